@@ -6,15 +6,29 @@ Use python3.8
 Основной модуль, из него производится запуск бота
 """
 
-import requests
 import logging
-from random import randint
+import time
 
 from pony.orm import db_session
 
+import bot_logging
 import handlers
-from air_traffic_controller import route_controller, route_formation
-from models import UserState, Registration
+from air_traffic_controller import route_controller, route_formation, timetable
+from bot_logging import LazyMessage, bind_log_fields, log_fields
+from bot_metrics import MetricsServer, metrics
+from dispatcher import EventDispatcher, event_id, event_peer_id
+from intent_matcher import IntentMatcher
+from message_ids import ReplyIds, event_message_id, random_id
+from photo_delivery import PhotoUploader
+from registration_writer import RegistrationWriter, registration_order
+from scenario_compiler import compile_scenarios, missing_settings
+from scenario_context import render_context, upgrade_context
+from send_queue import RetryPolicy, SendQueue
+from session_backends import make_backend
+from session_cache import SessionCache
+from session_sweeper import SessionSweeper
+from ticket_attachments import AttachmentCache, image_key
+from ticket_pool import TicketRenderPool
 from vk_api.bot_longpoll import VkBotEventType, VkBotLongPoll
 from vk_api.vk_api import VkApi
 
@@ -24,28 +38,55 @@ try:
 except ImportError:
     exit('DO --->>>cp setting.py.default settings.py<<<--- and set group_id and group_token!')
 
+MISSING_SETTINGS = missing_settings(settings_module=settings)
+if MISSING_SETTINGS:
+    exit(f'В settings.py нет настроек {", ".join(MISSING_SETTINGS)} - перенесите их из settings.py.default')
+
 
 def configure_logging():
     """
     Создание и конфигурация логера
+    Записи пишутся в консоль и файл фоновым потоком (bot_logging), файл ротируется по settings.LOG_ROTATION.
     """
     bot_log = logging.getLogger(name='air_ticket_bot')
 
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(logging.Formatter(fmt='%(levelname)s %(message)s'))
     stream_handler.setLevel(logging.INFO)
-    bot_log.addHandler(hdlr=stream_handler)
 
-    file_handler = logging.FileHandler(filename='air_ticket_bot.log', delay=False)
-    file_handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s', datefmt='%d-%m-%Y %H:%M'))
+    file_handler = bot_logging.file_handler(filename=settings.LOG_FILE, rotation=settings.LOG_ROTATION,
+                                            max_bytes=settings.LOG_MAX_BYTES, when=settings.LOG_ROTATE_WHEN,
+                                            backup_count=settings.LOG_BACKUP_COUNT)
+    if settings.LOG_JSON:
+        file_handler.setFormatter(bot_logging.JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s',
+                                                    datefmt='%d-%m-%Y %H:%M'))
     file_handler.setLevel(logging.DEBUG)
-    bot_log.addHandler(hdlr=file_handler)
 
-    bot_log.setLevel(logging.DEBUG)
+    bot_logging.start_logging(logger=bot_log, handlers=[stream_handler, file_handler],
+                              max_queue=settings.LOG_QUEUE_SIZE)
+    bot_log.setLevel(settings.LOG_LEVEL)
 
     return bot_log
 
 
+def order_summary(context):
+    """
+    Текст оформленного заказа для лога
+    :param context: контекст работы с пользователем
+    :return: str
+    """
+    return ('Телефон покупателя - {phone}\n'
+            'Email покупателя - {email}\n'
+            'Имя - {name}\n'
+            'Город отправления - {departure}\n'
+            'Город прибытия - {arrival}\n'
+            '{flight_date_to_output}\n'
+            'Количество мест - {spaces}\n'
+            'Комментарий - {comment}').format_map(render_context(context))
+
+
 class Bot:
 
     """
@@ -69,6 +110,15 @@ class Bot:
     Если в процессе выполнения сценария вводится /ticket, ответом будет предложение закончить оформление билета.
     """
 
+    # действия шагов сценария (ключ 'action' в settings.SCENARIOS): функция, выполняющая шаг
+    STEP_ACTIONS = {
+        'resume_or_cancel': '_step0',
+        'check_route': '_step3',
+        'form_flights': '_step4',
+        'offer_comment': '_step7',
+        'confirm_order': '_step8',
+    }
+
     def __init__(self, group_id, group_token):
         """
         :param group_id: group_id группы vk
@@ -76,15 +126,79 @@ class Bot:
         """
         self.group_id = group_id
         self.group_token = group_token
+        self.scenarios = compile_scenarios(scenarios=settings.SCENARIOS, handlers_module=handlers,
+                                           actions=self.STEP_ACTIONS, constants=handlers.TEMPLATE_CONSTANTS)
+        self.step_actions = {action: getattr(self, method_name) for action, method_name in self.STEP_ACTIONS.items()}
+        self.intent_matcher = IntentMatcher(intents=settings.INTENTS)
+        # расписание строится при старте, а не при первом подборе рейсов
+        timetable.build_all()
         self.vk = VkApi(token=self.group_token)
         self.long_poller = VkBotLongPoll(vk=self.vk, group_id=self.group_id)
         self.api = self.vk.get_api()
+        self.dispatcher = EventDispatcher(handler=self.handle_event,
+                                          workers=settings.DISPATCHER_WORKERS,
+                                          max_pending=settings.DISPATCHER_MAX_PENDING,
+                                          stats_interval=settings.DISPATCHER_STATS_INTERVAL)
+        self.ticket_pool = TicketRenderPool(workers=settings.TICKET_RENDER_WORKERS,
+                                            timeout=settings.TICKET_RENDER_TIMEOUT)
+        self.photo_uploader = PhotoUploader(upload_url_ttl=settings.PHOTO_UPLOAD_URL_TTL,
+                                            pool_size=settings.PHOTO_UPLOAD_POOL_SIZE)
+        self.send_queue = SendQueue(rate=settings.SEND_RATE_LIMIT, burst=settings.SEND_BURST,
+                                    workers=settings.SEND_WORKERS,
+                                    retry=RetryPolicy(attempts=settings.SEND_RETRY_ATTEMPTS,
+                                                      base_delay=settings.SEND_RETRY_BASE_DELAY,
+                                                      max_delay=settings.SEND_RETRY_MAX_DELAY))
+        self.reply_ids = ReplyIds()
+        self.attachments = AttachmentCache(path=settings.TICKET_ATTACHMENT_CACHE_PATH,
+                                           max_items=settings.TICKET_ATTACHMENT_CACHE_MAX_ITEMS)
+        self.sessions = SessionCache(mode=settings.SESSION_CACHE_MODE,
+                                     flush_interval=settings.SESSION_CACHE_FLUSH_INTERVAL,
+                                     flush_batch=settings.SESSION_CACHE_FLUSH_BATCH,
+                                     max_items=settings.SESSION_CACHE_MAX_ITEMS,
+                                     backend=make_backend(kind=settings.SESSION_BACKEND,
+                                                          sqlite_path=settings.SESSION_SQLITE_PATH))
+        self.registrations = RegistrationWriter(spool_path=settings.REGISTRATION_SPOOL_PATH,
+                                                flush_interval=settings.REGISTRATION_FLUSH_INTERVAL,
+                                                flush_batch=settings.REGISTRATION_FLUSH_BATCH)
+        self.sweeper = SessionSweeper(sessions=self.sessions, ttl=settings.SESSION_TTL,
+                                      batch=settings.SESSION_SWEEP_BATCH, interval=settings.SESSION_SWEEP_INTERVAL,
+                                      pause=settings.SESSION_SWEEP_PAUSE,
+                                      notify=self.notify_expired if settings.SESSION_EXPIRY_NOTICE else None)
+        if settings.METRICS_PORT:
+            metrics.enable()
+        self.metrics_server = MetricsServer(metrics=metrics, host=settings.METRICS_HOST, port=settings.METRICS_PORT)
 
     def run(self):
         """
         Запуск бота
+        События распределяются диспетчером по рабочим потокам (сообщения одного пользователя - по порядку)
+        """
+        self.sessions.start()
+        self.registrations.start()
+        self.send_queue.start()
+        self.dispatcher.start()
+        self.sweeper.start()
+        self.metrics_server.start()
+        try:
+            for event in self.long_poller.listen():
+                self.dispatcher.submit(event=event)
+        finally:
+            self.metrics_server.stop()
+            self.sweeper.stop()
+            self.dispatcher.stop()
+            self.ticket_pool.shutdown()
+            self.send_queue.stop()
+            self.attachments.close()
+            self.sessions.stop()
+            self.registrations.stop()
+
+    def handle_event(self, event):
+        """
+        Обработка одного события в рабочем потоке диспетчера
+        :param event: VkBotMessageEvent object
+        :return: None
         """
-        for event in self.long_poller.listen():
+        with log_fields(event_id=event_id(event=event), peer_id=event_peer_id(event=event)):
             try:
                 self.on_event(event=event)
             except Exception:
@@ -98,73 +212,161 @@ class Bot:
         :return: None
         """
         if event.type != VkBotEventType.MESSAGE_NEW:
-            log.info(f'{event.type} - НЕОБРАБАТЫВАЕМЫЙ ТИП СОБЫТИЯ')
+            log.info('%s - НЕОБРАБАТЫВАЕМЫЙ ТИП СОБЫТИЯ', event.type)
             return
 
         user_id = event.object.message['peer_id']
         text = event.object.message["text"]
-        state = UserState.get(user_id=str(user_id))
+        self.reply_ids.begin(peer_id=user_id, message_id=event_message_id(event=event))
+        try:
+            self.answer(user_id=user_id, text=text)
+        finally:
+            self.reply_ids.end(peer_id=user_id)
+
+    def answer(self, user_id, text):
+        """
+        Ответ на текстовое сообщение пользователя
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param text: текст сообщения
+        :return: None
+        """
+        with metrics.timer('state_load'):
+            state = self.sessions.get(user_id=user_id)
+            if state is not None:
+                bind_log_fields(step=state.step_name)
 
         if state is not None:
             self.continue_scenario(state=state, user_id=user_id, text=text)
+            with metrics.timer('db_commit'):
+                self.sessions.commit(state=state)
         else:
             # search intent
-            for intent in settings.INTENTS:
-                log.debug(f'User gets {intent}')
-                if any(token in text.lower() for token in intent['tokens']):
-                    if intent['answer']:
-                        self.send_text(text_to_send=intent['answer'], user_id=user_id)
-                    else:
-                        self.start_scenario(user_id=user_id, scenario_name=intent['scenario'], text=text)
-                    break
-            else:
+            intent = self.intent_matcher.match(text=text)
+            if intent is None:
                 self.send_text(text_to_send=settings.DEFAULT_ANSWER, user_id=user_id)
+            elif intent['answer']:
+                self.send_text(text_to_send=intent['answer'], user_id=user_id)
+            else:
+                self.start_scenario(user_id=user_id, scenario_name=intent['scenario'], text=text)
 
-    def send_text(self, text_to_send, user_id):
+    def send_text(self, text_to_send, user_id, attachment=None, message_random_id=None):
         """
-        Отправка сообщения в чат
+        Отправка сообщения в чат (через очередь отправки, с ожиданием результата)
         :param text_to_send: текст, который нужно отправить
         :param user_id: id пользователя, от которого пришло сообщение боту
+        :param attachment: вложения сообщения (например 'photo{owner_id}_{media_id}'), если нужны
+        :param message_random_id: random_id сообщения (по умолчанию - следующий ответ пользователю, см. message_ids)
+        :return: None
+        """
+        if message_random_id is None:
+            message_random_id = self.reply_ids.next(peer_id=user_id)
+        if attachment is None:
+            self.send_queue.call(self.api, 'messages.send',
+                                 message=text_to_send,
+                                 random_id=message_random_id,
+                                 peer_id=user_id)
+        else:
+            self.send_queue.call(self.api, 'messages.send',
+                                 message=text_to_send,
+                                 attachment=attachment,
+                                 random_id=message_random_id,
+                                 peer_id=user_id)
+
+    def notify_expired(self, user_id):
+        """
+        Уведомление пользователя, чей сценарий удалён за долгим молчанием
+        :param user_id: id пользователя
         :return: None
         """
-        self.api.messages.send(message=text_to_send,
-                               random_id=randint(0, 2 ** 20),
-                               peer_id=user_id)
+        self.send_text(text_to_send=settings.SESSION_EXPIRY_NOTICE, user_id=user_id,
+                       message_random_id=random_id(peer_id=user_id, message_id='expired', part=int(time.time())))
 
-    def send_image(self, image, user_id):
+    def upload_images(self, images):
+        """
+        Загрузка картинок для отправки в сообщениях
+        :param images: список картинок (настроено на формат .png)
+        :return: list[строка вложения 'photo{owner_id}_{media_id}', ...]
+        """
+        with metrics.timer('photo_upload'):
+            return self.photo_uploader.upload(api=self.api, images=images)
+
+    def send_image(self, image, user_id, message_random_id=None, cache_key=None):
         """
         Отправка картинки в чат
         :param image: картинка, который нужно отправить (настроено на формат .png)
         :param user_id: id пользователя, от которого пришло сообщение боту
+        :param message_random_id: random_id сообщения (по умолчанию - следующий ответ пользователю)
+        :param cache_key: ключ картинки в кэше вложений (image_key), если её нужно запомнить
         :return: None
         """
-        upload_url = self.api.photos.getMessagesUploadServer()['upload_url']
-        upload_data = requests.post(url=upload_url, files={'photo': ('image.png', image, 'image/png')}).json()
+        if message_random_id is None:
+            message_random_id = self.reply_ids.next(peer_id=user_id)
+        attachment = self.upload_images(images=[image])[0]
+        self.attachments.put(key=cache_key, attachment=attachment)
 
-        image_data = self.api.photos.saveMessagesPhoto(**upload_data)
-        owner_id = image_data[0]['owner_id']
-        media_id = image_data[0]['id']
-        attachment = f'photo{owner_id}_{media_id}'
+        self.send_queue.call(self.api, 'messages.send',
+                             attachment=attachment,
+                             random_id=message_random_id,
+                             peer_id=user_id)
 
-        self.api.messages.send(attachment=attachment,
-                               random_id=randint(0, 2 ** 20),
-                               peer_id=user_id)
+    def send_cached_image(self, cache_key, user_id, message_random_id):
+        """
+        Отправка картинки, уже загруженной в VK
+        :param cache_key: ключ картинки в кэше вложений (image_key)
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param message_random_id: random_id сообщения
+        :return: bool, True - картинка отправлена, False - её нет в кэше (или VK её больше не принимает)
+        """
+        attachment = self.attachments.get(key=cache_key)
+        if attachment is None:
+            return False
+        try:
+            self.send_queue.call(self.api, 'messages.send',
+                                 attachment=attachment,
+                                 random_id=message_random_id,
+                                 peer_id=user_id)
+        except Exception:
+            log.warning('Вложение %s не отправлено, картинка будет нарисована заново', attachment, exc_info=True)
+            self.attachments.discard(key=cache_key)
+            return False
+        return True
 
     def send_step(self, step, user_id, text, context):
         """
         Отправка и сообщения, и картинки в чат (если это предусматривается в шаге сценария)
-        :param step: текущий шаг выполнения сценария (словарь, с информацией о шаге)
+        :param step: текущий шаг выполнения сценария (CompiledStep)
         :param user_id: id пользователя, от которого пришло сообщение боту
         :param text: текст ПОЛУЧЕННОГО от пользователя сообщения
         :param context: контекст работы с пользователем (JSON, хранящийся в базе данных state.context)
         :return: None
         """
-        if 'text' in step:
-            self.send_text(text_to_send=step['text'].format(**context), user_id=user_id)
-        if 'image' in step:
-            handler = getattr(handlers, step['image'])
-            image = handler(text=text, context=context)
-            self.send_image(image=image, user_id=user_id)
+        cache_key = image_key(image_handler=step.image, context=context) if step.image is not None else None
+        if step.image is not None and step.text is not None and settings.STEP_IMAGE_WITH_TEXT:
+            # картинка прикрепляется к тексту шага - одно сообщение вместо двух
+            attachment = self.attachments.get(key=cache_key)
+            try:
+                if attachment is None:
+                    image = self.ticket_pool.render(image_handler=step.image, text=text, context=context)
+                    attachment = self.upload_images(images=[image])[0]
+                    self.attachments.put(key=cache_key, attachment=attachment)
+            except Exception:
+                log.exception('ОШИБКА ПРИ РИСОВАНИИ КАРТИНКИ %s', step.image)
+            self.send_text(text_to_send=step.render_text(context=render_context(context)), user_id=user_id,
+                           attachment=attachment)
+            return
+
+        if step.text is not None:
+            self.send_text(text_to_send=step.render_text(context=render_context(context)), user_id=user_id)
+        if step.image is not None:
+            # картинка рисуется в пуле процессов и отправляется следом за текстом, когда будет готова
+            # (random_id берётся сейчас из id этого сообщения - к тому времени бот может отвечать уже на другое)
+            image_random_id = self.reply_ids.named(peer_id=user_id, name='image')
+            if self.send_cached_image(cache_key=cache_key, user_id=user_id, message_random_id=image_random_id):
+                return
+            self.ticket_pool.deliver(image_handler=step.image, text=text, context=context,
+                                     callback=lambda image: self.send_image(image=image, user_id=user_id,
+                                                                            message_random_id=image_random_id,
+                                                                            cache_key=cache_key))
 
     def start_scenario(self, user_id, scenario_name, text):
         """
@@ -174,60 +376,55 @@ class Bot:
         :param text: текст, введённый пользователем в сообщении
         :return: None
         """
-        scenario = settings.SCENARIOS[scenario_name]
-        first_step = scenario['first_step']
-        step = scenario['steps'][first_step]
-        UserState(user_id=str(user_id), scenario_name=scenario_name, step_name=first_step, context={})
+        scenario = self.scenarios[scenario_name]
+        first_step = scenario.first_step
+        step = scenario.steps[first_step]
+        bind_log_fields(step=first_step)
+        state = self.sessions.create(user_id=user_id, scenario_name=scenario_name, step_name=first_step, context={})
         self.send_step(step=step, user_id=user_id, text=text, context={})
+        with metrics.timer('db_commit'):
+            self.sessions.commit(state=state)
 
     def continue_scenario(self, state, user_id, text):
         """
         Продолжение сценария
-        :param state: состояние пользователя в сценарии (таблица из базы данных)
+        :param state: состояние пользователя в сценарии (ScenarioState из кэша состояний)
         :param user_id: id пользователя, от которого пришло сообщение боту
         :param text: текст сообщения пользователя
         :return: None
         """
         # continue scenario
-        steps = settings.SCENARIOS[state.scenario_name]['steps']
+        upgrade_context(context=state.context)
+        scenario = self.scenarios[state.scenario_name]
+        steps = scenario.steps
         step = steps[state.step_name]
 
         if text == '/help':
             self.send_step(step=step, user_id=user_id, text=text, context=state.context)
-        elif text == '/ticket':
+        elif text == '/ticket' and scenario.pause_step is not None:
             state.context['pause_step'] = state.step_name
-            next_step = steps['step0']
-            state.step_name = 'step0'
-            self.send_text(text_to_send=next_step['text'], user_id=user_id)
+            next_step = steps[scenario.pause_step]
+            state.step_name = scenario.pause_step
+            self.send_text(text_to_send=next_step.text, user_id=user_id)
         else:
-            handler = getattr(handlers, step['handler'])
-            if handler(text=text.lower(), context=state.context):
+            with metrics.timer('handler'):
+                passed = step.handler(text=text.lower(), context=state.context)
+            if passed:
                 # start new step
-                current_foo = self.define_step_foo(step_name=state.step_name)
+                current_foo = self.define_step_foo(step=step)
                 current_foo(state=state, steps=steps, step=step, user_id=user_id, text=text)    # работает
             else:
                 # retry current step
-                text_to_send = step['failure_text'].format(**state.context)
+                text_to_send = step.render_failure(context=render_context(state.context))
                 self.send_text(text_to_send=text_to_send, user_id=user_id)
 
-    def define_step_foo(self, step_name):
-        """
-        Определение функции, выполняющей текущий шаг
-        :param step_name: название выполняемого шага
-        :return: название нужной функции
-        """
-        if step_name == 'step0':
-            return self._step0
-        elif step_name == 'step3':
-            return self._step3
-        elif step_name == 'step4':
-            return self._step4
-        elif step_name == 'step7':
-            return self._step7
-        elif step_name == 'step8':
-            return self._step8
-        else:
-            return self._normal_step
+    def define_step_foo(self, step):
+        """
+        Определение функции, выполняющей текущий шаг (по ключу 'action' шага сценария)
+        :param step: выполняемый шаг (CompiledStep)
+        :return: нужная функция
+        """
+        return self.step_actions.get(step.action, self._normal_step)
 
     def _step0(self, state, steps, step, user_id, text):
         """
@@ -247,9 +444,9 @@ class Bot:
             self.send_step(step=next_step, user_id=user_id, text=text, context=state.context)
             del state.context['pause_step']
         else:
-            state.step_name = step['additional_next_step']
-            next_step = steps[step['additional_next_step']]
-            self.send_text(text_to_send=next_step['text'], user_id=user_id)
+            state.step_name = step.additional_next_step
+            next_step = steps[step.additional_next_step]
+            self.send_text(text_to_send=next_step.text, user_id=user_id)
             state.delete()
 
     def _step3(self, state, steps, step, user_id, text):
@@ -266,10 +463,11 @@ class Bot:
         departure = state.context['departure']
         appointment = state.context['arrival']
         if not route_controller(departure=departure, arrival=appointment):
-            # break scenario if have not route
-            next_step = steps[step['additional_next_step']]
-            state.step_name = step['additional_next_step']
-            self.send_text(text_to_send=next_step['text'], user_id=user_id)
+            # break scenario if have not route, offer connecting flights if there are any
+            next_step = steps[step.additional_next_step]
+            state.step_name = step.additional_next_step
+            text_to_send = next_step.render_text(context=render_context(state.context))
+            self.send_text(text_to_send=text_to_send, user_id=user_id)
             state.delete()
         else:
             self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
@@ -288,8 +486,8 @@ class Bot:
         departure = state.context['departure']
         arrival = state.context['arrival']
         date = state.context['date']
-        state.context['result_flights_dict'], state.context['result_flights_str'] = \
-            route_formation(departure=departure, arrival=arrival, date=date)
+        with metrics.timer('route_formation'):
+            state.context['flights'] = route_formation(departure=departure, arrival=arrival, date=date)
         self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
 
     def _step7(self, state, steps, step, user_id, text):
@@ -305,9 +503,9 @@ class Bot:
         # checking the want to leave comment
         confirmation = state.context['confirmation']
         if confirmation:
-            next_step = steps[step['additional_next_step']]
-            state.step_name = step['additional_next_step']
-            self.send_text(text_to_send=next_step['text'], user_id=user_id)
+            next_step = steps[step.additional_next_step]
+            state.step_name = step.additional_next_step
+            self.send_text(text_to_send=next_step.text, user_id=user_id)
         else:
             self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
 
@@ -324,9 +522,9 @@ class Bot:
         # checking the want to complete ticket
         confirmation = state.context['confirmation']
         if not confirmation:
-            next_step = steps[step['additional_next_step']]
-            state.step_name = step['additional_next_step']
-            self.send_text(text_to_send=next_step['text'], user_id=user_id)
+            next_step = steps[step.additional_next_step]
+            state.step_name = step.additional_next_step
+            self.send_text(text_to_send=next_step.text, user_id=user_id)
             state.delete()
         else:
             self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
@@ -341,31 +539,16 @@ class Bot:
         :param text: текст сообщения пользователя
         :return: None
         """
-        next_step = steps[step['next_step']]
+        next_step = steps[step.next_step]
         self.send_step(step=next_step, user_id=user_id, text=text, context=state.context)
-        if next_step['next_step']:
+        if next_step.next_step:
             # switch to next step normal
-            state.step_name = step['next_step']
+            state.step_name = step.next_step
         else:
             # finish scenario
-            log.info('Оформлен билет:\n'
-                     'Телефон покупателя - {phone}\n'
-                     'Email покупателя - {email}\n'
-                     'Имя - {name}\n'
-                     'Город отправления - {departure}\n'
-                     'Город прибытия - {arrival}\n'
-                     '{flight_date_to_output}\n'
-                     'Количество мест - {spaces}\n'
-                     'Комментарий - {comment}'.format(**state.context))
-
-            Registration(user_phone=state.context['phone'],
-                         user_email=state.context['email'],
-                         user_name=state.context['name'],
-                         departure=state.context['departure'],
-                         arrival=state.context['arrival'],
-                         date=state.context['flight_date_to_database'],
-                         spaces=state.context['spaces'],
-                         comment=state.context['comment'])
+            log.info('Оформлен билет:\n%s', LazyMessage(order_summary, state.context))
+
+            self.registrations.submit(order=registration_order(context=state.context))
             state.delete()
 
 
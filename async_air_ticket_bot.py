@@ -0,0 +1,739 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Асинхронная версия бота (asyncio + aiohttp)
+Один процесс обслуживает тысячи открытых диалогов без потока на каждый запрос.
+Сценарий работает так же, как в синхронном Bot из модуля 'air_ticket_bot.py'.
+Запуск бота производится из этого модуля.
+"""
+
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+import handlers
+from air_ticket_bot import log, order_summary
+from air_traffic_controller import route_controller, route_formation, timetable
+from bot_logging import LazyMessage, bind_log_fields, current_log_fields, log_fields
+from bot_metrics import MetricsServer, metrics
+from dispatcher import event_id, event_peer_id
+from intent_matcher import IntentMatcher
+from message_ids import ReplyIds, event_message_id, random_id
+from photo_delivery import PhotoUploadError, UploadUrlCache, image_file_type, upload_fields
+from registration_writer import RegistrationWriter, registration_order
+from scenario_compiler import compile_scenarios
+from scenario_context import render_context, upgrade_context
+from send_queue import AsyncSendQueue, RetryPolicy
+from session_backends import make_backend
+from session_cache import SessionCache
+from session_sweeper import SessionSweeper
+from ticket_attachments import AttachmentCache, image_key
+from ticket_pool import TicketRenderPool, render_image
+from vk_api.bot_longpoll import VkBotEventType, VkBotLongPoll
+
+
+try:
+    import settings
+except ImportError:
+    exit('DO --->>>cp setting.py.default settings.py<<<--- and set group_id and group_token!')
+
+
+VK_API_URL = 'https://api.vk.com/method/'
+VK_API_VERSION = '5.92'
+
+
+class AsyncVkApiError(Exception):
+    """
+    Ошибка, которую вернул VK API
+    """
+
+    def __init__(self, method, error):
+        self.method = method
+        self.code = error.get('error_code')
+        self.error = error
+        super().__init__(f'[{self.code}] {error.get("error_msg")} ({method})')
+
+
+class AsyncVkApi:
+
+    """
+    Асинхронный клиент методов VK API
+    Все запросы идут через одну aiohttp.ClientSession с пулом соединений
+    """
+
+    def __init__(self, token, pool_size=100, api_version=VK_API_VERSION):
+        """
+        :param token: секретный токен группы
+        :param pool_size: максимальное количество одновременно открытых соединений
+        :param api_version: версия VK API
+        """
+        self.token = token
+        self.pool_size = pool_size
+        self.api_version = api_version
+        self.session = None
+
+    async def open(self):
+        """
+        Создание сессии (должно выполняться внутри работающего event loop)
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        """
+        Закрытие сессии и всех соединений пула
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def method(self, method, **values):
+        """
+        Вызов метода VK API
+        :param method: название метода, например 'messages.send'
+        :param values: параметры метода
+        :return: поле response ответа VK
+        """
+        session = await self.open()
+        values['access_token'] = self.token
+        values['v'] = self.api_version
+        async with session.post(url=f'{VK_API_URL}{method}', data=values) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+        if 'error' in data:
+            raise AsyncVkApiError(method=method, error=data['error'])
+        return data['response']
+
+
+class AsyncPhotoUploader:
+
+    """
+    Асинхронная загрузка фотографий для сообщений через сессию AsyncVkApi
+    Как и PhotoUploader: адрес сервера загрузки используется повторно, пока он действителен, а если сервер
+    не принял файл, адрес запрашивается заново и загрузка повторяется.
+    """
+
+    def __init__(self, api, upload_url_ttl=600, timeout=30):
+        """
+        :param api: AsyncVkApi object
+        :param upload_url_ttl: сколько секунд использовать полученный адрес сервера загрузки
+        :param timeout: время ожидания ответа сервера загрузки, сек
+        """
+        self.api = api
+        self.upload_urls = UploadUrlCache(ttl=upload_url_ttl)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def upload_url(self, refresh=False):
+        """
+        Адрес сервера загрузки (запрашивается у VK, только если прежний устарел)
+        :param refresh: запросить новый адрес в любом случае
+        :return: upload_url
+        """
+        upload_url = None if refresh else self.upload_urls.get()
+        if upload_url is None:
+            upload_url = (await self.api.method('photos.getMessagesUploadServer'))['upload_url']
+            self.upload_urls.put(url=upload_url)
+        return upload_url
+
+    async def upload(self, image):
+        """
+        Загрузка и сохранение фотографии
+        :param image: картинка в байтах (тип определяется по содержимому)
+        :return: строка вложения photo{owner_id}_{media_id}
+        """
+        upload_data = await self._post(image=image)
+        image_data = await self.api.method('photos.saveMessagesPhoto', **upload_data)
+        return f'photo{image_data[0]["owner_id"]}_{image_data[0]["id"]}'
+
+    async def _post(self, image):
+        """
+        Отправка фотографии на сервер загрузки
+        :return: dict {server, photo, hash} для photos.saveMessagesPhoto
+        """
+        filename, file_type = image_file_type(data=image)
+        session = await self.api.open()
+        for refresh in (False, True):
+            upload_url = await self.upload_url(refresh=refresh)
+            form = aiohttp.FormData()
+            form.add_field('photo', image, filename=filename, content_type=file_type)
+            try:
+                async with session.post(url=upload_url, data=form, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    upload_data = upload_fields(upload_data=await response.json(content_type=None))
+                if upload_data is not None:
+                    return upload_data
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                if refresh:
+                    raise
+            if not refresh:
+                log.info('Сервер загрузки фотографий не принял файл, адрес запрашивается заново')
+        raise PhotoUploadError('Фотография не загружена')
+
+
+class AsyncBotLongPoll:
+
+    """
+    Асинхронное чтение событий Bots Long Poll
+    """
+
+    def __init__(self, api, group_id, wait=25):
+        """
+        :param api: AsyncVkApi object
+        :param group_id: group_id группы vk
+        :param wait: время ожидания событий сервером, сек
+        """
+        self.api = api
+        self.group_id = group_id
+        self.wait = wait
+        self.server = None
+        self.key = None
+        self.ts = None
+
+    async def update_longpoll_server(self, update_ts=True):
+        """
+        Получение адреса и ключа long poll сервера
+        :param update_ts: обновлять ли номер последнего события
+        """
+        response = await self.api.method('groups.getLongPollServer', group_id=self.group_id)
+        self.server = response['server']
+        self.key = response['key']
+        if update_ts:
+            self.ts = response['ts']
+
+    async def check(self):
+        """
+        Однократный запрос событий у сервера
+        :return: list[VkBotEvent object, ...]
+        """
+        if self.server is None:
+            await self.update_longpoll_server()
+
+        session = await self.api.open()
+        params = {'act': 'a_check', 'key': self.key, 'ts': self.ts, 'wait': self.wait}
+        timeout = aiohttp.ClientTimeout(total=self.wait + 10)
+        async with session.get(url=self.server, params=params, timeout=timeout) as response:
+            data = await response.json(content_type=None)
+
+        if 'failed' not in data:
+            self.ts = data['ts']
+            return [self._parse_event(raw_event=raw_event) for raw_event in data['updates']]
+        elif data['failed'] == 1:
+            self.ts = data['ts']
+        elif data['failed'] == 2:
+            await self.update_longpoll_server(update_ts=False)
+        elif data['failed'] == 3:
+            await self.update_longpoll_server()
+        return []
+
+    async def listen(self):
+        """
+        Бесконечное чтение событий
+        :yields: VkBotEvent object
+        """
+        while True:
+            for event in await self.check():
+                yield event
+
+    @staticmethod
+    def _parse_event(raw_event):
+        """
+        Создание объекта события тем же классом, что и у VkBotLongPoll
+        """
+        event_class = VkBotLongPoll.CLASS_BY_EVENT_TYPE.get(raw_event['type'], VkBotLongPoll.DEFAULT_EVENT_CLASS)
+        return event_class(raw_event)
+
+
+class AsyncBot:
+
+    """
+    Асинхронный бот для vk.com, сценарий заказа авиабилетов такой же, как у Bot
+
+    Каждое событие обрабатывается в отдельной задаче asyncio, сообщения одного пользователя - по порядку.
+    Запросы к базе данных (pony работает синхронно) выполняются в небольшом пуле потоков,
+    состояния пользователей берутся из кэша SessionCache и в базу за ними бот ходит только при промахе.
+    """
+
+    # действия шагов сценария (ключ 'action' в settings.SCENARIOS): функция, выполняющая шаг
+    STEP_ACTIONS = {
+        'resume_or_cancel': '_step0',
+        'check_route': '_step3',
+        'form_flights': '_step4',
+        'offer_comment': '_step7',
+        'confirm_order': '_step8',
+    }
+
+    def __init__(self, group_id, group_token):
+        """
+        :param group_id: group_id группы vk
+        :param group_token: секретный токен для этой группы
+        """
+        self.group_id = group_id
+        self.group_token = group_token
+        self.scenarios = compile_scenarios(scenarios=settings.SCENARIOS, handlers_module=handlers,
+                                           actions=self.STEP_ACTIONS, constants=handlers.TEMPLATE_CONSTANTS)
+        self.step_actions = {action: getattr(self, method_name) for action, method_name in self.STEP_ACTIONS.items()}
+        self.intent_matcher = IntentMatcher(intents=settings.INTENTS)
+        # расписание строится при старте, а не при первом подборе рейсов
+        timetable.build_all()
+        self.api = AsyncVkApi(token=self.group_token, pool_size=settings.ASYNC_HTTP_POOL_SIZE)
+        self.long_poller = AsyncBotLongPoll(api=self.api, group_id=self.group_id)
+        self.photo_uploader = AsyncPhotoUploader(api=self.api, upload_url_ttl=settings.PHOTO_UPLOAD_URL_TTL)
+        self.send_queue = AsyncSendQueue(rate=settings.SEND_RATE_LIMIT, burst=settings.SEND_BURST,
+                                         workers=settings.SEND_WORKERS,
+                                         retry=RetryPolicy(attempts=settings.SEND_RETRY_ATTEMPTS,
+                                                           base_delay=settings.SEND_RETRY_BASE_DELAY,
+                                                           max_delay=settings.SEND_RETRY_MAX_DELAY))
+        self.reply_ids = ReplyIds()
+        self.attachments = AttachmentCache(path=settings.TICKET_ATTACHMENT_CACHE_PATH,
+                                           max_items=settings.TICKET_ATTACHMENT_CACHE_MAX_ITEMS)
+        self.db_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_DB_WORKERS, thread_name_prefix='bot-db')
+        self.ticket_pool = TicketRenderPool(workers=settings.TICKET_RENDER_WORKERS,
+                                            timeout=settings.TICKET_RENDER_TIMEOUT)
+        self.sessions = SessionCache(mode=settings.SESSION_CACHE_MODE,
+                                     flush_interval=settings.SESSION_CACHE_FLUSH_INTERVAL,
+                                     flush_batch=settings.SESSION_CACHE_FLUSH_BATCH,
+                                     max_items=settings.SESSION_CACHE_MAX_ITEMS,
+                                     backend=make_backend(kind=settings.SESSION_BACKEND,
+                                                          sqlite_path=settings.SESSION_SQLITE_PATH))
+        self.registrations = RegistrationWriter(spool_path=settings.REGISTRATION_SPOOL_PATH,
+                                                flush_interval=settings.REGISTRATION_FLUSH_INTERVAL,
+                                                flush_batch=settings.REGISTRATION_FLUSH_BATCH)
+        self.sweeper = SessionSweeper(sessions=self.sessions, ttl=settings.SESSION_TTL,
+                                      batch=settings.SESSION_SWEEP_BATCH, interval=settings.SESSION_SWEEP_INTERVAL,
+                                      pause=settings.SESSION_SWEEP_PAUSE,
+                                      notify=self.notify_expired if settings.SESSION_EXPIRY_NOTICE else None)
+        if settings.METRICS_PORT:
+            metrics.enable()
+        self.metrics_server = MetricsServer(metrics=metrics, host=settings.METRICS_HOST, port=settings.METRICS_PORT)
+        self.loop = None
+        self.peer_locks = {}  # peer_id: (asyncio.Lock, количество задач пользователя)
+        self.tasks = set()
+
+    async def run(self):
+        """
+        Запуск бота
+        """
+        self.loop = asyncio.get_running_loop()
+        self.sessions.start()
+        self.registrations.start()
+        self.send_queue.start()
+        self.sweeper.start()
+        self.metrics_server.start()
+        try:
+            async for event in self.long_poller.listen():
+                self.spawn(coroutine=self.handle_event(event=event))
+        finally:
+            await self.in_db(self.metrics_server.stop)
+            await self.in_db(self.sweeper.stop)
+            while self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.send_queue.stop()
+            await self.api.close()
+            await self.in_db(self.attachments.close)
+            await self.in_db(self.sessions.stop)
+            await self.in_db(self.registrations.stop)
+            self.db_executor.shutdown(wait=True)
+            self.ticket_pool.shutdown()
+
+    def spawn(self, coroutine):
+        """
+        Запуск задачи, которую нужно дождаться при остановке бота
+        :param coroutine: coroutine object
+        :return: None
+        """
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle_event(self, event):
+        """
+        Обработка одного события, сообщения одного пользователя обрабатываются по порядку
+        :param event: VkBotMessageEvent object
+        :return: None
+        """
+        peer_id = event_peer_id(event=event)
+        with log_fields(event_id=event_id(event=event), peer_id=peer_id):
+            try:
+                if peer_id is None:
+                    # событие без peer_id ни с чем не упорядочивается
+                    await self.on_event(event=event)
+                else:
+                    async with self.peer_lock(peer_id=peer_id):
+                        await self.on_event(event=event)
+            except Exception:
+                log.exception('ОШИБКА ПРИ ОБРАБОТКЕ СОБЫТИЯ')
+
+    @asynccontextmanager
+    async def peer_lock(self, peer_id):
+        """
+        Блокировка peer_id: живёт, пока есть задачи этого пользователя
+        :param peer_id: id пользователя
+        """
+        lock, users = self.peer_locks.get(peer_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.peer_locks[peer_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.peer_locks[peer_id]
+            if users == 1:
+                del self.peer_locks[peer_id]
+            else:
+                self.peer_locks[peer_id] = (lock, users - 1)
+
+    async def in_db(self, func, *args):
+        """
+        Выполнение синхронной функции работы с базой данных в пуле потоков
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, func, *args)
+
+    async def on_event(self, event):
+        """
+        Ответ на полученные сообщения, если это текст
+        :param event: VkBotMessageEvent object
+        :return: None
+        """
+        if event.type != VkBotEventType.MESSAGE_NEW:
+            log.info('%s - НЕОБРАБАТЫВАЕМЫЙ ТИП СОБЫТИЯ', event.type)
+            return
+
+        user_id = event.object.message['peer_id']
+        text = event.object.message["text"]
+        self.reply_ids.begin(peer_id=user_id, message_id=event_message_id(event=event))
+        try:
+            await self.answer(user_id=user_id, text=text)
+        finally:
+            self.reply_ids.end(peer_id=user_id)
+
+    async def answer(self, user_id, text):
+        """
+        Ответ на текстовое сообщение пользователя
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param text: текст сообщения
+        :return: None
+        """
+        with metrics.timer('state_load'):
+            found, state = self.sessions.peek(user_id=user_id)
+            if not found:
+                state = await self.in_db(self.sessions.get, user_id)
+            if state is not None:
+                bind_log_fields(step=state.step_name)
+
+        if state is not None:
+            await self.continue_scenario(state=state, user_id=user_id, text=text)
+            with metrics.timer('db_commit'):
+                await self.in_db(self.sessions.commit, state)
+        else:
+            # search intent
+            intent = self.intent_matcher.match(text=text)
+            if intent is None:
+                await self.send_text(text_to_send=settings.DEFAULT_ANSWER, user_id=user_id)
+            elif intent['answer']:
+                await self.send_text(text_to_send=intent['answer'], user_id=user_id)
+            else:
+                await self.start_scenario(user_id=user_id, scenario_name=intent['scenario'], text=text)
+
+    async def send_text(self, text_to_send, user_id, attachment=None, message_random_id=None):
+        """
+        Отправка сообщения в чат (через очередь отправки)
+        :param text_to_send: текст, который нужно отправить
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param attachment: вложения сообщения (например 'photo{owner_id}_{media_id}'), если нужны
+        :param message_random_id: random_id сообщения (по умолчанию - следующий ответ пользователю, см. message_ids)
+        :return: None
+        """
+        if message_random_id is None:
+            message_random_id = self.reply_ids.next(peer_id=user_id)
+        if attachment is None:
+            await self.send_queue.call(self.api, 'messages.send', message=text_to_send, random_id=message_random_id,
+                                       peer_id=user_id)
+        else:
+            await self.send_queue.call(self.api, 'messages.send', message=text_to_send, attachment=attachment,
+                                       random_id=message_random_id, peer_id=user_id)
+
+    def notify_expired(self, user_id):
+        """
+        Уведомление пользователя, чей сценарий удалён за долгим молчанием (вызывается из потока SessionSweeper)
+        :param user_id: id пользователя
+        :return: None
+        """
+        coroutine = self.send_text(text_to_send=settings.SESSION_EXPIRY_NOTICE, user_id=user_id,
+                                   message_random_id=random_id(peer_id=user_id, message_id='expired',
+                                                               part=int(time.time())))
+        asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def send_image(self, image, user_id, message_random_id=None, cache_key=None):
+        """
+        Отправка картинки в чат
+        :param image: картинка в байтах, которую нужно отправить (тип определяется по содержимому)
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param message_random_id: random_id сообщения (по умолчанию - следующий ответ пользователю)
+        :param cache_key: ключ картинки в кэше вложений (image_key), если её нужно запомнить
+        :return: None
+        """
+        if message_random_id is None:
+            message_random_id = self.reply_ids.next(peer_id=user_id)
+        attachment = await self.upload_image(image=image, cache_key=cache_key)
+
+        await self.send_queue.call(self.api, 'messages.send', attachment=attachment, random_id=message_random_id,
+                                   peer_id=user_id)
+
+    async def upload_image(self, image, cache_key=None):
+        """
+        Загрузка картинки в VK
+        :param image: картинка в байтах
+        :param cache_key: ключ картинки в кэше вложений (image_key), если её нужно запомнить
+        :return: str, вложение 'photo{owner_id}_{media_id}'
+        """
+        with metrics.timer('photo_upload'):
+            attachment = await self.photo_uploader.upload(image=image)
+        await self.in_db(self.attachments.put, cache_key, attachment)
+        return attachment
+
+    async def send_step(self, step, user_id, text, context):
+        """
+        Отправка и сообщения, и картинки в чат (если это предусматривается в шаге сценария)
+        :param step: текущий шаг выполнения сценария (CompiledStep)
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param text: текст ПОЛУЧЕННОГО от пользователя сообщения
+        :param context: контекст работы с пользователем
+        :return: None
+        """
+        if step.image is not None and step.text is not None and settings.STEP_IMAGE_WITH_TEXT:
+            # картинка прикрепляется к тексту шага - одно сообщение вместо двух
+            cache_key = image_key(image_handler=step.image, context=context)
+            attachment = await self.in_db(self.attachments.get, cache_key)
+            try:
+                if attachment is None:
+                    image = await self.render(image_handler=step.image, text=text, context=dict(context))
+                    if image is not None:
+                        attachment = await self.upload_image(image=image, cache_key=cache_key)
+            except Exception:
+                log.exception('ОШИБКА ПРИ РИСОВАНИИ КАРТИНКИ %s', step.image)
+            await self.send_text(text_to_send=step.render_text(context=render_context(context)), user_id=user_id,
+                                 attachment=attachment)
+            return
+
+        if step.text is not None:
+            await self.send_text(text_to_send=step.render_text(context=render_context(context)), user_id=user_id)
+        if step.image is not None:
+            # картинка отправляется отдельной задачей следом за текстом, шаг сценария её не ждёт
+            # (random_id берётся сейчас из id этого сообщения - к тому времени бот может отвечать уже на другое)
+            image_random_id = self.reply_ids.named(peer_id=user_id, name='image')
+            self.spawn(coroutine=self.send_rendered_image(image_handler=step.image, text=text,
+                                                          context=dict(context), user_id=user_id,
+                                                          message_random_id=image_random_id))
+
+    async def render(self, image_handler, text, context):
+        """
+        Рисование картинки в пуле процессов (или в потоке, если пул отключён)
+        :param image_handler: название handler'а картинки из модуля handlers
+        :param text: текст ПОЛУЧЕННОГО от пользователя сообщения
+        :param context: контекст работы с пользователем
+        :return: картинка в байтах, None - рисование не уложилось в таймаут пула
+        """
+        if self.ticket_pool.workers:
+            future = self.ticket_pool.submit(image_handler=image_handler, text=text, context=context)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.ticket_pool.timeout)
+            except asyncio.TimeoutError:
+                self.ticket_pool.timed_out(future=future, image_handler=image_handler)
+                return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, render_image, image_handler, text, context,
+                                          current_log_fields().get('step'))
+
+    async def send_rendered_image(self, image_handler, text, context, user_id, message_random_id=None):
+        """
+        Рисование картинки (в пуле процессов) и её отправка в чат
+        Ошибка рисования или отправки записывается в лог и не прерывает сценарий.
+        :param image_handler: название handler'а картинки из модуля handlers
+        :param text: текст ПОЛУЧЕННОГО от пользователя сообщения
+        :param context: контекст работы с пользователем
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param message_random_id: random_id сообщения с картинкой
+        :return: None
+        """
+        cache_key = image_key(image_handler=image_handler, context=context)
+        attachment = await self.in_db(self.attachments.get, cache_key)
+        if attachment is not None:
+            # одинаковая картинка уже загружена в VK
+            try:
+                await self.send_queue.call(self.api, 'messages.send', attachment=attachment,
+                                           random_id=message_random_id, peer_id=user_id)
+                return
+            except Exception:
+                log.warning('Вложение %s не отправлено, картинка будет нарисована заново', attachment, exc_info=True)
+                await self.in_db(self.attachments.discard, cache_key)
+        try:
+            image = await self.render(image_handler=image_handler, text=text, context=context)
+            if image is not None:
+                await self.send_image(image=image, user_id=user_id, message_random_id=message_random_id,
+                                      cache_key=cache_key)
+        except Exception:
+            log.exception('ОШИБКА ПРИ РИСОВАНИИ КАРТИНКИ %s', image_handler)
+
+    async def start_scenario(self, user_id, scenario_name, text):
+        """
+        Запуск сценария
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param scenario_name: назавание запускаемого сценария
+        :param text: текст, введённый пользователем в сообщении
+        :return: None
+        """
+        scenario = self.scenarios[scenario_name]
+        first_step = scenario.first_step
+        step = scenario.steps[first_step]
+        bind_log_fields(step=first_step)
+        # create ждёт блокировку кэша, которую держит запись состояний в базу, поэтому выполняется в пуле потоков
+        state = await self.in_db(self.sessions.create, user_id, scenario_name, first_step, {})
+        await self.send_step(step=step, user_id=user_id, text=text, context={})
+        with metrics.timer('db_commit'):
+            await self.in_db(self.sessions.commit, state)
+
+    async def continue_scenario(self, state, user_id, text):
+        """
+        Продолжение сценария
+        :param state: состояние пользователя в сценарии (ScenarioState)
+        :param user_id: id пользователя, от которого пришло сообщение боту
+        :param text: текст сообщения пользователя
+        :return: None
+        """
+        # continue scenario
+        upgrade_context(context=state.context)
+        scenario = self.scenarios[state.scenario_name]
+        steps = scenario.steps
+        step = steps[state.step_name]
+
+        if text == '/help':
+            await self.send_step(step=step, user_id=user_id, text=text, context=state.context)
+        elif text == '/ticket' and scenario.pause_step is not None:
+            state.context['pause_step'] = state.step_name
+            next_step = steps[scenario.pause_step]
+            state.step_name = scenario.pause_step
+            await self.send_text(text_to_send=next_step.text, user_id=user_id)
+        else:
+            with metrics.timer('handler'):
+                passed = step.handler(text=text.lower(), context=state.context)
+            if passed:
+                # start new step
+                current_foo = self.define_step_foo(step=step)
+                await current_foo(state=state, steps=steps, step=step, user_id=user_id, text=text)
+            else:
+                # retry current step
+                text_to_send = step.render_failure(context=render_context(state.context))
+                await self.send_text(text_to_send=text_to_send, user_id=user_id)
+
+    def define_step_foo(self, step):
+        """
+        Определение функции, выполняющей текущий шаг (по ключу 'action' шага сценария)
+        :param step: выполняемый шаг (CompiledStep)
+        :return: нужная функция
+        """
+        return self.step_actions.get(step.action, self._normal_step)
+
+    async def _step0(self, state, steps, step, user_id, text):
+        """
+        Функция (шаг) отвечает за прерывание исполнения сценария
+        """
+        # checking the want to go out
+        confirmation = state.context['confirmation']
+        if not confirmation:
+            state.step_name = state.context['pause_step']
+            next_step = steps[state.step_name]
+            await self.send_step(step=next_step, user_id=user_id, text=text, context=state.context)
+            del state.context['pause_step']
+        else:
+            state.step_name = step.additional_next_step
+            next_step = steps[step.additional_next_step]
+            await self.send_text(text_to_send=next_step.text, user_id=user_id)
+            state.delete()
+
+    async def _step3(self, state, steps, step, user_id, text):
+        """
+        Функция (шаг) отвечает за проверку сообщения между введёнными городами
+        """
+        # checking have route between two cities
+        departure = state.context['departure']
+        appointment = state.context['arrival']
+        if not route_controller(departure=departure, arrival=appointment):
+            # break scenario if have not route, offer connecting flights if there are any
+            next_step = steps[step.additional_next_step]
+            state.step_name = step.additional_next_step
+            text_to_send = next_step.render_text(context=render_context(state.context))
+            await self.send_text(text_to_send=text_to_send, user_id=user_id)
+            state.delete()
+        else:
+            await self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
+
+    async def _step4(self, state, steps, step, user_id, text):
+        """
+        Функция (шаг) отвечает за формирование ближайших пяти рейсов
+        """
+        # formation route
+        departure = state.context['departure']
+        arrival = state.context['arrival']
+        date = state.context['date']
+        with metrics.timer('route_formation'):
+            state.context['flights'] = route_formation(departure=departure, arrival=arrival, date=date)
+        await self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
+
+    async def _step7(self, state, steps, step, user_id, text):
+        """
+        Функция (шаг) отвечает за комментарий пользователя
+        """
+        # checking the want to leave comment
+        confirmation = state.context['confirmation']
+        if confirmation:
+            next_step = steps[step.additional_next_step]
+            state.step_name = step.additional_next_step
+            await self.send_text(text_to_send=next_step.text, user_id=user_id)
+        else:
+            await self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
+
+    async def _step8(self, state, steps, step, user_id, text):
+        """
+        Функция (шаг) отвечает за подтверждение заказа
+        """
+        # checking the want to complete ticket
+        confirmation = state.context['confirmation']
+        if not confirmation:
+            next_step = steps[step.additional_next_step]
+            state.step_name = step.additional_next_step
+            await self.send_text(text_to_send=next_step.text, user_id=user_id)
+            state.delete()
+        else:
+            await self._normal_step(state=state, steps=steps, step=step, user_id=user_id, text=text)
+
+    async def _normal_step(self, state, steps, step, user_id, text):
+        """
+        Функция "Обычный шаг", используется при обычном переходе из одного шага сценария на другой
+        """
+        next_step = steps[step.next_step]
+        await self.send_step(step=next_step, user_id=user_id, text=text, context=state.context)
+        if next_step.next_step:
+            # switch to next step normal
+            state.step_name = step.next_step
+        else:
+            # finish scenario
+            log.info('Оформлен билет:\n%s', LazyMessage(order_summary, state.context))
+
+            # заявка дописывается в спул (запись в файл - в пуле потоков базы), в базу её запишет RegistrationWriter
+            await self.in_db(self.registrations.submit, registration_order(context=state.context))
+            state.delete()
+
+
+if __name__ == '__main__':
+    bot = AsyncBot(group_id=settings.GROUP_ID, group_token=settings.GROUP_TOKEN)
+    asyncio.run(bot.run())
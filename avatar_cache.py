@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Кэш аватарок для билетов
+Аватарка (svg с dicebear, переведённый в png) хранится в двух уровнях:
+- LRU в памяти процесса
+- на диске, файл называется по хэшу email (content-addressed), с ограничением по времени жизни и размеру
+Если сервис аватарок не ответил вовремя или вернул ошибку, рисуется локальная заглушка,
+одинаковая для одного и того же email.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from io import BytesIO
+
+import requests
+from cairosvg import svg2png
+from PIL import Image, ImageDraw
+
+from bot_metrics import metrics
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+PLACEHOLDER_GRID = 5
+PLACEHOLDER_BACKGROUND = (255, 255, 255, 255)
+
+
+def email_key(email):
+    """
+    Ключ аватарки в кэше
+    :param email: email пользователя
+    :return: sha256 email в hex
+    """
+    return hashlib.sha256(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+def placeholder_avatar(email, size):
+    """
+    Локальная заглушка вместо аватарки: симметричный узор 5х5, цвет и узор зависят только от email
+    :param email: email пользователя
+    :param size: размер стороны картинки в пикселях
+    :return: .png в байтах
+    """
+    digest = hashlib.sha256(email.strip().lower().encode('utf-8')).digest()
+    color = (digest[0], digest[1], digest[2], 255)
+    image = Image.new('RGBA', (size, size), PLACEHOLDER_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    cell = size // PLACEHOLDER_GRID
+    half = (PLACEHOLDER_GRID + 1) // 2
+    for row in range(PLACEHOLDER_GRID):
+        for column in range(half):
+            if digest[3 + row * half + column] % 2:
+                for x in (column, PLACEHOLDER_GRID - 1 - column):
+                    draw.rectangle([x * cell, row * cell, (x + 1) * cell - 1, (row + 1) * cell - 1], fill=color)
+    image_file = BytesIO()
+    image.save(image_file, 'png')
+    return image_file.getvalue()
+
+
+class AvatarCache:
+
+    """
+    Двухуровневый кэш аватарок (память + диск) с заглушкой на случай недоступности сервиса
+    """
+
+    def __init__(self, url, cache_dir, ttl=7 * 24 * 3600, max_memory_items=256, max_disk_bytes=50 * 2 ** 20,
+                 timeout=3, size=180):
+        """
+        :param url: адрес сервиса аватарок, к нему добавляется '{email}.svg'
+        :param cache_dir: папка дискового кэша
+        :param ttl: время жизни аватарки в кэше, сек
+        :param max_memory_items: максимальное количество аватарок в памяти
+        :param max_disk_bytes: максимальный размер дискового кэша, байт
+        :param timeout: время ожидания ответа сервиса аватарок, сек
+        :param size: размер заглушки в пикселях
+        """
+        self.url = url
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.timeout = timeout
+        self.size = size
+
+        self._memory = OrderedDict()  # key: (png, время сохранения)
+        self._lock = threading.Lock()
+        self._disk_bytes = None  # размер дискового кэша, считается при первой записи
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'fetched': 0, 'placeholders': 0}
+
+    def get(self, email):
+        """
+        Аватарка пользователя
+        :param email: email пользователя
+        :return: .png в байтах
+        """
+        key = email_key(email=email)
+        now = time.time()
+
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return cached[0]
+
+        avatar = self._read_disk(key=key, now=now)
+        if avatar is not None:
+            self._remember(key=key, avatar=avatar, stored_at=now)
+            with self._lock:
+                self._stats['disk_hits'] += 1
+            return avatar
+
+        try:
+            avatar = self._fetch(email=email)
+        except Exception as exc:
+            log.warning('Аватарка для %s не получена (%s), используется заглушка', email, exc)
+            with self._lock:
+                self._stats['placeholders'] += 1
+            return placeholder_avatar(email=email, size=self.size)
+
+        self._remember(key=key, avatar=avatar, stored_at=now)
+        self._write_disk(key=key, avatar=avatar)
+        with self._lock:
+            self._stats['fetched'] += 1
+        return avatar
+
+    def stats(self):
+        """
+        Статистика кэша
+        :return: dict {memory_hits, disk_hits, fetched, placeholders, memory_items}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_items'] = len(self._memory)
+        return stats
+
+    def _fetch(self, email):
+        """
+        Загрузка svg аватарки и перевод в png (этап метрик 'avatar_fetch')
+        """
+        with metrics.timer('avatar_fetch'):
+            response = requests.get(url=f'{self.url}{email}.svg', timeout=self.timeout)
+            response.raise_for_status()
+            return svg2png(bytestring=response.content, background_color='white')
+
+    def _remember(self, key, avatar, stored_at):
+        """
+        Сохранение аватарки в памяти с вытеснением самой давно использованной
+        """
+        with self._lock:
+            self._memory[key] = (avatar, stored_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.png')
+
+    def _read_disk(self, key, now):
+        """
+        Чтение аватарки с диска, если она ещё не устарела
+        """
+        path = self._path(key=key)
+        try:
+            if now - os.path.getmtime(path) >= self.ttl:
+                return None
+            with open(path, mode='rb') as avatar_file:
+                return avatar_file.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, avatar):
+        """
+        Атомарная запись аватарки на диск (через временный файл) с контролем размера кэша
+        """
+        path = self._path(key=key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(descriptor, mode='wb') as temp_file:
+                temp_file.write(avatar)
+            os.replace(temp_path, path)
+        except OSError:
+            log.exception('Аватарка не сохранена в кэш на диске')
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_bytes += len(avatar)
+            overflow = self._disk_bytes > self.max_disk_bytes
+        if overflow:
+            self._shrink_disk()
+
+    def _disk_files(self):
+        """
+        Файлы дискового кэша
+        :return: list[(путь, размер, время изменения), ...]
+        """
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _shrink_disk(self):
+        """
+        Удаление самых старых аватарок, пока кэш не уменьшится до 3/4 допустимого размера
+        """
+        files = sorted(self._disk_files(), key=lambda disk_file: disk_file[2])
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if total <= self.max_disk_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
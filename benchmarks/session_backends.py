@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Сравнение хранилищ состояний пользователей (session_backends)
+Запуск из основной директории программы: python -m benchmarks.session_backends [--users N] [--steps N]
+Для каждого хранилища имитируется прохождение сценария: загрузка состояния и запись изменённых ключей
+контекста пачками, как это делает SessionCache в режиме 'batch'. Хранилище 'database' проверяется,
+только если указан ключ --database (используется DB_CONFIG из settings.py).
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from session_backends import make_backend
+
+
+CONTEXT = {'name': 'иван', 'departure': 'Москва', 'arrival': 'Лондон', 'date': '05-12-2027',
+           'flights': ['05-12-2027 10:00', '06-12-2027 13:12', '07-12-2027 10:00', '09-12-2027 02:45',
+                       '11-12-2027 18:30']}
+
+
+def run(backend, users, steps, batch):
+    """
+    :return: (загрузок в секунду, записей в секунду)
+    """
+    user_ids = [f'bench-{number}' for number in range(users)]
+    backend.write(writes={user_id: ('full', 'order_ticket', 'step1', {}) for user_id in user_ids})
+
+    started = time.perf_counter()
+    for user_id in user_ids:
+        backend.load(user_id=user_id)
+    loads = users / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for step in range(steps):
+        key = list(CONTEXT)[step % len(CONTEXT)]
+        for first in range(0, users, batch):
+            backend.write(writes={user_id: ('delta', 'order_ticket', f'step{step}', {key: CONTEXT[key]}, [], CONTEXT)
+                                  for user_id in user_ids[first:first + batch]})
+    writes = users * steps / (time.perf_counter() - started)
+
+    backend.write(writes={user_id: None for user_id in user_ids})
+    return loads, writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение хранилищ состояний пользователей')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--database', action='store_true', help='проверить и основную базу данных (DB_CONFIG)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = [('memory', make_backend(kind='memory')),
+                    ('sqlite', make_backend(kind='sqlite', sqlite_path=os.path.join(directory, 'sessions.sqlite')))]
+        if args.database:
+            backends.append(('database', make_backend(kind='database')))
+
+        print(f'{"хранилище":<10}{"загрузок/с":>14}{"записей/с":>14}')
+        for kind, backend in backends:
+            loads, writes = run(backend=backend, users=args.users, steps=args.steps, batch=args.batch)
+            backend.close()
+            print(f'{kind:<10}{loads:>14.0f}{writes:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
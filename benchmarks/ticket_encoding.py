@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Сравнение профилей вывода билета (generate_ticket.OUTPUT_PROFILES)
+Запуск из основной директории программы: python -m benchmarks.ticket_encoding [--repeat N] [--mbps N]
+Билет рисуется один раз (с локальной заглушкой вместо аватарки), затем сохраняется по каждому профилю:
+медианное время кодирования, размер файла и оценка времени загрузки в VK при скорости канала --mbps.
+"""
+
+import argparse
+import statistics
+import time
+
+from io import BytesIO
+
+from PIL import features
+
+from avatar_cache import placeholder_avatar
+from generate_ticket import AVATAR_SIZE, OUTPUT_PROFILES, TicketRenderer, encode
+
+
+TICKET = {'phone': '+79001234567', 'email': 'ivan@mail.ru', 'name': 'Иван Иванов', 'departure': 'Москва',
+          'arrival': 'Лондон', 'date': '05-12-2027 10:00', 'spaces': '2'}
+
+
+class PlaceholderAvatars:
+
+    """
+    Аватарки без обращения к сети
+    """
+
+    def get(self, email):
+        return placeholder_avatar(email=email, size=AVATAR_SIZE)
+
+
+def run(image, profile, repeat):
+    """
+    :return: (медианное время кодирования в мс, размер файла в байтах)
+    """
+    timings = []
+    for _ in range(repeat):
+        output = BytesIO()
+        started = time.perf_counter()
+        encode(image=image, output=output, profile=profile)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), output.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение профилей вывода билета')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--mbps', type=float, default=10.0, help='скорость канала до сервера загрузки, Мбит/с')
+    parser.add_argument('--profiles', nargs='*', default=list(OUTPUT_PROFILES), choices=list(OUTPUT_PROFILES))
+    args = parser.parse_args()
+
+    image = TicketRenderer(avatars=PlaceholderAvatars()).compose(**TICKET)
+
+    print(f'{"профиль":<12}{"кодирование, мс":>18}{"размер, КБ":>14}{"загрузка, мс":>16}')
+    for name in args.profiles:
+        if OUTPUT_PROFILES[name].format == 'webp' and not features.check('webp'):
+            print(f'{name:<12}{"Pillow собран без webp":>48}')
+            continue
+        encode_ms, size = run(image=image, profile=name, repeat=args.repeat)
+        upload_ms = size * 8 / (args.mbps * 10 ** 6) * 1000
+        print(f'{name:<12}{encode_ms:>18.1f}{size / 1024:>14.1f}{upload_ms:>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Логирование без записи на диск в потоке обработки события
+Записи логера кладутся в очередь (QueueHandler), а в файл и консоль их пишет фоновый поток (QueueListener).
+Файл лога ротируется по размеру или по времени, записи можно писать строками JSON с полями события
+(event_id, peer_id, step), которые задаются через log_fields/bind_log_fields для текущего потока или задачи asyncio.
+Дорогие сообщения передаются как LazyMessage: они собираются, только если уровень записи включён.
+Если фоновый поток не успевает, записи сверх max_queue отбрасываются (счётчик LogQueueHandler.dropped).
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+
+LOG_FIELDS = ('event_id', 'peer_id', 'step')
+
+_fields = ContextVar('log_fields', default={})
+
+
+@contextmanager
+def log_fields(**fields):
+    """
+    Поля записей лога внутри блока with (обработка одного события)
+    :param fields: значения из LOG_FIELDS
+    """
+    token = _fields.set(dict(_fields.get(), **fields))
+    try:
+        yield
+    finally:
+        _fields.reset(token)
+
+
+def bind_log_fields(**fields):
+    """
+    Добавление полей записей лога до конца текущего блока log_fields
+    :param fields: значения из LOG_FIELDS
+    :return: None
+    """
+    _fields.set(dict(_fields.get(), **fields))
+
+
+def current_log_fields():
+    """
+    Поля записей лога текущего потока или задачи asyncio
+    :return: dict (изменять нельзя)
+    """
+    return _fields.get()
+
+
+class LazyMessage:
+
+    """
+    Сообщение лога, которое собирается только при записи: log.info('%s', LazyMessage(func, arg))
+    """
+
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+class FieldsFilter(logging.Filter):
+
+    """
+    Добавление полей события (LOG_FIELDS) в запись лога, в потоке, который её создал
+    """
+
+    def filter(self, record):
+        fields = _fields.get()
+        for name in LOG_FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, fields.get(name))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    """
+    Запись лога одной строкой JSON
+    """
+
+    def format(self, record):
+        data = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'message': record.getMessage()}
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+
+    """
+    QueueHandler, который собирает в потоке события только текст сообщения и traceback,
+    а оформление записи (время, JSON) оставляет фоновому потоку
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.listener = None
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogListener(logging.handlers.QueueListener):
+
+    """
+    Фоновый поток записи лога, который можно останавливать повторно (явно и при выходе из программы)
+    """
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def file_handler(filename, rotation='size', max_bytes=10 * 2 ** 20, when='midnight', backup_count=5):
+    """
+    Обработчик записи в файл с ротацией
+    :param filename: файл лога
+    :param rotation: 'size' - по размеру, 'time' - по времени, None - без ротации
+    :param max_bytes: размер файла для ротации по размеру, байт
+    :param when: период ротации по времени (как у TimedRotatingFileHandler: 'midnight', 'H', 'D', ...)
+    :param backup_count: количество старых файлов
+    :return: logging.Handler
+    """
+    if rotation == 'size':
+        return logging.handlers.RotatingFileHandler(filename=filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                    encoding='utf-8', delay=True)
+    if rotation == 'time':
+        return logging.handlers.TimedRotatingFileHandler(filename=filename, when=when, backupCount=backup_count,
+                                                         encoding='utf-8', delay=True)
+    if rotation is None:
+        return logging.FileHandler(filename=filename, encoding='utf-8', delay=True)
+    raise ValueError(f'Неизвестная ротация лога: {rotation}')
+
+
+def start_logging(logger, handlers, max_queue=10000):
+    """
+    Подключение обработчиков к логеру через очередь и фоновый поток записи
+    Повторный вызов для того же логера ничего не меняет. Очередь дописывается в обработчики при выходе из программы.
+    :param logger: logging.Logger object
+    :param handlers: обработчики (файл, консоль), которые вызываются в фоновом потоке
+    :param max_queue: максимальное количество записей в очереди (при переполнении новые записи теряются)
+    :return: LogListener object
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, LogQueueHandler):
+            return handler.listener
+
+    records = queue.Queue(maxsize=max_queue)
+    queue_handler = LogQueueHandler(records=records)
+    queue_handler.addFilter(FieldsFilter())
+    listener = LogListener(records, *handlers, respect_handler_level=True)
+    queue_handler.listener = listener
+    logger.addHandler(hdlr=queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
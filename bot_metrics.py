@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Время этапов обработки сообщений (гистограммы и счётчики ошибок) в формате Prometheus
+Этапы: загрузка состояния пользователя, handler шага, route_formation, рисование билета, загрузка аватарки,
+загрузка фотографии, вызовы VK API (messages.send), запись состояния. Каждое измерение помечено шагом сценария
+(поле step из bot_logging), поэтому видно, на каком шаге и на каком этапе уходит время.
+Пока метрики не включены (enable), timer ничего не измеряет. Процессы пула рисования билетов отправляют
+измерения в очередь (forward_to), а основной процесс забирает их при каждом запросе /metrics.
+Метрики отдаёт MetricsServer: HTTP сервер в одном фоновом потоке.
+"""
+
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from bot_logging import current_log_fields
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+NOT_MEASURED = nullcontext()
+
+
+class _Timer:
+
+    """
+    Измерение одного этапа (with metrics.timer(...))
+    """
+
+    __slots__ = ('metrics', 'stage', 'step', 'started')
+
+    def __init__(self, metrics, stage, step):
+        self.metrics = metrics
+        self.stage = stage
+        self.step = step
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(stage=self.stage, seconds=time.perf_counter() - self.started, step=self.step,
+                             error=exc_type is not None)
+
+
+class Metrics:
+
+    """
+    Гистограммы времени этапов по (этап, шаг) и счётчики ошибок
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: верхние границы корзин гистограммы, сек
+        """
+        self.buckets = tuple(buckets)
+        self.enabled = False
+        self._series = {}  # (этап, шаг): [количество по корзинам..., +Inf], сумма, количество ошибок
+        self._lock = threading.Lock()
+        self._forward = None  # очередь основного процесса (в процессе пула)
+        self._sources = []  # очереди процессов пула (в основном процессе)
+
+    def enable(self):
+        self.enabled = True
+
+    def timer(self, stage, step=None):
+        """
+        Измерение этапа: with metrics.timer('handler'): ...
+        Исключение внутри блока считается ошибкой этапа.
+        :param stage: название этапа ('state_load', 'handler', 'route_formation', ...)
+        :param step: шаг сценария, по умолчанию - поле step текущего события (bot_logging)
+        :return: context manager
+        """
+        if not self.enabled:
+            return NOT_MEASURED
+        return _Timer(metrics=self, stage=stage, step=step)
+
+    def observe(self, stage, seconds, step=None, error=False):
+        """
+        Запись одного измерения
+        :param stage: название этапа
+        :param seconds: длительность, сек
+        :param step: шаг сценария, по умолчанию - поле step текущего события
+        :param error: True - этап завершился ошибкой
+        :return: None
+        """
+        if not self.enabled:
+            return
+        if step is None:
+            step = current_log_fields().get('step') or ''
+        if self._forward is not None:
+            self._forward.put_nowait((stage, step, seconds, error))
+            return
+        self._add(stage=stage, step=step, seconds=seconds, error=error)
+
+    def _add(self, stage, step, seconds, error):
+        with self._lock:
+            series = self._series.get((stage, step))
+            if series is None:
+                series = self._series[(stage, step)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+            series[2] += error
+
+    def process_queue(self):
+        """
+        Очередь для измерений процессов пула (передаётся в forward_to при старте процесса)
+        :return: multiprocessing.Queue, или None, если метрики не включены
+        """
+        if not self.enabled:
+            return None
+        source = multiprocessing.Queue()
+        with self._lock:
+            self._sources.append(source)
+        return source
+
+    def forward_to(self, source):
+        """
+        Отправка измерений этого процесса (процесса пула) в основной процесс
+        :param source: очередь из process_queue, None - метрики в процессе не нужны
+        :return: None
+        """
+        self.enabled = source is not None
+        self._forward = source
+
+    def collect(self):
+        """
+        Перенос измерений из очередей процессов пула
+        :return: None
+        """
+        with self._lock:
+            sources = list(self._sources)
+        for source in sources:
+            while True:
+                try:
+                    stage, step, seconds, error = source.get_nowait()
+                except (queue.Empty, OSError, ValueError):
+                    break
+                self._add(stage=stage, step=step, seconds=seconds, error=error)
+
+    def render(self):
+        """
+        Метрики в текстовом формате Prometheus
+        :return: str
+        """
+        self.collect()
+        with self._lock:
+            series = [(key, list(counts), total, errors) for key, (counts, total, errors) in self._series.items()]
+        series.sort()
+
+        lines = ['# HELP bot_stage_seconds Время этапа обработки сообщения',
+                 '# TYPE bot_stage_seconds histogram']
+        for (stage, step), counts, total, _ in series:
+            labels = f'stage="{_escape(stage)}",step="{_escape(step)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'bot_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'bot_stage_seconds_sum{{{labels}}} {total}')
+            lines.append(f'bot_stage_seconds_count{{{labels}}} {cumulative}')
+        lines.extend(['# HELP bot_stage_errors_total Этапы, завершившиеся ошибкой',
+                      '# TYPE bot_stage_errors_total counter'])
+        for (stage, step), _, _, errors in series:
+            lines.append(f'bot_stage_errors_total{{stage="{_escape(stage)}",step="{_escape(step)}"}} {errors}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+
+    """
+    HTTP сервер метрик (GET /metrics) в фоновом потоке
+    Если port == 0, сервер не запускается.
+    """
+
+    def __init__(self, metrics, host='127.0.0.1', port=0):
+        """
+        :param metrics: Metrics object
+        :param host: адрес сервера
+        :param port: порт сервера (0 - не запускать)
+        """
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        if not self.port or self._server is not None:
+            return
+        self._server = HTTPServer((self.host, self.port), _MetricsHandler)
+        self._server.metrics = self.metrics
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True)
+        self._thread.start()
+        log.info('Метрики: http://%s:%d/metrics', self.host, self._server.server_port)
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+
+
+metrics = Metrics()
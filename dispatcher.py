@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Диспетчер событий
+Распределяет события long poll по пулу рабочих потоков.
+События одного peer_id обрабатываются строго по очереди (шаги сценария зависят от порядка сообщений),
+события разных peer_id и события без peer_id - параллельно.
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+
+def event_peer_id(event):
+    """
+    Получение peer_id из события
+    :param event: VkBotMessageEvent object (или любое другое событие)
+    :return: peer_id, или None, если событие не содержит сообщения
+    """
+    try:
+        return event.object.message['peer_id']
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+def event_id(event):
+    """
+    Получение event_id (идентификатор события Bots Long Poll, есть в новых версиях API)
+    :param event: VkBotMessageEvent object (или любое другое событие)
+    :return: event_id, или None, если его нет
+    """
+    try:
+        return event.raw.get('event_id')
+    except AttributeError:
+        return None
+
+
+class EventDispatcher:
+
+    """
+    Пул рабочих потоков с сохранением порядка событий для каждого peer_id
+
+    Для каждого peer_id ведётся своя очередь событий. В общую очередь готовых к обработке попадает
+    peer_id, а не событие, поэтому один peer_id никогда не обрабатывается двумя потоками одновременно,
+    а медленный пользователь не задерживает остальных.
+    События без peer_id ни с чем не упорядочиваются: каждое получает свою очередь.
+    Ошибки обработки записывает в лог сам handler, диспетчер их не перехватывает.
+    Если workers == 0, события обрабатываются сразу в вызывающем потоке.
+    """
+
+    def __init__(self, handler, workers=4, max_pending=0, stats_interval=0):
+        """
+        :param handler: функция, обрабатывающая одно событие, handler(event) (не должна выбрасывать исключения)
+        :param workers: количество рабочих потоков
+        :param max_pending: максимальное количество необработанных событий (0 - без ограничения),
+                            при превышении submit ждёт освобождения очереди
+        :param stats_interval: период (в секундах) записи статистики в лог (0 - не записывать)
+        """
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.stats_interval = stats_interval
+
+        self._condition = threading.Condition()
+        self._pending = {}  # ключ: deque[событие, ...], пока ключ в очереди или в обработке
+        self._ready = deque()  # ключи, готовые к обработке
+        self._depth = 0  # количество событий в очередях
+        self._stopping = False
+        self._threads = []
+        self._workers_stats = []
+        self._started_at = None
+
+    def start(self):
+        """
+        Запуск рабочих потоков
+        """
+        self._stopping = False
+        self._started_at = time.monotonic()
+        self._workers_stats = [{'processed': 0, 'busy_seconds': 0.0} for _ in range(self.workers)]
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(number,), name=f'dispatcher-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.workers and self.stats_interval:
+            reporter = threading.Thread(target=self._report, name='dispatcher-stats', daemon=True)
+            reporter.start()
+
+    def submit(self, event):
+        """
+        Постановка события в очередь его peer_id
+        :param event: событие long poll
+        :return: None
+        """
+        if not self.workers:
+            self.handler(event)
+            return
+
+        peer_id = event_peer_id(event=event)
+        # ключ очереди - peer_id, у события без peer_id - своя очередь из одного события
+        key = peer_id if peer_id is not None else object()
+        with self._condition:
+            while self.max_pending and self._depth >= self.max_pending and not self._stopping:
+                self._condition.wait()
+            if key in self._pending:
+                # peer_id уже ждёт обработки или обрабатывается - событие встаёт за предыдущими
+                self._pending[key].append(event)
+            else:
+                self._pending[key] = deque([event])
+                self._ready.append(key)
+            self._depth += 1
+            self._condition.notify_all()
+
+    def stop(self):
+        """
+        Остановка диспетчера, уже принятые события обрабатываются до конца
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.workers:
+            log.info('Диспетчер остановлен: %s', self.stats())
+
+    def stats(self):
+        """
+        Статистика работы диспетчера
+        :return: dict {queue_depth: событий в очереди, peers_pending: очередей (peer_id) в ожидании и обработке,
+                       workers: [{processed, busy_seconds, utilisation}, ...]}
+        """
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        with self._condition:
+            workers = []
+            for worker_stats in self._workers_stats:
+                utilisation = worker_stats['busy_seconds'] / uptime if uptime else 0.0
+                workers.append({'processed': worker_stats['processed'],
+                                'busy_seconds': round(worker_stats['busy_seconds'], 3),
+                                'utilisation': round(utilisation, 3)})
+            return {'queue_depth': self._depth,
+                    'peers_pending': len(self._pending),
+                    'workers': workers}
+
+    def _work(self, number):
+        """
+        Цикл рабочего потока
+        :param number: порядковый номер потока
+        """
+        worker_stats = self._workers_stats[number]
+        while True:
+            with self._condition:
+                while not self._ready and not self._stopping:
+                    self._condition.wait()
+                if not self._ready:
+                    # остановка, и очередь пуста
+                    return
+                key = self._ready.popleft()
+                event = self._pending[key].popleft()
+
+            started_at = time.monotonic()
+            try:
+                self.handler(event)
+            finally:
+                # даже если handler всё же выбросил исключение, очередь peer_id не должна остановиться
+                busy_seconds = time.monotonic() - started_at
+                with self._condition:
+                    worker_stats['processed'] += 1
+                    worker_stats['busy_seconds'] += busy_seconds
+                    self._depth -= 1
+                    if self._pending[key]:
+                        self._ready.append(key)
+                    else:
+                        del self._pending[key]
+                    self._condition.notify_all()
+
+    def _report(self):
+        """
+        Периодическая запись статистики в лог
+        """
+        while not self._stopping:
+            time.sleep(self.stats_interval)
+            log.info('Диспетчер: %s', self.stats())
@@ -4,15 +4,23 @@
 Use python3.8
 
 Работа с картинками
+Билет сохраняется по профилю вывода (OUTPUT_PROFILES): формат, параметры кодирования, режим цвета и масштаб.
+Профиль по умолчанию 'png' даёт тот же файл, что и раньше (RGBA PNG в полном размере), остальные
+уменьшают размер загружаемого в VK файла за счёт качества. Сравнение профилей: python -m benchmarks.ticket_encoding
+Строки билета (города, даты, количество мест) повторяются, поэтому каждая строка растеризуется шрифтом один раз:
+готовый слой текста (маска в оттенках серого) хранится в LRU кэше по (строка, шрифт, размер) и накладывается
+на шаблон в позиции *_OFFSET. Результат совпадает с draw.text попиксельно.
 """
 
-import requests
+import threading
 
+from collections import OrderedDict, namedtuple
 from io import BytesIO
 
-from cairosvg import svg2png
 from PIL import Image, ImageDraw, ImageFont
 
+from avatar_cache import AvatarCache
+
 
 TEMPLATE_PATH = 'files/air_ticket_sample.jpg'
 
@@ -29,13 +37,250 @@ ARRIVAL_OFFSET = (245, 445)
 DATE_OFFSET = (15, 510)
 SPACES_OFFSET = (245, 510)
 
+TEXT_LAYER_CACHE_ITEMS = 1024
+
 AVATAR_URL = 'https://avatars.dicebear.com/api/bottts/'
 AVATAR_OFFSET = (260, 215)
+AVATAR_SIZE = 180
+
+AVATAR_CACHE_DIR = 'files/avatars'
+AVATAR_CACHE_TTL = 7 * 24 * 3600  # сек
+AVATAR_CACHE_MEMORY_ITEMS = 256
+AVATAR_CACHE_DISK_BYTES = 50 * 2 ** 20
+AVATAR_TIMEOUT = 3  # сек
+
+# format - формат Pillow, options - параметры Image.save, mode - режим цвета, scale - масштаб (1.0 - без изменений)
+OutputProfile = namedtuple('OutputProfile', ('format', 'options', 'mode', 'scale'))
+
+OUTPUT_PROFILES = {
+    'png': OutputProfile(format='png', options={}, mode='RGBA', scale=1.0),
+    'png-fast': OutputProfile(format='png', options={'compress_level': 1}, mode='RGB', scale=1.0),
+    'png-small': OutputProfile(format='png', options={'compress_level': 9}, mode='RGB', scale=1.0),
+    'jpeg': OutputProfile(format='jpeg', options={'quality': 90}, mode='RGB', scale=1.0),
+    'jpeg-small': OutputProfile(format='jpeg', options={'quality': 80}, mode='RGB', scale=0.75),
+    # VK принимает для фотографий в сообщениях JPG, PNG и GIF, webp - для сравнения и других получателей
+    'webp': OutputProfile(format='webp', options={'quality': 80, 'method': 4}, mode='RGB', scale=1.0),
+}
+OUTPUT_PROFILE = 'png'
+
+
+class TicketRenderer:
+
+    """
+    Рисование билетов с кэшем шаблонов и шрифтов
+
+    Шаблон открывается, декодируется и переводится в RGBA один раз, шрифт разбирается один раз,
+    а каждый билет рисуется на копии уже готового шаблона.
+    Поддерживается несколько шаблонов и размеров шрифта (кэш по пути к файлу и размеру).
+    Слои текста кэшируются по (строка, путь к шрифту, размер), не больше max_text_layers.
+    """
+
+    def __init__(self, avatars, max_text_layers=TEXT_LAYER_CACHE_ITEMS):
+        """
+        :param avatars: AvatarCache object
+        :param max_text_layers: максимальное количество слоёв текста в кэше
+        """
+        self.avatars = avatars
+        self.max_text_layers = max_text_layers
+        self._templates = {}  # путь к шаблону: Image (RGBA)
+        self._fonts = {}  # (путь к шрифту, размер): FreeTypeFont
+        self._text_layers = OrderedDict()  # (строка, путь к шрифту, размер): (Image (L), (dx, dy)) или None
+        self._lock = threading.Lock()
+        self._stats = {'template_hits': 0, 'template_misses': 0, 'font_hits': 0, 'font_misses': 0,
+                       'text_hits': 0, 'text_misses': 0, 'rendered': 0}
+
+    def template(self, path):
+        """
+        Декодированный шаблон билета
+        :param path: путь к файлу шаблона
+        :return: Image object (RGBA), который нельзя изменять - рисовать нужно на копии
+        """
+        with self._lock:
+            template = self._templates.get(path)
+            if template is not None:
+                self._stats['template_hits'] += 1
+                return template
+            self._stats['template_misses'] += 1
+        with Image.open(path) as template_file:
+            template = template_file.convert("RGBA")
+        with self._lock:
+            return self._templates.setdefault(path, template)
+
+    def font(self, path, size):
+        """
+        Разобранный TrueType шрифт
+        :param path: путь к файлу шрифта
+        :param size: размер шрифта
+        :return: FreeTypeFont object
+        """
+        key = (path, size)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._stats['font_hits'] += 1
+                return font
+            self._stats['font_misses'] += 1
+        font = ImageFont.truetype(path, size)
+        with self._lock:
+            return self._fonts.setdefault(key, font)
+
+    def text_layer(self, text, path, size):
+        """
+        Растеризованная строка
+        :param text: строка
+        :param path: путь к шрифту
+        :param size: размер шрифта
+        :return: (Image (L) - маска текста, (dx, dy) - её смещение от точки вывода текста), None для пустой строки
+        """
+        key = (text, path, size)
+        with self._lock:
+            if key in self._text_layers:
+                self._text_layers.move_to_end(key)
+                self._stats['text_hits'] += 1
+                return self._text_layers[key]
+            self._stats['text_misses'] += 1
+
+        font = self.font(path=path, size=size)
+        left, top, right, bottom = font.getbbox(text)
+        layer = None
+        if right > left and bottom > top:
+            mask = Image.new('L', (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+            layer = (mask, (left, top))
+
+        with self._lock:
+            self._text_layers[key] = layer
+            self._text_layers.move_to_end(key)
+            while len(self._text_layers) > self.max_text_layers:
+                self._text_layers.popitem(last=False)
+        return layer
+
+    def draw_text(self, base, offset, text, path, size):
+        """
+        Вывод строки на билет (как draw.text с цветом BLACK)
+        :param base: Image object (RGBA), на котором рисуется билет
+        :param offset: точка вывода текста
+        :param text: строка
+        :param path: путь к шрифту
+        :param size: размер шрифта
+        :return: None
+        """
+        if '\n' in text:
+            # многострочный текст (не встречается в билете) рисуется без кэша
+            ImageDraw.Draw(base).text(offset, text, font=self.font(path=path, size=size), fill=BLACK)
+            return
+        layer = self.text_layer(text=text, path=path, size=size)
+        if layer is None:
+            return
+        mask, (dx, dy) = layer
+        base.paste(BLACK, (offset[0] + dx, offset[1] + dy, offset[0] + dx + mask.width, offset[1] + dy + mask.height),
+                   mask)
+
+    def preload(self, template_paths=None, fonts=None):
+        """
+        Загрузка шаблонов и шрифтов заранее (при старте)
+        :param template_paths: пути к шаблонам, по умолчанию TEMPLATE_PATH
+        :param fonts: список (путь к шрифту, размер), по умолчанию (FONT_PATH, FONT_SIZE)
+        :return: None
+        """
+        for path in template_paths or [TEMPLATE_PATH]:
+            self.template(path=path)
+        for path, size in fonts or [(FONT_PATH, FONT_SIZE)]:
+            self.font(path=path, size=size)
+
+    def cache_stats(self):
+        """
+        Статистика кэша
+        :return: dict {template_hits, template_misses, font_hits, font_misses, text_hits, text_misses, rendered,
+                       templates, fonts, text_layers}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['templates'] = len(self._templates)
+            stats['fonts'] = len(self._fonts)
+            stats['text_layers'] = len(self._text_layers)
+        return stats
+
+    def render(self, phone, email, name, departure, arrival, date, spaces,
+               template_path=None, font_path=None, font_size=None, profile=None):
+        """
+        Создание картинки билета
+        :param phone: телефон пользователя
+        :param email: email пользователя
+        :param name: имя пользователя
+        :param departure: город отправления
+        :param arrival: город назначения
+        :param date: дата вылета
+        :param spaces: количество мест
+        :param template_path: путь к шаблону, по умолчанию TEMPLATE_PATH
+        :param font_path: путь к шрифту, по умолчанию FONT_PATH
+        :param font_size: размер шрифта, по умолчанию FONT_SIZE
+        :param profile: профиль вывода (название из OUTPUT_PROFILES или OutputProfile), по умолчанию OUTPUT_PROFILE
+        :return: картинка в байтах (BytesIO)
+        """
+        base = self.compose(phone=phone, email=email, name=name, departure=departure, arrival=arrival, date=date,
+                            spaces=spaces, template_path=template_path, font_path=font_path, font_size=font_size)
+        temp_file = BytesIO()
+        encode(image=base, output=temp_file, profile=profile)
+        temp_file.seek(0)
+
+        with self._lock:
+            self._stats['rendered'] += 1
+        return temp_file
+
+    def compose(self, phone, email, name, departure, arrival, date, spaces,
+                template_path=None, font_path=None, font_size=None):
+        """
+        Рисование билета (без сохранения в файл), параметры - как у render
+        :return: Image object (RGBA)
+        """
+        base = self.template(path=template_path or TEMPLATE_PATH).copy()
+        font_path = font_path or FONT_PATH
+        font_size = font_size or FONT_SIZE
+
+        for offset, text in ((NAME_OFFSET, name), (PHONE_OFFSET, phone), (EMAIL_OFFSET, email),
+                             (DEPARTURE_OFFSET, departure), (ARRIVAL_OFFSET, arrival), (DATE_OFFSET, date),
+                             (SPACES_OFFSET, spaces)):
+            self.draw_text(base=base, offset=offset, text=text, path=font_path, size=font_size)
+
+        avatar_file_like = BytesIO(self.avatars.get(email=email))
+        avatar = Image.open(avatar_file_like)
+
+        base.paste(avatar, AVATAR_OFFSET)
+        return base
+
+
+def encode(image, output, profile=None):
+    """
+    Сохранение картинки по профилю вывода
+    :param image: Image object
+    :param output: file-like object, в который пишется файл
+    :param profile: название из OUTPUT_PROFILES или OutputProfile, по умолчанию OUTPUT_PROFILE
+    :return: OutputProfile
+    """
+    if not isinstance(profile, OutputProfile):
+        profile = OUTPUT_PROFILES[profile or OUTPUT_PROFILE]
+    if profile.scale != 1.0:
+        image = image.resize((round(image.width * profile.scale), round(image.height * profile.scale)),
+                             Image.LANCZOS)
+    if image.mode != profile.mode:
+        image = image.convert(profile.mode)
+    image.save(output, profile.format, **profile.options)
+    return profile
+
+
+renderer = TicketRenderer(avatars=AvatarCache(url=AVATAR_URL,
+                                               cache_dir=AVATAR_CACHE_DIR,
+                                               ttl=AVATAR_CACHE_TTL,
+                                               max_memory_items=AVATAR_CACHE_MEMORY_ITEMS,
+                                               max_disk_bytes=AVATAR_CACHE_DISK_BYTES,
+                                               timeout=AVATAR_TIMEOUT,
+                                               size=AVATAR_SIZE))
 
 
-def generate_ticket(phone, email, name, departure, arrival, date, spaces):
+def generate_ticket(phone, email, name, departure, arrival, date, spaces, profile=None):
     """
-    Создание картинки билета
+    Создание картинки билета (общим TicketRenderer, шаблон и шрифт загружаются один раз)
     :param phone: телефон пользователя
     :param email: email пользователя
     :param name: имя пользователя
@@ -43,32 +288,11 @@ def generate_ticket(phone, email, name, departure, arrival, date, spaces):
     :param arrival: город назначения
     :param date: дата вылета
     :param spaces: количество мест
-    :return: .png в байтах
+    :param profile: профиль вывода (название из OUTPUT_PROFILES), по умолчанию OUTPUT_PROFILE ('png')
+    :return: картинка в байтах (BytesIO)
     """
-    base = Image.open(TEMPLATE_PATH).convert("RGBA")
-    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
-
-    draw = ImageDraw.Draw(base)
-    draw.text(NAME_OFFSET, name, font=font, fill=BLACK)
-    draw.text(PHONE_OFFSET, phone, font=font, fill=BLACK)
-    draw.text(EMAIL_OFFSET, email, font=font, fill=BLACK)
-    draw.text(DEPARTURE_OFFSET, departure, font=font, fill=BLACK)
-    draw.text(ARRIVAL_OFFSET, arrival, font=font, fill=BLACK)
-    draw.text(DATE_OFFSET, date, font=font, fill=BLACK)
-    draw.text(SPACES_OFFSET, spaces, font=font, fill=BLACK)
-
-    response = requests.get(url=f'{AVATAR_URL}{email}.svg')
-    svg_to_png = svg2png(bytestring=response.content, background_color='white')
-    avatar_file_like = BytesIO(svg_to_png)
-    avatar = Image.open(avatar_file_like)
-
-    base.paste(avatar, AVATAR_OFFSET)
-
-    temp_file = BytesIO()
-    base.save(temp_file, 'png')
-    temp_file.seek(0)
-
-    return temp_file
+    return renderer.render(phone=phone, email=email, name=name, departure=departure,
+                           arrival=arrival, date=date, spaces=spaces, profile=profile)
 
     # base.show()
     # with open('files/example_ticket.png', 'wb') as ff:
@@ -7,7 +7,7 @@ Handler - функция, которая принимает на вход:
 text: текст входящего сообщения
 context: dict (JSON), с информацией о состоянии пользователя в сценарии
 return: bool, True - если шаг пройден, False - если данные введены некорректно
-        handle_generate_ticket - возвращает .png в байтах
+        handle_generate_ticket - возвращает картинку билета в байтах
 """
 
 import re
@@ -15,25 +15,39 @@ import re
 from datetime import datetime
 
 from generate_ticket import generate_ticket
+from settings import TICKET_OUTPUT_PROFILE
 from settings_time_table import ROUTE_TABLE
 
 
-RE_CITIES = {
-    'Амстердам': re.compile(r'\bамстердам.{0,2}\b'),
-    'Берлин': re.compile(r'\bберлин.{0,2}\b'),
-    'Буэнос-Айрес': re.compile(r'\bбуэнос-айрес.{0,2}\b'),
-    'Лондон': re.compile(r'\bлондон.{0,2}\b'),
-    'Лос-Анджелес': re.compile(r'\bлос-анджелес.{0,2}\b'),
-    'Мадрид': re.compile(r'\bмадрид.{0,2}\b'),
-    'Москва': re.compile(r'\bмоскв.{0,2}\b'),
-    'Нью-Йорк': re.compile(r'\bнью-йорк.{0,2}\b'),
-    'Париж': re.compile(r'\bпариж.{0,2}\b'),
-    'Пекин': re.compile(r'\bпекин.{0,2}\b'),
-    'Рим': re.compile(r'\bрим.{0,2}\b'),
-    'Рио-де-Жанейро': re.compile(r'\bрио-де-жанейр.{0,2}\b'),
-    'Санкт-Петербург': re.compile(r'\bсанкт-петербург.{0,2}\b'),
-    'Сидней': re.compile(r'\bсидне.{0,2}\b'),
-    'Токио': re.compile(r'\bтокио.{0,2}\b')
+# основа названия города (без окончания) - в сообщении после неё допускается не больше двух символов
+CITY_STEMS = {
+    'Амстердам': 'амстердам',
+    'Берлин': 'берлин',
+    'Буэнос-Айрес': 'буэнос-айрес',
+    'Лондон': 'лондон',
+    'Лос-Анджелес': 'лос-анджелес',
+    'Мадрид': 'мадрид',
+    'Москва': 'москв',
+    'Нью-Йорк': 'нью-йорк',
+    'Париж': 'париж',
+    'Пекин': 'пекин',
+    'Рим': 'рим',
+    'Рио-де-Жанейро': 'рио-де-жанейр',
+    'Санкт-Петербург': 'санкт-петербург',
+    'Сидней': 'сидне',
+    'Токио': 'токио'
+}
+
+# все города одним выражением, город определяется по названию сработавшей группы (за один проход по тексту)
+CITY_GROUPS = {f'city{number}': city for number, city in enumerate(CITY_STEMS)}
+RE_CITY = re.compile('|'.join(rf'(?P<{group}>\b{re.escape(CITY_STEMS[city])}.{{0,2}}\b)'
+                              for group, city in CITY_GROUPS.items()))
+
+AVAILABLE_CITIES = ''.join(f'{city}\n' for city in ROUTE_TABLE)
+
+# значения, которые подставляются в шаблоны текстов сценария при старте, а не хранятся в контексте
+TEMPLATE_CONSTANTS = {
+    'available_cities': AVAILABLE_CITIES
 }
 
 RE_EXPRESSIONS = {
@@ -58,21 +72,26 @@ def handle_name(text, context):
         return False
 
 
+def find_city(text):
+    """
+    Поиск города в сообщении
+    :param text: текст сообщения (в нижнем регистре)
+    :return: название города, или None, если город не найден
+    """
+    match = RE_CITY.search(text)
+    if match:
+        return CITY_GROUPS[match.lastgroup]
+    return None
+
+
 def handle_departure_city(text, context):
     """
     Обработка сообщения о городе отправеления
     """
-    if 'available_cities' not in context:
-        available_cities = str()
-        for city in ROUTE_TABLE.keys():
-            available_cities += (str(city) + '\n')
-        context['available_cities'] = available_cities
-
-    for city, expression in RE_CITIES.items():
-        match = re.search(expression, text)
-        if match:
-            context['departure'] = city
-            return True
+    city = find_city(text=text)
+    if city:
+        context['departure'] = city
+        return True
     return False
 
 
@@ -80,12 +99,10 @@ def handle_arrival_city(text, context):
     """
     Обработка сообщения о городе назначения
     """
-    for city, expression in RE_CITIES.items():
-        match = re.search(expression, text)
-        if match:
-            context['arrival'] = city
-            del context['available_cities']
-            return True
+    city = find_city(text=text)
+    if city:
+        context['arrival'] = city
+        return True
     return False
 
 
@@ -111,14 +128,11 @@ def handle_flights(text, context):
     """
     match = re.search(RE_EXPRESSIONS['re_five_numbers'], text)
     if match:
-        if match.group() in context['result_flights_dict']:
-            flight_date = context['result_flights_dict'][match.group()]
-            flight_date = datetime.strptime(flight_date, '%d-%m-%Y %H:%M')
-            context['flight_date_to_output'] = flight_date.strftime('Дата вылета - %d-%m-%Y; Время вылета - %H:%M')
-            context['flight_date_to_database'] = flight_date.strftime('%d-%m-%Y %H:%M')
+        number = int(match.group())
+        if number <= len(context['flights']):
+            context['flight'] = context['flights'][number - 1]
             del context['date']
-            del context['result_flights_dict']
-            del context['result_flights_str']
+            del context['flights']
             return True
     return False
 
@@ -181,15 +195,23 @@ def handle_email(text, context):
         return False
 
 
+# поля контекста, от которых зависит картинка handler'а (по ним ищется уже загруженная в VK картинка,
+# см. ticket_attachments); картинки handler'ов, которых здесь нет, не кэшируются
+IMAGE_CACHE_FIELDS = {
+    'handle_generate_ticket': ('phone', 'email', 'name', 'departure', 'arrival', 'flight', 'spaces'),
+}
+
+
 def handle_generate_ticket(text, context):
     """
     Запуск функции рисования билета
-    :return: .png в байтах
+    :return: картинка в байтах (формат - по профилю settings.TICKET_OUTPUT_PROFILE)
     """
     return generate_ticket(phone=context['phone'],
                            email=context['email'],
                            name=context['name'],
                            departure=context['departure'],
                            arrival=context['arrival'],
-                           date=context['flight_date_to_database'],
-                           spaces=context['spaces'])
+                           date=context['flight'],
+                           spaces=context['spaces'],
+                           profile=TICKET_OUTPUT_PROFILE)
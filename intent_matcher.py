@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Поиск интента в сообщении пользователя
+Все токены всех интентов собираются при старте в один автомат Ахо-Корасик,
+поэтому интент находится за один проход по тексту сообщения, независимо от количества интентов и токенов.
+Приоритет как у перебора settings.INTENTS по порядку: побеждает интент, стоящий в списке раньше.
+"""
+
+
+NO_INTENT = -1
+
+
+class IntentMatcher:
+
+    """
+    Автомат Ахо-Корасик по токенам интентов
+    """
+
+    def __init__(self, intents):
+        """
+        :param intents: список интентов (settings.INTENTS), порядок списка - приоритет
+        """
+        self.intents = list(intents)
+
+        # узлы автомата: переходы, ссылка неудачи, лучший (наименьший) номер интента среди токенов,
+        # заканчивающихся в этом узле или в узлах по цепочке ссылок неудачи
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [NO_INTENT]
+
+        for number, intent in enumerate(self.intents):
+            for token in intent['tokens']:
+                self._add_token(token=token.lower(), number=number)
+        self._build_fail_links()
+
+    def _add_token(self, token, number):
+        """
+        Добавление токена в бор
+        """
+        node = 0
+        for char in token:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(NO_INTENT)
+            node = next_node
+        if self._best[node] == NO_INTENT or number < self._best[node]:
+            self._best[node] = number
+
+    def _build_fail_links(self):
+        """
+        Построение ссылок неудачи обходом бора в ширину
+        """
+        queue = list(self._goto[0].values())
+        position = 0
+        while position < len(queue):
+            node = queue[position]
+            position += 1
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                child_fail = self._goto[fail].get(char, 0)
+                self._fail[child] = child_fail if child_fail != child else 0
+                inherited = self._best[self._fail[child]]
+                if inherited != NO_INTENT and (self._best[child] == NO_INTENT or inherited < self._best[child]):
+                    self._best[child] = inherited
+                queue.append(child)
+
+    def match(self, text):
+        """
+        Поиск интента в тексте
+        :param text: текст сообщения пользователя
+        :return: интент (dict из settings.INTENTS), или None, если ни один токен не найден
+        """
+        goto = self._goto
+        fail = self._fail
+        best = self._best
+        found = best[0]  # пустой токен есть в любом тексте
+        node = 0
+        for char in text.lower():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            number = best[node]
+            if number != NO_INTENT and (found == NO_INTENT or number < found):
+                found = number
+                if found == 0:
+                    # интент с наивысшим приоритетом - дальше искать нечего
+                    break
+        return self.intents[found] if found != NO_INTENT else None
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+random_id исходящих сообщений
+VK не отправляет повторно сообщение с тем же random_id, поэтому random_id не случайный, а получается из
+(peer_id, id сообщения пользователя, номер ответа на это сообщение): повтор отправки (retry в send_queue,
+повторная обработка того же события) не приводит к дублю, а ответы на разные сообщения не совпадают
+(random_id - положительный 31-битный хеш, совпадение возможно, но намного реже, чем у randint(0, 2 ** 20)).
+"""
+
+import hashlib
+import threading
+
+from random import getrandbits
+
+
+def random_id(peer_id, message_id, part):
+    """
+    random_id сообщения
+    :param peer_id: получатель
+    :param message_id: сообщение пользователя, на которое отвечает бот (или другой ключ события)
+    :param part: номер ответа на это сообщение
+    :return: положительный int32 (31 бит, не 0)
+    """
+    digest = hashlib.blake2b(f'{peer_id}:{message_id}:{part}'.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, byteorder='big') & 0x7FFFFFFF or 1
+
+
+def event_message_id(event):
+    """
+    id сообщения пользователя из события (уникален внутри беседы с peer_id)
+    :param event: VkBotMessageEvent object
+    :return: conversation_message_id, или id, если его нет
+    """
+    message = event.object.message
+    return message.get('conversation_message_id') or message.get('id')
+
+
+class ReplyIds:
+
+    """
+    random_id ответов: для каждого peer_id - сообщение, на которое бот сейчас отвечает, и номер следующего ответа
+    Сообщения одного peer_id обрабатываются по очереди (диспетчер, блокировки peer_id), поэтому номера ответов
+    при повторной обработке того же сообщения получаются такими же.
+    """
+
+    def __init__(self):
+        self._replies = {}  # peer_id: [id сообщения, номер следующего ответа]
+        self._lock = threading.Lock()
+
+    def begin(self, peer_id, message_id):
+        """
+        Начало ответа на сообщение пользователя
+        """
+        with self._lock:
+            self._replies[peer_id] = [message_id, 0]
+
+    def end(self, peer_id):
+        """
+        Окончание ответа на сообщение пользователя
+        """
+        with self._lock:
+            self._replies.pop(peer_id, None)
+
+    def next(self, peer_id):
+        """
+        random_id следующего ответа
+        :param peer_id: получатель
+        :return: положительный int32 (случайный, если бот не отвечает на сообщение этого пользователя)
+        """
+        with self._lock:
+            reply = self._replies.get(peer_id)
+            if reply is None:
+                return getrandbits(31) or 1
+            message_id, part = reply
+            reply[1] += 1
+        return random_id(peer_id=peer_id, message_id=message_id, part=part)
+
+    def named(self, peer_id, name):
+        """
+        random_id ответа, у которого есть своё имя (например картинка шага, отправляемая позже остальных ответов)
+        Номер следующего ответа не меняется, поэтому отложенный ответ не сдвигает номера остальных.
+        :param peer_id: получатель
+        :param name: имя ответа, например 'image'
+        :return: положительный int32 (случайный, если бот не отвечает на сообщение этого пользователя)
+        """
+        with self._lock:
+            reply = self._replies.get(peer_id)
+            if reply is None:
+                return getrandbits(31) or 1
+            message_id = reply[0]
+        return random_id(peer_id=peer_id, message_id=message_id, part=name)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Перевод таблицы Registration на типизированные колонки
+До появления индексированных запросов дата вылета (date, строка '%d-%m-%Y %H:%M') и количество мест (spaces)
+хранились строками. Скрипт переводит существующие данные и создаёт индексы, запускается один раз при
+остановленном боте: python migrate_registration.py
+- PostgreSQL: типы колонок меняются на месте (ALTER TABLE ... USING)
+- SQLite: старая таблица переименовывается, создаётся новая, данные переносятся одним запросом
+Всё выполняется в одной транзакции и без импорта models (его схема может требовать других переводов, например
+migrate_user_state.py). Если от прерванного запуска предыдущей версии скрипта осталась таблица Registration_old,
+перенос из неё продолжается. Повторный запуск ничего не меняет.
+"""
+
+import os
+import sqlite3
+
+try:
+    import settings
+except ImportError:
+    exit('DO --->>>cp setting.py.default settings.py<<<--- and set group_id and group_token!')
+
+
+POSTGRES_MIGRATION = '''
+    ALTER TABLE "registration"
+        ALTER COLUMN "date" TYPE TIMESTAMP USING to_timestamp("date", 'DD-MM-YYYY HH24:MI')::timestamp,
+        ALTER COLUMN "spaces" TYPE INTEGER USING "spaces"::integer
+'''
+
+INDEXES = (
+    ('idx_registration__date', ('date',)),
+    ('idx_registration__departure_arrival_date', ('departure', 'arrival', 'date')),
+    ('idx_registration__user_email', ('user_email',)),
+)
+
+SQLITE_TABLE = '''
+    CREATE TABLE "Registration" (
+        "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "user_phone" TEXT UNIQUE NOT NULL,
+        "user_email" TEXT NOT NULL,
+        "user_name" TEXT NOT NULL,
+        "departure" TEXT NOT NULL,
+        "arrival" TEXT NOT NULL,
+        "date" DATETIME NOT NULL,
+        "spaces" INTEGER NOT NULL,
+        "comment" TEXT NOT NULL
+    )
+'''
+
+# заявки с уже записанным в новую таблицу телефоном не переносятся; id сохраняется, если он свободен
+# ({id_condition}), иначе выдаётся новый
+SQLITE_COPY = '''
+    INSERT INTO "Registration" ("id", "user_phone", "user_email", "user_name", "departure", "arrival", "date",
+                                "spaces", "comment")
+    SELECT {id_value}, "user_phone", "user_email", "user_name", "departure", "arrival",
+           substr("date", 7, 4) || '-' || substr("date", 4, 2) || '-' || substr("date", 1, 2) || ' '
+           || substr("date", 12, 5) || ':00.000000',
+           CAST("spaces" AS INTEGER), "comment"
+    FROM "Registration_old"
+    WHERE "user_phone" NOT IN (SELECT "user_phone" FROM "Registration")
+      AND {id_condition}
+'''
+SQLITE_COPY_STEPS = (
+    {'id_value': '"id"', 'id_condition': '"id" NOT IN (SELECT "id" FROM "Registration")'},
+    {'id_value': 'NULL', 'id_condition': '1'},
+)
+
+
+def create_indexes(cursor, table):
+    """
+    Создание индексов таблицы заявок (тех же, что создаёт pony по models.Registration)
+    :param cursor: курсор базы данных (sqlite3 или psycopg2)
+    :param table: имя таблицы ('Registration' в SQLite, 'registration' в PostgreSQL)
+    :return: None
+    """
+    for index_name, columns in INDEXES:
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table}" ({column_list})')
+
+
+def migrate_postgres(db_config):
+    """
+    Смена типов колонок date и spaces в PostgreSQL
+    :param db_config: settings.DB_CONFIG
+    :return: bool, True - данные переведены, False - перевод не нужен
+    """
+    import psycopg2
+
+    connection = psycopg2.connect(**{key: value for key, value in db_config.items() if key != 'provider'})
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute("SELECT data_type FROM information_schema.columns "
+                           "WHERE table_name = 'registration' AND column_name = 'date'")
+            row = cursor.fetchone()
+            if row is None or row[0] != 'text':
+                return False
+            cursor.execute(POSTGRES_MIGRATION)
+            create_indexes(cursor=cursor, table='registration')
+    finally:
+        connection.close()
+    return True
+
+
+def migrate_sqlite(filename):
+    """
+    Перевод таблицы Registration в SQLite одной транзакцией: переименование, новая таблица, перенос, индексы
+    :param filename: файл базы данных
+    :return: bool, True - данные переведены, False - перевод не нужен
+    """
+    connection = sqlite3.connect(filename, isolation_level=None)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            tables = {name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            columns = {name: column_type for _, name, column_type, _, _, _
+                       in connection.execute('PRAGMA table_info("Registration")')}
+            if 'Registration_old' in tables:
+                # запуск предыдущей версии скрипта прервался после переименования - перенос продолжается
+                if columns.get('spaces', '').upper() == 'TEXT':
+                    raise RuntimeError('В базе есть и Registration_old, и непереведённая Registration')
+                if not columns:
+                    connection.execute(SQLITE_TABLE)
+            elif columns.get('spaces', '').upper() == 'TEXT':
+                # индексы, которые мог создать новый models на старой таблице, мешают создать их на новой
+                index_names = connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                                 "AND tbl_name = 'Registration' AND name LIKE 'idx_%'").fetchall()
+                for (index_name,) in index_names:
+                    connection.execute(f'DROP INDEX "{index_name}"')
+                connection.execute('ALTER TABLE "Registration" RENAME TO "Registration_old"')
+                connection.execute(SQLITE_TABLE)
+            else:
+                connection.execute('ROLLBACK')
+                return False
+
+            for copy_step in SQLITE_COPY_STEPS:
+                connection.execute(SQLITE_COPY.format(**copy_step))
+            connection.execute('DROP TABLE "Registration_old"')
+            create_indexes(cursor=connection, table='Registration')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    return True
+
+
+def migrate():
+    """
+    Перевод таблицы Registration
+    :return: bool, True - данные переведены, False - перевод не нужен
+    """
+    provider = settings.DB_CONFIG['provider']
+    if provider == 'postgres':
+        return migrate_postgres(db_config=settings.DB_CONFIG)
+
+    if provider == 'sqlite':
+        # относительный путь pony считает от каталога модуля models
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), settings.DB_CONFIG['filename'])
+        return migrate_sqlite(filename=filename)
+
+    raise ValueError(f'Перевод таблицы для {provider} не поддерживается')
+
+
+if __name__ == '__main__':
+    if migrate():
+        print('Таблица Registration переведена на типизированные колонки')
+    else:
+        print('Таблица Registration уже переведена')
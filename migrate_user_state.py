@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Добавление в таблицу UserState колонки last_activity (время последней активности пользователя)
+По колонке (и индексу на ней) SessionSweeper находит брошенные сценарии. Скрипт запускается один раз при
+остановленном боте, до первого импорта models: python migrate_user_state.py
+Существующим состояниям время активности ставится равным времени перевода, чтобы их не удалили сразу.
+Колонка и индекс (тот же, что создаёт pony по models.UserState) добавляются одной транзакцией без импорта models.
+Повторный запуск ничего не меняет.
+"""
+
+import os
+import sqlite3
+
+from datetime import datetime
+
+try:
+    import settings
+except ImportError:
+    exit('DO --->>>cp setting.py.default settings.py<<<--- and set group_id and group_token!')
+
+
+POSTGRES_MIGRATION = 'ALTER TABLE "userstate" ADD COLUMN "last_activity" TIMESTAMP NOT NULL DEFAULT %s'
+# SQLite допускает в ADD COLUMN только постоянное значение по умолчанию
+SQLITE_MIGRATION = 'ALTER TABLE "UserState" ADD COLUMN "last_activity" DATETIME NOT NULL DEFAULT \'{now}\''
+INDEX = 'CREATE INDEX IF NOT EXISTS "idx_userstate__last_activity" ON "{table}" ("last_activity")'
+
+
+def migrate_postgres(db_config, now):
+    """
+    Добавление колонки last_activity в PostgreSQL
+    :param db_config: settings.DB_CONFIG
+    :param now: время перевода (datetime object, UTC)
+    :return: bool, True - колонка добавлена, False - перевод не нужен
+    """
+    import psycopg2
+
+    connection = psycopg2.connect(**{key: value for key, value in db_config.items() if key != 'provider'})
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'userstate'")
+            columns = {name for (name,) in cursor.fetchall()}
+            if not columns or 'last_activity' in columns:
+                return False
+            cursor.execute(POSTGRES_MIGRATION, (now,))
+            cursor.execute(INDEX.format(table='userstate'))
+    finally:
+        connection.close()
+    return True
+
+
+def migrate_sqlite(filename, now):
+    """
+    Добавление колонки last_activity в SQLite
+    :param filename: файл базы данных
+    :param now: время перевода (datetime object, UTC)
+    :return: bool, True - колонка добавлена, False - перевод не нужен
+    """
+    connection = sqlite3.connect(filename)
+    try:
+        with connection:
+            columns = {name for _, name, _, _, _, _ in connection.execute('PRAGMA table_info("UserState")')}
+            if not columns or 'last_activity' in columns:
+                return False
+            connection.execute(SQLITE_MIGRATION.format(now=now.isoformat(sep=' ', timespec='microseconds')))
+            connection.execute(INDEX.format(table='UserState'))
+    finally:
+        connection.close()
+    return True
+
+
+def migrate():
+    """
+    Перевод таблицы UserState
+    :return: bool, True - колонка добавлена, False - перевод не нужен
+    """
+    provider = settings.DB_CONFIG['provider']
+    now = datetime.utcnow()
+    if provider == 'postgres':
+        return migrate_postgres(db_config=settings.DB_CONFIG, now=now)
+    if provider == 'sqlite':
+        # относительный путь pony считает от каталога модуля models
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), settings.DB_CONFIG['filename'])
+        return migrate_sqlite(filename=filename, now=now)
+    raise ValueError(f'Перевод таблицы для {provider} не поддерживается')
+
+
+if __name__ == '__main__':
+    if migrate():
+        print('В таблицу UserState добавлена колонка last_activity')
+    else:
+        print('Таблица UserState уже переведена')
@@ -6,7 +6,9 @@ Use python3.8
 Инициализация таблиц в базе данных
 """
 
-from pony.orm import Database, Required, Json
+from datetime import datetime
+
+from pony.orm import Database, Json, Required, composite_index
 
 from settings import DB_CONFIG
 
@@ -19,25 +21,29 @@ class UserState(db.Entity):
     """
     Состояние пользователя внутри сценариия.
     Если у пользователя нет state - он не находится внутри сценария, если есть - находится
+    Базу без колонки last_activity нужно перевести скриптом migrate_user_state.py
     """
     user_id = Required(str, unique=True)    # уникальный id пользователя
     scenario_name = Required(str)   # сценарий, в котором находится пользователь
     step_name = Required(str)   # шаг, на котором находится пользователь
     context = Required(Json)    # контекст работы с пользователем
+    last_activity = Required(datetime, default=datetime.utcnow, index=True)    # время последней записи (UTC)
 
 
 class Registration(db.Entity):
     """
     Заявки на регистрацию
+    Базу со строковыми date и spaces (до появления индексов) нужно перевести скриптом migrate_registration.py
     """
     user_phone = Required(str, unique=True)
-    user_email = Required(str)
+    user_email = Required(str, index=True)
     user_name = Required(str)
     departure = Required(str)
     arrival = Required(str)
-    date = Required(str)
-    spaces = Required(str)
+    date = Required(datetime, index=True)   # дата и время вылета
+    spaces = Required(int)
     comment = Required(str)
+    composite_index(departure, arrival, date)   # поиск заявок по маршруту и датам
 
 
 db.generate_mapping(create_tables=True)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Загрузка фотографий в сообщения vk
+- одна requests.Session с пулом соединений для всех загрузок
+- адрес сервера загрузки (photos.getMessagesUploadServer) используется повторно, пока он действителен
+  (UploadUrlCache и upload_fields общие с асинхронным ботом)
+- несколько фотографий сохраняются одним вызовом execute
+- тело запроса загрузки (multipart/form-data) читается кусками прямо из буфера картинки, без склейки в новую строку
+  байт; имя файла и тип берутся по содержимому (PNG, JPEG, GIF, WebP - см. generate_ticket.OUTPUT_PROFILES)
+"""
+
+import json
+import logging
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+EXECUTE_MAX_CALLS = 25  # ограничение VK на количество методов в одном execute
+
+# начало файла: (имя файла, тип)
+IMAGE_SIGNATURES = (
+    (b'\x89PNG', ('image.png', 'image/png')),
+    (b'\xff\xd8', ('image.jpg', 'image/jpeg')),
+    (b'GIF8', ('image.gif', 'image/gif')),
+    (b'RIFF', ('image.webp', 'image/webp')),
+)
+
+
+def image_file_type(data):
+    """
+    Имя файла и тип картинки по её содержимому
+    :param data: картинка в байтах (bytes или memoryview)
+    :return: (имя файла, тип), для неизвестного формата - как для PNG
+    """
+    start = bytes(data[:4])
+    for signature, file_type in IMAGE_SIGNATURES:
+        if start.startswith(signature):
+            return file_type
+    return IMAGE_SIGNATURES[0][1]
+
+
+class MultipartBody:
+
+    """
+    Тело запроса multipart/form-data с одним файлом
+    Части (заголовок, картинка, окончание) отдаются срезами при отправке, картинка не копируется.
+    """
+
+    def __init__(self, field, image):
+        """
+        :param field: имя поля формы
+        :param image: картинка (BytesIO или другой file-like object)
+        """
+        data = image.getbuffer() if hasattr(image, 'getbuffer') else memoryview(image.read())
+        filename, file_type = image_file_type(data=data)
+        boundary = uuid.uuid4().hex
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f'Content-Type: {file_type}\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self._parts = [memoryview(head), data, memoryview(tail)]
+        self._length = sum(part.nbytes for part in self._parts)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        """
+        Следующий кусок тела запроса без копирования: срез одной из частей тела
+        Куски разных частей не склеиваются, поэтому кусок может быть короче size.
+        :param size: максимальный размер куска (-1 - вся текущая часть)
+        :return: memoryview (пустой, когда тело прочитано)
+        """
+        if not self._parts or size == 0:
+            return memoryview(b'')
+        part = self._parts[0]
+        chunk = part if size < 0 else part[:size]
+        if chunk.nbytes == part.nbytes:
+            self._parts.pop(0)
+        else:
+            self._parts[0] = part[chunk.nbytes:]
+        return chunk
+
+    def close(self):
+        """
+        Освобождение буфера картинки
+        """
+        for part in self._parts:
+            part.release()
+        self._parts = []
+
+
+class PhotoUploadError(Exception):
+    """
+    Сервер загрузки не принял фотографию
+    """
+
+
+def upload_fields(upload_data):
+    """
+    Поля ответа сервера загрузки для photos.saveMessagesPhoto
+    :param upload_data: ответ сервера загрузки (dict)
+    :return: dict {server, photo, hash}, None - сервер не принял файл
+    """
+    if not upload_data.get('photo') or upload_data['photo'] == '[]':
+        return None
+    return {'server': upload_data['server'],
+            'photo': upload_data['photo'],
+            'hash': upload_data['hash']}
+
+
+class UploadUrlCache:
+
+    """
+    Адрес сервера загрузки, который используется повторно, пока не устарел
+    """
+
+    def __init__(self, ttl):
+        """
+        :param ttl: сколько секунд использовать полученный адрес
+        """
+        self.ttl = ttl
+        self._url = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        :return: действующий адрес или None
+        """
+        with self._lock:
+            if self._url and time.monotonic() < self._expires:
+                return self._url
+        return None
+
+    def put(self, url):
+        with self._lock:
+            self._url = url
+            self._expires = time.monotonic() + self.ttl
+
+
+class PhotoUploader:
+
+    """
+    Загрузчик фотографий для сообщений, возвращает строки вложений вида photo{owner_id}_{media_id}
+    """
+
+    def __init__(self, upload_url_ttl=600, pool_size=10, timeout=30):
+        """
+        :param upload_url_ttl: сколько секунд использовать полученный адрес сервера загрузки
+        :param pool_size: размер пула соединений с сервером загрузки
+        :param timeout: время ожидания ответа сервера загрузки, сек
+        """
+        self.upload_urls = UploadUrlCache(ttl=upload_url_ttl)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def upload_url(self, api, refresh=False):
+        """
+        Адрес сервера загрузки (запрашивается у VK, только если прежний устарел)
+        :param api: VkApiMethod object
+        :param refresh: запросить новый адрес в любом случае
+        :return: upload_url
+        """
+        upload_url = None if refresh else self.upload_urls.get()
+        if upload_url is None:
+            upload_url = api.photos.getMessagesUploadServer()['upload_url']
+            self.upload_urls.put(url=upload_url)
+        return upload_url
+
+    def upload(self, api, images):
+        """
+        Загрузка и сохранение фотографий
+        :param api: VkApiMethod object
+        :param images: список картинок (file-like object в формате .png)
+        :return: list[строка вложения, ...] в том же порядке, что и images
+        """
+        upload_data = [self._post(api=api, image=image) for image in images]
+
+        attachments = []
+        for first in range(0, len(upload_data), EXECUTE_MAX_CALLS):
+            batch = upload_data[first:first + EXECUTE_MAX_CALLS]
+            if len(batch) == 1:
+                saved = [api.photos.saveMessagesPhoto(**batch[0])]
+            else:
+                calls = ','.join(f'API.photos.saveMessagesPhoto({json.dumps(data)})' for data in batch)
+                saved = api.execute(code=f'return [{calls}];')
+            for image_data in saved:
+                attachments.append(f'photo{image_data[0]["owner_id"]}_{image_data[0]["id"]}')
+        return attachments
+
+    def _post(self, api, image):
+        """
+        Отправка одной фотографии на сервер загрузки
+        Если адрес сервера загрузки устарел, он запрашивается заново и загрузка повторяется.
+        :return: dict {server, photo, hash} для photos.saveMessagesPhoto
+        """
+        for refresh in (False, True):
+            upload_url = self.upload_url(api=api, refresh=refresh)
+            image.seek(0)
+            body = MultipartBody(field='photo', image=image)
+            try:
+                response = self.session.post(url=upload_url, data=body, headers={'Content-Type': body.content_type},
+                                             timeout=self.timeout)
+                response.raise_for_status()
+                upload_data = upload_fields(upload_data=response.json())
+                if upload_data is not None:
+                    return upload_data
+            except (requests.RequestException, ValueError):
+                if refresh:
+                    raise
+            finally:
+                body.close()
+            if not refresh:
+                log.info('Сервер загрузки фотографий не принял файл, адрес запрашивается заново')
+        raise PhotoUploadError('Фотография не загружена')
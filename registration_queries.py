@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Поиск заявок на регистрацию (Registration)
+Все запросы идут по индексам таблицы (user_phone, user_email, (departure, arrival, date), date).
+Списки заявок выдаются страницами с ключевой пагинацией (keyset): следующая страница начинается после
+последней заявки предыдущей, а не через OFFSET, поэтому любая страница читается одинаково быстро.
+"""
+
+from collections import namedtuple
+
+from pony.orm import db_session, select
+
+from models import Registration
+
+
+PAGE_SIZE = 50
+
+# items - заявки страницы (list[dict]), next_cursor - курсор следующей страницы или None, если страница последняя
+Page = namedtuple('Page', ('items', 'next_cursor'))
+
+
+def make_page(registrations, limit, cursor_key):
+    """
+    Страница из выборки limit + 1 заявок (лишняя заявка показывает, что страница не последняя)
+    :param registrations: list[Registration object, ...]
+    :param limit: размер страницы
+    :param cursor_key: функция, возвращающая курсор по заявке
+    :return: Page
+    """
+    items = [registration.to_dict() for registration in registrations[:limit]]
+    next_cursor = cursor_key(registrations[limit - 1]) if len(registrations) > limit else None
+    return Page(items=items, next_cursor=next_cursor)
+
+
+@db_session
+def find_by_phone(phone):
+    """
+    Заявка по номеру телефона
+    :param phone: номер телефона
+    :return: dict, или None, если заявки нет
+    """
+    registration = Registration.get(user_phone=phone)
+    return registration.to_dict() if registration is not None else None
+
+
+@db_session
+def find_by_email(email, after=None, limit=PAGE_SIZE):
+    """
+    Заявки по email, по порядку оформления
+    :param email: email
+    :param after: курсор (next_cursor предыдущей страницы)
+    :param limit: размер страницы
+    :return: Page
+    """
+    query = select(registration for registration in Registration if registration.user_email == email)
+    if after is not None:
+        query = query.where(lambda registration: registration.id > after)
+    registrations = query.order_by(Registration.id)[:limit + 1]
+    return make_page(registrations=registrations, limit=limit, cursor_key=lambda registration: registration.id)
+
+
+@db_session
+def find_by_route(departure, arrival, date_from=None, date_to=None, after=None, limit=PAGE_SIZE):
+    """
+    Заявки по маршруту, по дате вылета
+    :param departure: город отправления
+    :param arrival: город назначения
+    :param date_from: вылет не раньше (datetime object)
+    :param date_to: вылет раньше (datetime object)
+    :param after: курсор (next_cursor предыдущей страницы)
+    :param limit: размер страницы
+    :return: Page
+    """
+    query = select(registration for registration in Registration
+                   if registration.departure == departure and registration.arrival == arrival)
+    return _dates_page(query=query, date_from=date_from, date_to=date_to, after=after, limit=limit)
+
+
+@db_session
+def find_by_dates(date_from, date_to, after=None, limit=PAGE_SIZE):
+    """
+    Заявки с вылетом в промежутке [date_from, date_to), по дате вылета
+    :param date_from: datetime object
+    :param date_to: datetime object
+    :param after: курсор (next_cursor предыдущей страницы)
+    :param limit: размер страницы
+    :return: Page
+    """
+    query = select(registration for registration in Registration)
+    return _dates_page(query=query, date_from=date_from, date_to=date_to, after=after, limit=limit)
+
+
+def _dates_page(query, date_from, date_to, after, limit):
+    """
+    Страница заявок, упорядоченных по (date, id)
+    :param after: курсор - (date, id) последней заявки предыдущей страницы
+    :return: Page
+    """
+    if date_from is not None:
+        query = query.where(lambda registration: registration.date >= date_from)
+    if date_to is not None:
+        query = query.where(lambda registration: registration.date < date_to)
+    if after is not None:
+        after_date, after_id = after
+        query = query.where(lambda registration: registration.date > after_date
+                            or (registration.date == after_date and registration.id > after_id))
+    registrations = query.order_by(Registration.date, Registration.id)[:limit + 1]
+    return make_page(registrations=registrations, limit=limit,
+                     cursor_key=lambda registration: (registration.date, registration.id))
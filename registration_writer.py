@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Групповая запись заявок на регистрацию (Registration)
+- законченная заявка дописывается в локальный файл-спул и ставится в очередь, оформление заказа не ждёт базу
+- фоновый поток записывает очередь в базу пачками, одной транзакцией на пачку,
+  раз в flush_interval секунд или при накоплении flush_batch заявок
+- после записи пачки спул переписывается без неё; при запуске незаписанные заявки из спула возвращаются в очередь,
+  поэтому при падении процесса заявки не теряются
+- заявки с уже зарегистрированным телефоном (уникальное поле user_phone) не записываются и считаются конфликтами
+- заявка проверяется при постановке в очередь (и при восстановлении из спула): заявка, которую нельзя записать
+  (нет поля, дата или количество мест в неверном формате), дописывается в файл отклонённых заявок
+  (spool_path + '.rejected') и не попадает в пачку, поэтому не останавливает запись следующих заявок
+"""
+
+import json
+import logging
+import os
+import threading
+
+from datetime import datetime
+
+from pony.orm import db_session, select
+
+from models import Registration
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+REGISTRATION_FIELDS = ('user_phone', 'user_email', 'user_name', 'departure', 'arrival', 'date', 'spaces', 'comment')
+DATE_FORMAT = '%d-%m-%Y %H:%M'  # формат даты вылета в заявке (и в спуле)
+
+
+def registration_order(context):
+    """
+    Заявка на регистрацию из контекста пользователя, закончившего сценарий
+    :param context: контекст пользователя
+    :return: dict {поле Registration: значение}
+    """
+    return {'user_phone': context['phone'],
+            'user_email': context['email'],
+            'user_name': context['name'],
+            'departure': context['departure'],
+            'arrival': context['arrival'],
+            'date': context['flight'],
+            'spaces': context['spaces'],
+            'comment': context['comment']}
+
+
+def order_columns(order):
+    """
+    Значения полей Registration для заявки
+    :param order: dict {поле Registration: значение}, см. registration_order
+    :return: dict {поле Registration: значение в типе поля}
+    :raise ValueError: в заявке нет поля или дата / количество мест в неверном формате
+    """
+    try:
+        columns = {field: order[field] for field in REGISTRATION_FIELDS}
+        columns['date'] = datetime.strptime(order['date'], DATE_FORMAT)
+        columns['spaces'] = int(order['spaces'])
+    except (KeyError, TypeError, ValueError) as exc:
+        raise ValueError(f'Заявку нельзя записать: {exc!r}') from exc
+    return columns
+
+
+class RegistrationWriter:
+
+    """
+    Очередь заявок на регистрацию со спулом на диске и групповой записью в базу
+    """
+
+    def __init__(self, spool_path, flush_interval=1.0, flush_batch=100):
+        """
+        :param spool_path: путь к файлу-спулу (заявки, ещё не записанные в базу)
+        :param flush_interval: период записи пачки, сек
+        :param flush_batch: количество заявок, при котором пачка записывается не дожидаясь периода
+        """
+        self.spool_path = spool_path
+        self.rejected_path = f'{spool_path}.rejected'
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        self._pending = []  # заявки в порядке поступления
+        self._spool = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+        self._stats = {'queued': 0, 'recovered': 0, 'written': 0, 'conflicts': 0, 'rejected': 0, 'flushes': 0}
+
+    def start(self):
+        """
+        Возврат в очередь заявок из спула и запуск фоновой записи
+        """
+        with self._condition:
+            if self._spool is None:
+                self._pending.extend(order for order in self._read_spool() if self._accept(order=order))
+                self._stats['recovered'] += len(self._pending)
+                if self._pending:
+                    log.info('Из спула восстановлено заявок: %d', len(self._pending))
+                self._spool = open(self.spool_path, 'a', encoding='utf-8')
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._flush_loop, name='registration-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Остановка фоновой записи и запись всех заявок из очереди
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._condition:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+
+    def submit(self, order):
+        """
+        Постановка заявки в очередь (заявка сразу дописывается в спул)
+        :param order: dict {поле Registration: значение}, см. registration_order
+        :return: None
+        """
+        if not self._accept(order=order):
+            return
+        line = json.dumps(order, ensure_ascii=False)
+        with self._condition:
+            if self._spool is None:
+                self._spool = open(self.spool_path, 'a', encoding='utf-8')
+            self._spool.write(line + '\n')
+            self._spool.flush()
+            self._pending.append(order)
+            self._stats['queued'] += 1
+            pending_count = len(self._pending)
+            self._condition.notify_all()
+
+        if self._thread is None and pending_count >= self.flush_batch:
+            # фоновая запись не запущена - пачка записывается сразу
+            self.flush()
+
+    def flush(self):
+        """
+        Запись заявок из очереди в базу одной транзакцией
+        :return: количество записанных заявок
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch = list(self._pending)
+                if batch and self._spool is not None:
+                    os.fsync(self._spool.fileno())
+            if not batch:
+                return 0
+
+            written, conflicts = self._write(orders=batch)
+
+            with self._condition:
+                del self._pending[:len(batch)]
+                self._rewrite_spool()
+                self._stats['flushes'] += 1
+                self._stats['written'] += written
+                self._stats['conflicts'] += conflicts
+            if conflicts:
+                log.warning('Заявки с уже зарегистрированным телефоном не записаны: %d', conflicts)
+            return written
+
+    def stats(self):
+        """
+        Статистика записи
+        :return: dict {queued, recovered, written, conflicts, rejected, flushes, pending}
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+    @staticmethod
+    @db_session
+    def _write(orders):
+        """
+        Запись пачки заявок в таблицу Registration
+        :param orders: list[dict {поле Registration: значение}, ...]
+        :return: (количество записанных заявок, количество конфликтов по user_phone)
+        """
+        phones = {order['user_phone'] for order in orders}
+        taken = set(select(registration.user_phone for registration in Registration
+                           if registration.user_phone in phones))
+        written = 0
+        for order in orders:
+            if order['user_phone'] in taken:
+                continue
+            Registration(**order_columns(order=order))
+            taken.add(order['user_phone'])
+            written += 1
+        return written, len(orders) - written
+
+    def _accept(self, order):
+        """
+        Проверка заявки перед постановкой в очередь
+        Заявка, которую нельзя записать, дописывается в файл отклонённых заявок.
+        :param order: dict {поле Registration: значение}
+        :return: True - заявку можно записать
+        """
+        try:
+            order_columns(order=order)
+            return True
+        except ValueError as exc:
+            log.error('%s, заявка отложена в %s: %r', exc, self.rejected_path, order)
+        with self._condition:
+            with open(self.rejected_path, 'a', encoding='utf-8') as rejected:
+                rejected.write(json.dumps(order, ensure_ascii=False, default=str) + '\n')
+            self._stats['rejected'] += 1
+        return False
+
+    def _read_spool(self):
+        """
+        Чтение заявок из спула (недописанная при падении последняя строка пропускается)
+        :return: list[dict, ...]
+        """
+        if not os.path.exists(self.spool_path):
+            return []
+        orders = []
+        with open(self.spool_path, encoding='utf-8') as spool:
+            for line in spool:
+                try:
+                    orders.append(json.loads(line))
+                except ValueError:
+                    log.warning('Повреждённая строка в спуле заявок пропущена: %r', line)
+        return orders
+
+    def _rewrite_spool(self):
+        """
+        Замена спула на заявки, оставшиеся в очереди (вызывается под блокировкой)
+        """
+        if self._spool is not None:
+            self._spool.close()
+        temp_path = f'{self.spool_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as spool:
+            for order in self._pending:
+                spool.write(json.dumps(order, ensure_ascii=False) + '\n')
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.replace(temp_path, self.spool_path)
+        self._spool = open(self.spool_path, 'a', encoding='utf-8')
+
+    def _flush_loop(self):
+        """
+        Цикл фоновой записи
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping or len(self._pending) >= self.flush_batch,
+                                         timeout=self.flush_interval)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                log.exception('ОШИБКА ПРИ ЗАПИСИ ЗАЯВОК НА РЕГИСТРАЦИЮ')
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Граф маршрутов
+Таблица маршрутов компилируется один раз при старте:
+- каждый город получает целочисленный id
+- соседи города хранятся битовой маской (int), проверка прямого рейса - один сдвиг и одна операция and
+- кратчайшие маршруты с пересадками находятся обходом в ширину из города отправления по битовым маскам
+  (не глубже max_stops пересадок) и хранятся массивом предков (array на город отправления),
+  поэтому маршрут с пересадками восстанавливается за количество пересадок
+Для всех городов сразу массивы строит precompute() (при старте), для большой сети их можно строить
+при первом запросе из города - обход одного города занимает доли миллисекунды.
+"""
+
+from array import array
+
+
+NO_CITY = -1
+
+
+def iter_bits(mask):
+    """
+    Номера установленных битов маски
+    :param mask: int
+    :return: генератор номеров битов
+    """
+    while mask:
+        low_bit = mask & -mask
+        yield low_bit.bit_length() - 1
+        mask ^= low_bit
+
+
+class RouteGraph:
+
+    """
+    Граф прямых рейсов между городами с заранее найденными маршрутами с пересадками
+    """
+
+    def __init__(self, route_table, max_stops=2):
+        """
+        :param route_table: таблица маршрутов {город отправления: [город назначения, ...]}
+        :param max_stops: максимальное количество пересадок в маршруте
+        """
+        self.max_stops = max_stops
+        cities = set(route_table)
+        for arrivals in route_table.values():
+            cities.update(arrivals)
+        self.cities = sorted(cities)
+        self.city_ids = {city: city_id for city_id, city in enumerate(self.cities)}
+
+        self.adjacency = [0] * len(self.cities)  # city_id: битовая маска городов, куда есть прямой рейс
+        for departure, arrivals in route_table.items():
+            departure_id = self.city_ids[departure]
+            for arrival in arrivals:
+                self.adjacency[departure_id] |= 1 << self.city_ids[arrival]
+
+        self.parents = [None] * len(self.cities)  # city_id: array предков или None, если ещё не построен
+
+    def precompute(self):
+        """
+        Поиск маршрутов с пересадками из всех городов заранее
+        """
+        for city_id in range(len(self.cities)):
+            self._city_parents(city_id=city_id)
+
+    def has_route(self, departure, arrival):
+        """
+        Есть ли прямой рейс
+        :param departure: город отправления
+        :param arrival: город назначения
+        :return: bool, для неизвестных городов - False
+        """
+        departure_id = self.city_ids.get(departure)
+        arrival_id = self.city_ids.get(arrival)
+        if departure_id is None or arrival_id is None:
+            return False
+        return bool(self.adjacency[departure_id] >> arrival_id & 1)
+
+    def itinerary(self, departure, arrival):
+        """
+        Кратчайший маршрут с пересадками (не больше max_stops пересадок)
+        :param departure: город отправления
+        :param arrival: город назначения
+        :return: list[город отправления, город пересадки, ..., город назначения], или None, если маршрута нет
+        """
+        departure_id = self.city_ids.get(departure)
+        arrival_id = self.city_ids.get(arrival)
+        if departure_id is None or arrival_id is None or departure_id == arrival_id:
+            return None
+
+        parents = self._city_parents(city_id=departure_id)
+        path = [arrival_id]
+        while path[-1] != departure_id:
+            parent = parents[path[-1]]
+            if parent == NO_CITY:
+                return None
+            path.append(parent)
+        return [self.cities[city_id] for city_id in reversed(path)]
+
+    def _city_parents(self, city_id):
+        """
+        Массив предков для города отправления (строится при первом обращении)
+        """
+        parents = self.parents[city_id]
+        if parents is None:
+            parents = self.parents[city_id] = self._shortest_paths(source=city_id)
+        return parents
+
+    def _shortest_paths(self, source):
+        """
+        Обход в ширину из города по битовым маскам, глубина обхода ограничена max_stops + 1 перелётами
+        :param source: id города отправления
+        :return: array предков {id города: id предыдущего города маршрута или NO_CITY}
+        """
+        parents = array('i', [NO_CITY]) * len(self.cities)
+        unvisited = ((1 << len(self.cities)) - 1) & ~(1 << source)
+        frontier = [source]
+        for _ in range(self.max_stops + 1):
+            if not frontier or not unvisited:
+                break
+            next_frontier = []
+            for city_id in frontier:
+                reached = self.adjacency[city_id] & unvisited
+                if not reached:
+                    continue
+                unvisited &= ~reached
+                for reached_id in iter_bits(reached):
+                    parents[reached_id] = city_id
+                    next_frontier.append(reached_id)
+            frontier = next_frontier
+        return parents
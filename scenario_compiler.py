@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Компиляция сценариев из settings.SCENARIOS в неизменяемую таблицу переходов
+Выполняется один раз при старте бота:
+- handler'ы шагов находятся в модуле handlers заранее
+- шаблоны текстов разбираются заранее (известно, какие поля контекста в них подставляются),
+  постоянные значения (например список доступных городов) подставляются в шаблоны сразу
+- проверяется, что все next_step / additional_next_step / first_step / pause_step существуют
+- ветвление шага задаётся в самом сценарии ключом 'action', а не названием шага: шаг с additional_next_step
+  без 'action' и сценарий без ключа 'pause_step' (так выглядит settings.py от старой версии бота) - ошибка
+Ошибка в сценарии останавливает запуск бота (ScenarioConfigError).
+missing_settings находит настройки из settings.py.default, которых нет в settings.py.
+"""
+
+import ast
+import os
+
+from collections import namedtuple
+from string import Formatter
+from types import MappingProxyType
+
+
+STEP_FIELDS = ('name', 'text', 'failure_text', 'image', 'handler', 'image_handler', 'next_step',
+               'additional_next_step', 'action', 'text_fields', 'failure_fields')
+
+
+class ScenarioConfigError(Exception):
+    """
+    Ошибка в описании сценария
+    """
+
+
+class CompiledStep(namedtuple('CompiledStep', STEP_FIELDS)):
+
+    """
+    Шаг сценария после компиляции
+    handler и image_handler - уже найденные функции, text_fields и failure_fields - поля шаблонов
+    """
+
+    __slots__ = ()
+
+    def render_text(self, context):
+        """
+        Текст шага с подставленными значениями из контекста
+        """
+        return self.text.format_map(context) if self.text_fields else self.text
+
+    def render_failure(self, context):
+        """
+        Уточняющее сообщение шага с подставленными значениями из контекста
+        """
+        return self.failure_text.format_map(context) if self.failure_fields else self.failure_text
+
+
+CompiledScenario = namedtuple('CompiledScenario', ('name', 'first_step', 'pause_step', 'steps'))
+
+
+def template_fields(template, where):
+    """
+    Разбор шаблона str.format
+    :param template: шаблон (или None)
+    :param where: описание места шаблона для сообщения об ошибке
+    :return: frozenset названий полей
+    """
+    if template is None:
+        return frozenset()
+    try:
+        return frozenset(field for _, field, _, _ in Formatter().parse(template) if field is not None)
+    except ValueError as exc:
+        raise ScenarioConfigError(f'{where}: некорректный шаблон ({exc})')
+
+
+def bind_constants(template, constants, where):
+    """
+    Подстановка постоянных значений в шаблон str.format, остальные поля остаются для подстановки из контекста
+    :param template: шаблон (или None)
+    :param constants: dict {поле: значение}
+    :param where: описание места шаблона для сообщения об ошибке
+    :return: шаблон без постоянных полей
+    """
+    if template is None or not constants:
+        return template
+    parts = []
+    try:
+        for literal, field, format_spec, conversion in Formatter().parse(template):
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            field_template = '{' + field + (f'!{conversion}' if conversion else '') \
+                             + (f':{format_spec}' if format_spec else '') + '}'
+            if field in constants:
+                parts.append(field_template.format(**constants).replace('{', '{{').replace('}', '}}'))
+            else:
+                parts.append(field_template)
+    except ValueError as exc:
+        raise ScenarioConfigError(f'{where}: некорректный шаблон ({exc})')
+    return ''.join(parts)
+
+
+def resolve_handler(handlers_module, handler_name, where):
+    """
+    Поиск handler'а в модуле handlers
+    :return: функция или None, если handler не указан
+    """
+    if handler_name is None:
+        return None
+    handler = getattr(handlers_module, handler_name, None)
+    if not callable(handler):
+        raise ScenarioConfigError(f'{where}: handler {handler_name} не найден')
+    return handler
+
+
+def missing_settings(settings_module, default_path=None):
+    """
+    Настройки из settings.py.default, которых нет в settings.py
+    :param settings_module: модуль settings
+    :param default_path: путь к settings.py.default, по умолчанию - рядом с этим модулем
+    :return: список названий (пустой, если всё есть или settings.py.default не найден)
+    """
+    if default_path is None:
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.py.default')
+    try:
+        with open(default_path, encoding='utf-8') as default_file:
+            tree = ast.parse(default_file.read(), filename=default_path)
+    except FileNotFoundError:
+        return []
+    names = [target.id for node in tree.body if isinstance(node, ast.Assign)
+             for target in node.targets if isinstance(target, ast.Name)]
+    return [name for name in names if not hasattr(settings_module, name)]
+
+
+def compile_scenario(scenario_name, scenario, handlers_module, actions, constants=None):
+    """
+    Компиляция одного сценария
+    :param scenario_name: название сценария
+    :param scenario: описание сценария из settings.SCENARIOS
+    :param handlers_module: модуль с handler'ами
+    :param actions: допустимые значения ключа 'action' шагов
+    :param constants: постоянные значения для подстановки в шаблоны текстов
+    :return: CompiledScenario
+    """
+    if 'pause_step' not in scenario:
+        raise ScenarioConfigError(f"Сценарий {scenario_name}: нет ключа 'pause_step' "
+                                  f"(None - /ticket не прерывает сценарий)")
+    raw_steps = scenario['steps']
+    steps = {}
+    for step_name, step in raw_steps.items():
+        where = f'Сценарий {scenario_name}, шаг {step_name}'
+        for key in ('next_step', 'additional_next_step'):
+            if step.get(key) is not None and step[key] not in raw_steps:
+                raise ScenarioConfigError(f'{where}: {key} {step[key]} не существует')
+        action = step.get('action')
+        if action is not None and action not in actions:
+            raise ScenarioConfigError(f'{where}: неизвестное действие {action}')
+        if step.get('additional_next_step') is not None and action is None:
+            raise ScenarioConfigError(f"{where}: у шага с additional_next_step нет 'action' "
+                                      f"(settings.py устарел, сравните его с settings.py.default)")
+        if step.get('handler') is not None and step.get('next_step') is None \
+                and step.get('additional_next_step') is None:
+            raise ScenarioConfigError(f'{where}: у шага с handler нет следующего шага')
+
+        text = bind_constants(template=step.get('text'), constants=constants, where=where)
+        failure_text = bind_constants(template=step.get('failure_text'), constants=constants, where=where)
+        text_fields = template_fields(text, where)
+        failure_fields = template_fields(failure_text, where)
+        steps[step_name] = CompiledStep(name=step_name,
+                                        # шаблон без полей хранится готовым текстом
+                                        text=text if text_fields or text is None else text.format(),
+                                        failure_text=failure_text if failure_fields or failure_text is None
+                                        else failure_text.format(),
+                                        image=step.get('image'),
+                                        handler=resolve_handler(handlers_module, step.get('handler'), where),
+                                        image_handler=resolve_handler(handlers_module, step.get('image'), where),
+                                        next_step=step.get('next_step'),
+                                        additional_next_step=step.get('additional_next_step'),
+                                        action=action,
+                                        text_fields=text_fields,
+                                        failure_fields=failure_fields)
+
+    for key in ('first_step', 'pause_step'):
+        if scenario.get(key) is not None and scenario[key] not in steps:
+            raise ScenarioConfigError(f'Сценарий {scenario_name}: {key} {scenario[key]} не существует')
+
+    return CompiledScenario(name=scenario_name,
+                            first_step=scenario['first_step'],
+                            pause_step=scenario.get('pause_step'),
+                            steps=MappingProxyType(steps))
+
+
+def compile_scenarios(scenarios, handlers_module, actions, constants=None):
+    """
+    Компиляция всех сценариев
+    :param scenarios: settings.SCENARIOS
+    :param handlers_module: модуль с handler'ами
+    :param actions: допустимые значения ключа 'action' шагов
+    :param constants: постоянные значения для подстановки в шаблоны текстов
+    :return: неизменяемый dict {название сценария: CompiledScenario}
+    """
+    return MappingProxyType({scenario_name: compile_scenario(scenario_name=scenario_name,
+                                                             scenario=scenario,
+                                                             handlers_module=handlers_module,
+                                                             actions=actions,
+                                                             constants=constants)
+                             for scenario_name, scenario in scenarios.items()})
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Контекст сценария
+В контексте (и в базе данных) хранятся только ответы пользователя и данные для работы:
+- flights - даты вылета предложенных рейсов, list[str('%d-%m-%Y %H:%M'), ...]
+- flight - дата вылета выбранного рейса, str('%d-%m-%Y %H:%M')
+Тексты для вывода в чат (список рейсов, дата вылета для билета, маршрут с пересадками) получаются из них
+при подстановке в шаблоны сообщений (render_context).
+"""
+
+from datetime import datetime
+
+from air_traffic_controller import route_connection
+
+
+FLIGHT_FORMAT = '%d-%m-%Y %H:%M'
+
+
+def flights_to_output(context):
+    """
+    Список предложенных рейсов строкой, для вывода в чат
+    """
+    return ''.join(datetime.strptime(flight, FLIGHT_FORMAT).strftime(f'{number}:\t'
+                                                                     f'Дата вылета - %d-%m-%Y; Время вылета - %H:%M\n')
+                   for number, flight in enumerate(context['flights'], start=1))
+
+
+def flight_to_output(context):
+    """
+    Дата и время вылета выбранного рейса, для вывода в чат
+    """
+    return datetime.strptime(context['flight'], FLIGHT_FORMAT).strftime('Дата вылета - %d-%m-%Y; Время вылета - %H:%M')
+
+
+def connection_to_output(context):
+    """
+    Маршрут с пересадками, для вывода в чат
+    """
+    return route_connection(departure=context['departure'], arrival=context['arrival'])
+
+
+# поле шаблона: функция, получающая его значение из контекста
+DERIVED_FIELDS = {
+    'result_flights_str': flights_to_output,
+    'flight_date_to_output': flight_to_output,
+    'route_connection': connection_to_output,
+}
+
+# ключи контекста прежних версий бота: ключ, который их заменил
+LEGACY_KEYS = {
+    'result_flights_dict': 'flights',
+    'flight_date_to_database': 'flight',
+}
+# отображаемые строки, которые прежние версии бота хранили в контексте
+LEGACY_DISPLAY_KEYS = ('available_cities',) + tuple(DERIVED_FIELDS)
+
+
+class RenderContext(dict):
+
+    """
+    Контекст для подстановки в шаблоны (str.format_map), вычисляет отображаемые поля при первом обращении
+    """
+
+    def __missing__(self, key):
+        derive = DERIVED_FIELDS.get(key)
+        if derive is None:
+            raise KeyError(key)
+        value = self[key] = derive(self)
+        return value
+
+
+def render_context(context):
+    """
+    :param context: контекст пользователя
+    :return: RenderContext (копия контекста, изменения в нём не попадают в контекст пользователя)
+    """
+    return RenderContext(context)
+
+
+def upgrade_context(context):
+    """
+    Перевод контекста, сохранённого прежней версией бота (с отображаемыми строками), в компактный вид
+    :param context: контекст пользователя (изменяется на месте)
+    :return: None
+    """
+    for legacy_key, key in LEGACY_KEYS.items():
+        if legacy_key in context:
+            value = context.pop(legacy_key)
+            context[key] = list(value.values()) if isinstance(value, dict) else value
+    for key in LEGACY_DISPLAY_KEYS:
+        context.pop(key, None)
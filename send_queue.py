@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Очередь исходящих вызовов VK API (отправка сообщений)
+VK ограничивает количество вызовов методов от имени группы в секунду, при всплеске сообщений вызовы сверх
+ограничения возвращают ошибку. Очередь отправляет вызовы не чаще ограничения:
+- вызовы расходуют токены из TokenBucket (rate токенов в секунду, не больше burst подряд)
+- если к моменту отправки в очереди накопилось несколько вызовов, они отправляются одним вызовом execute
+  (до 25 методов, один токен на весь execute), поэтому при нагрузке очередь приближается к пределу API,
+  а не упирается в него
+- вызовы одного peer_id отправляются строго по очереди: пока запрос с вызовом peer_id не выполнен, следующие его
+  вызовы ждут, вызовы разных peer_id выполняются параллельно (workers запросов одновременно)
+- запрос, не выполненный из-за превышения частоты (код 6), ошибки сервера VK или сети, повторяется
+  с экспоненциальной паузой со случайной составляющей (RetryPolicy); повтор тоже расходует токен, т.е. идёт
+  в пределах того же ограничения; повтор безопасен, т.к. random_id сообщения не меняется (message_ids)
+- flood control одинаковых сообщений (9) и исчерпанный лимит вызовов метода (29) за секунды не проходят,
+  поэтому такие запросы не повторяются
+- в stats() - время ожидания вызовов в очереди (latency_avg, latency_max) и счётчики ошибок по видам (errors)
+
+SendQueue - для синхронного бота (потоки), AsyncSendQueue - для асинхронного (asyncio).
+Пока очередь не запущена, вызовы выполняются сразу в вызывающем потоке.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future
+from functools import reduce
+
+import aiohttp
+import requests
+
+from bot_metrics import metrics
+from photo_delivery import EXECUTE_MAX_CALLS
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+FLOOD_ERROR_CODES = (6,)  # слишком много запросов в секунду
+QUOTA_ERROR_CODES = (9, 29)  # flood control (одинаковые сообщения), достигнут лимит вызовов метода
+SERVER_ERROR_CODES = (1, 10)  # неизвестная ошибка, внутренняя ошибка сервера VK
+NETWORK_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError, requests.ConnectionError, requests.Timeout,
+                  aiohttp.ClientConnectionError)
+ERROR_CLASSES = ('flood', 'quota', 'server', 'network', 'execute', 'other')
+RETRY_ERROR_CLASSES = ('flood', 'server', 'network')
+
+
+class SendError(Exception):
+    """
+    VK не выполнил метод внутри execute
+    """
+
+
+def error_class(error):
+    """
+    Вид ошибки вызова VK API
+    :param error: исключение (vk_api.ApiError, ApiHttpError, AsyncVkApiError, ошибки requests и aiohttp)
+    :return: 'flood', 'quota', 'server', 'network', 'execute' или 'other'
+    """
+    code = getattr(error, 'code', None)
+    if code in FLOOD_ERROR_CODES:
+        return 'flood'
+    if code in QUOTA_ERROR_CODES:
+        return 'quota'
+    if code in SERVER_ERROR_CODES:
+        return 'server'
+    status = getattr(error, 'status', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    if isinstance(status, int) and status >= 500:
+        return 'server'
+    if isinstance(error, NETWORK_ERRORS):
+        return 'network'
+    if isinstance(error, SendError):
+        return 'execute'
+    return 'other'
+
+
+class RetryPolicy:
+
+    """
+    Повтор запросов: не больше attempts попыток, пауза перед повтором - случайная в [0, base_delay * 2 ** номер),
+    но не больше max_delay
+    """
+
+    def __init__(self, attempts=5, base_delay=0.5, max_delay=10.0):
+        """
+        :param attempts: максимальное количество попыток (1 - без повторов)
+        :param base_delay: пауза перед первым повтором, сек
+        :param max_delay: максимальная пауза, сек
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """
+        :param attempt: номер неудачной попытки, начиная с 1
+        :return: пауза перед следующей попыткой, сек
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+
+    """
+    Ограничение частоты вызовов: rate токенов в секунду, не больше burst токенов подряд
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: количество вызовов в секунду
+        :param burst: максимальное количество вызовов подряд (по умолчанию - rate)
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Взятие токена
+        :return: 0, если токен взят, иначе - сколько секунд ждать следующего токена
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class OutgoingCall:
+
+    """
+    Вызов метода VK API в очереди
+    """
+
+    __slots__ = ('api', 'method', 'values', 'future', 'queued')
+
+    def __init__(self, api, method, values, future):
+        self.api = api
+        self.method = method
+        self.values = values
+        self.future = future
+        self.queued = time.monotonic()
+
+    @property
+    def peer_id(self):
+        return self.values.get('peer_id')
+
+
+def execute_code(calls):
+    """
+    Код VKScript для выполнения нескольких вызовов одним execute
+    :param calls: list[OutgoingCall, ...]
+    :return: str
+    """
+    methods = ','.join(f'API.{call.method}({json.dumps(call.values, ensure_ascii=False)})' for call in calls)
+    return f'return [{methods}];'
+
+
+class _SendScheduler:
+
+    """
+    Общая часть очередей: выбор вызовов для отправки и статистика (без ввода-вывода)
+    """
+
+    def __init__(self, rate=20, burst=None, workers=4, max_batch=EXECUTE_MAX_CALLS, retry=None):
+        """
+        :param rate: ограничение VK на количество вызовов в секунду
+        :param burst: максимальное количество вызовов подряд (по умолчанию - rate)
+        :param workers: количество одновременных запросов к VK
+        :param max_batch: максимальное количество методов в одном execute
+        :param retry: RetryPolicy object (по умолчанию - RetryPolicy())
+        """
+        self.workers = workers
+        self.max_batch = max_batch
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.retry = retry if retry is not None else RetryPolicy()
+
+        self._pending = deque()  # OutgoingCall в порядке поступления
+        self._in_flight = set()  # peer_id, вызовы которых выполняются
+        self._busy = 0  # количество выполняющихся запросов
+        self._latency_total = 0.0
+        self._stats = {'queued': 0, 'sent': 0, 'failed': 0, 'requests': 0, 'batches': 0, 'retries': 0,
+                       'latency_max': 0.0}
+        self._errors = dict.fromkeys(ERROR_CLASSES, 0)
+
+    def _take_batch(self):
+        """
+        Вызовы для одного запроса: по порядку поступления, кроме peer_id, у которых уже выполняется вызов
+        (вызывается под блокировкой)
+        :return: list[OutgoingCall, ...], пустой, если отправлять нечего
+        """
+        if not self._pending or self._busy >= self.workers:
+            return []
+        batch = []
+        blocked = set(self._in_flight)
+        rest = deque()
+        for call in self._pending:
+            peer_id = call.peer_id
+            if len(batch) < self.max_batch and peer_id not in blocked and (not batch or call.api is batch[0].api):
+                # методы внутри execute выполняются по порядку, вызовы одного peer_id могут идти в одном запросе
+                batch.append(call)
+            else:
+                rest.append(call)
+                if peer_id is not None:
+                    # следующие вызовы того же peer_id ждут этого
+                    blocked.add(peer_id)
+        if not batch:
+            return []
+        self._pending = rest
+        self._in_flight.update(call.peer_id for call in batch if call.peer_id is not None)
+        self._busy += 1
+        self._count_request(batch=batch)
+        return batch
+
+    def _count_request(self, batch):
+        """
+        Учёт запроса и времени ожидания его вызовов в очереди (вызывается под блокировкой)
+        """
+        now = time.monotonic()
+        for call in batch:
+            latency = now - call.queued
+            self._latency_total += latency
+            self._stats['latency_max'] = max(self._stats['latency_max'], latency)
+        self._stats['requests'] += 1
+        if len(batch) > 1:
+            self._stats['batches'] += 1
+
+    def _has_ready(self):
+        """
+        Есть ли вызов, который можно отправить (вызывается под блокировкой)
+        """
+        if self._busy >= self.workers:
+            return False
+        return any(call.peer_id is None or call.peer_id not in self._in_flight for call in self._pending)
+
+    def _finish(self, batch, results):
+        """
+        Окончание запроса (вызывается под блокировкой)
+        :param results: list[результат или исключение, ...] в порядке batch
+        """
+        self._busy -= 1
+        for call in batch:
+            self._in_flight.discard(call.peer_id)
+        self._count_results(results=results)
+
+    def _count_results(self, results):
+        """
+        Учёт выполненных и невыполненных вызовов (вызывается под блокировкой)
+        """
+        for result in results:
+            if isinstance(result, Exception):
+                self._stats['failed'] += 1
+                if isinstance(result, SendError):
+                    self._errors['execute'] += 1
+            else:
+                self._stats['sent'] += 1
+
+    def _should_retry(self, error, attempt):
+        """
+        Учёт ошибки запроса и решение, повторять ли его (вызывается под блокировкой)
+        :param error: исключение
+        :param attempt: номер неудачной попытки, начиная с 1
+        :return: bool
+        """
+        kind = error_class(error=error)
+        self._errors[kind] += 1
+        if kind in RETRY_ERROR_CLASSES and attempt < self.retry.attempts:
+            self._stats['retries'] += 1
+            return True
+        return False
+
+    @staticmethod
+    def _batch_results(batch, response):
+        """
+        Результаты вызовов из ответа execute (VK возвращает false для невыполненного метода)
+        """
+        return [SendError(f'{call.method} не выполнен внутри execute') if result is False else result
+                for call, result in zip(batch, response)]
+
+    def _stats_snapshot(self):
+        """
+        Статистика очереди (вызывается под блокировкой)
+        """
+        stats = dict(self._stats)
+        stats['errors'] = dict(self._errors)
+        taken = self._stats['queued'] - len(self._pending)
+        stats['latency_avg'] = self._latency_total / taken if taken else 0.0
+        stats['pending'] = len(self._pending)
+        return stats
+
+    @staticmethod
+    def _set_results(batch, results):
+        """
+        Передача результатов ожидающим вызовов
+        """
+        for call, result in zip(batch, results):
+            if isinstance(result, Exception):
+                call.future.set_exception(result)
+            else:
+                call.future.set_result(result)
+
+
+class SendQueue(_SendScheduler):
+
+    """
+    Очередь исходящих вызовов для синхронного бота (vk_api)
+    """
+
+    def __init__(self, rate=20, burst=None, workers=4, max_batch=EXECUTE_MAX_CALLS, retry=None):
+        super().__init__(rate=rate, burst=burst, workers=workers, max_batch=max_batch, retry=retry)
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def start(self):
+        """
+        Запуск потоков отправки
+        """
+        if not self._threads:
+            self._stopping = False
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._send_loop, name=f'send-queue-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """
+        Остановка потоков отправки (вызовы, уже стоящие в очереди, отправляются)
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        log.info('Очередь отправки остановлена: %s', self.stats())
+
+    def submit(self, api, method, **values):
+        """
+        Постановка вызова в очередь
+        :param api: VkApiMethod object
+        :param method: название метода, например 'messages.send'
+        :param values: параметры метода
+        :return: concurrent.futures.Future с результатом метода
+        """
+        call = OutgoingCall(api=api, method=method, values=values, future=Future())
+        if not self._threads:
+            # потоки отправки не запущены - вызов выполняется сразу
+            with self._condition:
+                self._stats['queued'] += 1
+                self._count_request(batch=[call])
+            results = self._execute(batch=[call])
+            with self._condition:
+                self._count_results(results=results)
+            self._set_results(batch=[call], results=results)
+            return call.future
+        with self._condition:
+            self._pending.append(call)
+            self._stats['queued'] += 1
+            self._condition.notify()
+        return call.future
+
+    def call(self, api, method, **values):
+        """
+        Вызов через очередь с ожиданием результата (время вызова - этап метрик с названием метода)
+        :return: результат метода
+        """
+        with metrics.timer(method):
+            return self.submit(api, method, **values).result()
+
+    def stats(self):
+        """
+        Статистика очереди
+        :return: dict {queued, sent, failed, requests, batches, retries, latency_avg, latency_max, pending,
+                 errors: {flood, quota, server, network, execute, other}}
+        """
+        with self._condition:
+            return self._stats_snapshot()
+
+    def _execute(self, batch):
+        """
+        Выполнение одного запроса (с повторами): один метод - напрямую, несколько - через execute
+        :return: list[результат или исключение, ...] в порядке batch
+        """
+        api = batch[0].api
+        attempt = 1
+        while True:
+            try:
+                if len(batch) == 1:
+                    call = batch[0]
+                    return [reduce(getattr, call.method.split('.'), api)(**call.values)]
+                return self._batch_results(batch=batch, response=api.execute(code=execute_code(calls=batch)))
+            except Exception as exc:
+                with self._condition:
+                    retry = self._should_retry(error=exc, attempt=attempt)
+                if not retry:
+                    return [exc] * len(batch)
+            time.sleep(self.retry.delay(attempt=attempt))
+            self._wait_token()
+            attempt += 1
+
+    def _wait_token(self):
+        """
+        Ожидание токена перед повтором запроса
+        """
+        while True:
+            with self._condition:
+                delay = self.bucket.take()
+            if not delay:
+                return
+            time.sleep(delay)
+
+    def _send(self, batch):
+        """
+        Выполнение запроса из очереди
+        """
+        results = self._execute(batch=batch)
+        with self._condition:
+            self._finish(batch=batch, results=results)
+            self._condition.notify_all()
+        self._set_results(batch=batch, results=results)
+
+    def _send_loop(self):
+        """
+        Цикл потока отправки
+        """
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopping and not self._pending:
+                        return
+                    if not self._has_ready():
+                        self._condition.wait()
+                        continue
+                    delay = self.bucket.take()
+                    if delay:
+                        self._condition.wait(timeout=delay)
+                        continue
+                    batch = self._take_batch()
+                    break
+            self._send(batch=batch)
+
+
+class AsyncSendQueue(_SendScheduler):
+
+    """
+    Очередь исходящих вызовов для асинхронного бота (AsyncVkApi)
+    """
+
+    def __init__(self, rate=20, burst=None, workers=4, max_batch=EXECUTE_MAX_CALLS, retry=None):
+        super().__init__(rate=rate, burst=burst, workers=workers, max_batch=max_batch, retry=retry)
+        self._wakeup = None
+        self._task = None
+        self._requests = set()
+        self._stopping = False
+
+    def start(self):
+        """
+        Запуск задачи отправки (должен выполняться внутри работающего event loop)
+        """
+        if self._task is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._send_loop())
+
+    async def stop(self):
+        """
+        Остановка отправки (вызовы, уже стоящие в очереди, отправляются)
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+            if self._requests:
+                await asyncio.gather(*self._requests)
+        log.info('Очередь отправки остановлена: %s', self.stats())
+
+    async def call(self, api, method, **values):
+        """
+        Вызов через очередь с ожиданием результата (время вызова - этап метрик с названием метода)
+        :param api: AsyncVkApi object
+        :param method: название метода, например 'messages.send'
+        :param values: параметры метода
+        :return: результат метода
+        """
+        with metrics.timer(method):
+            call = OutgoingCall(api=api, method=method, values=values,
+                                future=asyncio.get_running_loop().create_future())
+            self._stats['queued'] += 1
+            if self._task is None:
+                # задача отправки не запущена - вызов выполняется сразу
+                self._count_request(batch=[call])
+                results = await self._execute(batch=[call])
+                self._count_results(results=results)
+                self._set_results(batch=[call], results=results)
+            else:
+                self._pending.append(call)
+                self._wakeup.set()
+            return await call.future
+
+    def stats(self):
+        """
+        Статистика очереди
+        :return: dict {queued, sent, failed, requests, batches, retries, latency_avg, latency_max, pending,
+                 errors: {flood, quota, server, network, execute, other}}
+        """
+        return self._stats_snapshot()
+
+    async def _execute(self, batch):
+        """
+        Выполнение одного запроса (с повторами): один метод - напрямую, несколько - через execute
+        :return: list[результат или исключение, ...] в порядке batch
+        """
+        api = batch[0].api
+        attempt = 1
+        while True:
+            try:
+                if len(batch) == 1:
+                    return [await api.method(batch[0].method, **batch[0].values)]
+                return self._batch_results(batch=batch,
+                                           response=await api.method('execute', code=execute_code(calls=batch)))
+            except Exception as exc:
+                if not self._should_retry(error=exc, attempt=attempt):
+                    return [exc] * len(batch)
+            await asyncio.sleep(self.retry.delay(attempt=attempt))
+            await self._wait_token()
+            attempt += 1
+
+    async def _wait_token(self):
+        """
+        Ожидание токена перед повтором запроса
+        """
+        delay = self.bucket.take()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.bucket.take()
+
+    async def _send(self, batch):
+        """
+        Выполнение запроса из очереди
+        """
+        results = await self._execute(batch=batch)
+        self._finish(batch=batch, results=results)
+        self._set_results(batch=batch, results=results)
+        self._wakeup.set()
+
+    async def _send_loop(self):
+        """
+        Цикл задачи отправки
+        """
+        while True:
+            if self._stopping and not self._pending:
+                return
+            if not self._has_ready():
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self.bucket.take()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            request = asyncio.ensure_future(self._send(batch=self._take_batch()))
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
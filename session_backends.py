@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Хранилища состояний пользователей внутри сценариев (за кэшем session_cache.SessionCache)
+Состояния сценариев живут недолго и меняются на каждом сообщении, заявки на регистрацию - наоборот,
+поэтому состояния можно держать отдельно от заявок (settings.SESSION_BACKEND):
+- 'memory' - в памяти процесса (состояния теряются при перезапуске бота)
+- 'sqlite' - во встроенной базе SQLite в режиме WAL (settings.SESSION_SQLITE_PATH)
+- 'database' - в таблице UserState основной базы данных (DB_CONFIG, PostgreSQL)
+
+Все хранилища одинаково принимают записи SessionCache:
+None - удалить состояние, ('full', scenario_name, step_name, context) - записать целиком,
+('delta', scenario_name, step_name, изменённые ключи контекста, удалённые ключи, context) - обновить ключи контекста
+(если записи состояния в хранилище нет, например её удалили в обход кэша, состояние записывается целиком из context).
+При записи состояния запоминается время последней активности пользователя (last_activity, по нему есть индекс),
+idle_users находит давно неактивных пользователей для SessionSweeper.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from copy import deepcopy
+from datetime import datetime
+
+from pony.orm import db_session
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+BACKENDS = ('memory', 'sqlite', 'database')
+
+# обновление только изменённых ключей контекста: $changed - изменённые ключи (json), $removed - удалённые ключи
+DELTA_UPDATES = {
+    'postgres': 'UPDATE {table} SET "scenario_name" = $scenario_name, "step_name" = $step_name, '
+                '"last_activity" = $last_activity, '
+                '"context" = ("context" - CAST($removed AS text[])) || CAST($changed AS jsonb) WHERE "user_id" = $user_id',
+    # json_patch удаляет ключи со значением null
+    'sqlite': 'UPDATE {table} SET "scenario_name" = $scenario_name, "step_name" = $step_name, '
+              '"last_activity" = $last_activity, '
+              '"context" = json_patch("context", $changed) WHERE "user_id" = $user_id',
+}
+
+
+def apply_delta(context, changed, removed):
+    """
+    Контекст после изменения ключей
+    :return: новый dict
+    """
+    context = {key: value for key, value in context.items() if key not in removed}
+    context.update(changed)
+    return context
+
+
+def json_patch(changed, removed):
+    """
+    Изменения контекста для json_patch (удалённые ключи - со значением null)
+    :return: str
+    """
+    return json.dumps(dict(changed, **{key: None for key in removed}), ensure_ascii=False)
+
+
+class MemoryBackend:
+
+    """
+    Состояния в памяти процесса
+    """
+
+    def __init__(self):
+        self._rows = {}  # user_id: (scenario_name, step_name, context, last_activity)
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        """
+        :param user_id: id пользователя
+        :return: (scenario_name, step_name, context), или None, если пользователь не в сценарии
+        """
+        with self._lock:
+            row = self._rows.get(user_id)
+        if row is None:
+            return None
+        scenario_name, step_name, context, _ = row
+        return scenario_name, step_name, deepcopy(context)
+
+    def write(self, writes):
+        """
+        :param writes: dict {user_id: запись SessionCache}
+        """
+        last_activity = time.time()
+        with self._lock:
+            for user_id, write in writes.items():
+                if write is None:
+                    self._rows.pop(user_id, None)
+                elif write[0] == 'full':
+                    _, scenario_name, step_name, context = write
+                    self._rows[user_id] = (scenario_name, step_name, deepcopy(context), last_activity)
+                elif user_id in self._rows:
+                    _, scenario_name, step_name, changed, removed, _ = write
+                    self._rows[user_id] = (scenario_name, step_name,
+                                           apply_delta(context=self._rows[user_id][2], changed=deepcopy(changed),
+                                                       removed=removed),
+                                           last_activity)
+                else:
+                    _, scenario_name, step_name, _, _, context = write
+                    self._rows[user_id] = (scenario_name, step_name, deepcopy(context), last_activity)
+
+    def idle_users(self, before, limit):
+        """
+        Пользователи, неактивные с момента before
+        :param before: время, unix timestamp
+        :param limit: максимальное количество пользователей
+        :return: list[user_id, ...], сначала самые давние
+        """
+        with self._lock:
+            idle = sorted((row[3], user_id) for user_id, row in self._rows.items() if row[3] < before)
+        return [user_id for _, user_id in idle[:limit]]
+
+    def close(self):
+        pass
+
+
+class SqliteBackend:
+
+    """
+    Состояния во встроенной базе SQLite в режиме WAL
+    Запись не блокирует чтение, fsync выполняется при контрольных точках WAL, а не на каждой транзакции.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS "user_state" ('
+              '"user_id" TEXT PRIMARY KEY, "scenario_name" TEXT NOT NULL, "step_name" TEXT NOT NULL, '
+              '"context" TEXT NOT NULL, "last_activity" REAL NOT NULL DEFAULT 0)')
+    INDEX = 'CREATE INDEX IF NOT EXISTS "idx_user_state__last_activity" ON "user_state" ("last_activity")'
+
+    def __init__(self, path):
+        """
+        :param path: файл базы данных
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(self.SCHEMA)
+        columns = {row[1] for row in self._connection.execute('PRAGMA table_info("user_state")')}
+        if 'last_activity' not in columns:
+            # файл состояний создан до появления last_activity
+            self._connection.execute('ALTER TABLE "user_state" ADD COLUMN "last_activity" REAL NOT NULL DEFAULT 0')
+        self._connection.execute(self.INDEX)
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        """
+        :param user_id: id пользователя
+        :return: (scenario_name, step_name, context), или None, если пользователь не в сценарии
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT "scenario_name", "step_name", "context" FROM "user_state" '
+                                           'WHERE "user_id" = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        scenario_name, step_name, context = row
+        return scenario_name, step_name, json.loads(context)
+
+    def write(self, writes):
+        """
+        Все записи одной транзакцией
+        :param writes: dict {user_id: запись SessionCache}
+        """
+        last_activity = time.time()
+        with self._lock:
+            connection = self._connection
+            connection.execute('BEGIN')
+            try:
+                for user_id, write in writes.items():
+                    if write is None:
+                        connection.execute('DELETE FROM "user_state" WHERE "user_id" = ?', (user_id,))
+                        continue
+                    if write[0] == 'delta':
+                        _, scenario_name, step_name, changed, removed, context = write
+                        cursor = connection.execute('UPDATE "user_state" SET "scenario_name" = ?, "step_name" = ?, '
+                                                    '"last_activity" = ?, "context" = json_patch("context", ?) '
+                                                    'WHERE "user_id" = ?',
+                                                    (scenario_name, step_name, last_activity,
+                                                     json_patch(changed=changed, removed=removed), user_id))
+                        if cursor.rowcount:
+                            continue
+                        log.warning('Состояние пользователя %s не найдено при обновлении, записано целиком', user_id)
+                    else:
+                        _, scenario_name, step_name, context = write
+                    connection.execute('INSERT OR REPLACE INTO "user_state" VALUES (?, ?, ?, ?, ?)',
+                                       (user_id, scenario_name, step_name,
+                                        json.dumps(context, ensure_ascii=False), last_activity))
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def idle_users(self, before, limit):
+        """
+        Пользователи, неактивные с момента before (по индексу last_activity)
+        :param before: время, unix timestamp
+        :param limit: максимальное количество пользователей
+        :return: list[user_id, ...], сначала самые давние
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT "user_id" FROM "user_state" WHERE "last_activity" < ? '
+                                            'ORDER BY "last_activity" LIMIT ?', (before, limit)).fetchall()
+        return [user_id for (user_id,) in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class DatabaseBackend:
+
+    """
+    Состояния в таблице UserState основной базы данных (models)
+    """
+
+    def __init__(self):
+        from models import UserState, db
+
+        self.db = db
+        self.entity = UserState
+
+    def load(self, user_id):
+        """
+        :param user_id: id пользователя
+        :return: (scenario_name, step_name, context), или None, если пользователь не в сценарии
+        """
+        with db_session:
+            user_state = self.entity.get(user_id=user_id)
+            if user_state is None:
+                return None
+            return user_state.scenario_name, user_state.step_name, deepcopy(user_state.context)
+
+    def write(self, writes):
+        """
+        Все записи одной транзакцией
+        :param writes: dict {user_id: запись SessionCache}
+        """
+        db = self.db
+        last_activity = datetime.utcnow()
+        with db_session:
+            table = db.provider.quote_name(self.entity._table_)
+            for user_id, write in writes.items():
+                if write is not None and write[0] == 'delta' and db.provider_name in DELTA_UPDATES:
+                    _, scenario_name, step_name, changed, removed, _ = write
+                    if db.provider_name == 'postgres':
+                        changed, removed = json.dumps(changed, ensure_ascii=False), list(removed)
+                    else:
+                        changed = json_patch(changed=changed, removed=removed)
+                    if db.execute(DELTA_UPDATES[db.provider_name].format(table=table)).rowcount:
+                        continue
+                    # строки нет - состояние записывается целиком (ниже)
+                    log.warning('Состояние пользователя %s не найдено при обновлении, записано целиком', user_id)
+
+                user_state = self.entity.get(user_id=user_id)
+                if write is None:
+                    if user_state is not None:
+                        user_state.delete()
+                    continue
+                if write[0] == 'delta':
+                    # обновление ключей контекста средствами базы не поддерживается или строки нет -
+                    # контекст записывается целиком
+                    _, scenario_name, step_name, _, _, context = write
+                else:
+                    _, scenario_name, step_name, context = write
+                if user_state is None:
+                    self.entity(user_id=user_id, scenario_name=scenario_name, step_name=step_name, context=context,
+                                last_activity=last_activity)
+                else:
+                    user_state.scenario_name = scenario_name
+                    user_state.step_name = step_name
+                    user_state.context = context
+                    user_state.last_activity = last_activity
+
+    def idle_users(self, before, limit):
+        """
+        Пользователи, неактивные с момента before (по индексу last_activity)
+        :param before: время, unix timestamp
+        :param limit: максимальное количество пользователей
+        :return: list[user_id, ...], сначала самые давние
+        """
+        before = datetime.utcfromtimestamp(before)
+        with db_session:
+            user_states = self.entity.select(lambda user_state: user_state.last_activity < before) \
+                .order_by(self.entity.last_activity)[:limit]
+            return [user_state.user_id for user_state in user_states]
+
+    def close(self):
+        pass
+
+
+def make_backend(kind, sqlite_path=None):
+    """
+    :param kind: 'memory', 'sqlite' или 'database'
+    :param sqlite_path: файл базы данных для 'sqlite'
+    :return: хранилище состояний
+    """
+    if kind == 'memory':
+        return MemoryBackend()
+    if kind == 'sqlite':
+        return SqliteBackend(path=sqlite_path)
+    if kind == 'database':
+        return DatabaseBackend()
+    raise ValueError(f'Неизвестное хранилище состояний: {kind}')
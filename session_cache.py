@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Кэш состояний пользователей (UserState) в памяти с отложенной записью в хранилище состояний
+- горячие состояния хранятся в памяти компактными объектами ScenarioState
+- запоминается и отсутствие состояния (пользователь не в сценарии), чтобы не ходить в базу за каждым сообщением
+- изменения записываются в базу пачками, в одной транзакции
+- в хранилище уходят только изменённые ключи контекста (jsonb || в PostgreSQL, json_patch в SQLite),
+  объём контекстов и записи считается в stats() (context_bytes, written_bytes на commits сообщений)
+- хранилище состояний (память, SQLite, основная база данных) выбирается настройкой, см. session_backends
+- состояния брошенных сценариев удаляются небольшими пачками (expire_idle, см. session_sweeper)
+
+Режимы записи (гарантии сохранности):
+- 'write_through' - изменения записываются в базу до окончания обработки сообщения
+- 'batch' - изменения записываются фоновым потоком раз в flush_interval секунд или при накоплении flush_batch
+  изменённых состояний, при падении процесса теряется не больше flush_interval секунд работы
+- 'on_complete' - в базу записывается только окончание сценария, состояния внутри сценария живут в памяти;
+  если их больше max_items, самые давние записываются в хранилище и вытесняются из памяти
+
+Кэш рассчитан на то, что с хранилищем состояний работает один процесс бота.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from copy import deepcopy
+from itertools import islice
+
+from session_backends import DatabaseBackend
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+MODES = ('write_through', 'batch', 'on_complete')
+
+
+def encode_context(context):
+    """
+    :param context: контекст пользователя
+    :return: dict {ключ: значение в json}
+    """
+    return {key: json.dumps(value, ensure_ascii=False, sort_keys=True) for key, value in context.items()}
+
+
+def encoded_size(encoded):
+    """
+    Размер контекста в json, байт
+    :param encoded: dict {ключ: значение в json}
+    """
+    return sum(len(json.dumps(key, ensure_ascii=False).encode()) + len(value.encode()) + 2
+               for key, value in encoded.items()) + 1
+
+
+def prepare_writes(changes, persisted):
+    """
+    Сравнение изменённых контекстов с записанными в базу
+    :param changes: dict {user_id: (scenario_name, step_name, context) или None - удалить}
+    :param persisted: dict {user_id: контекст в базе (encode_context) или None, если неизвестен}
+    :return: (записи для хранилища состояний, dict {user_id: encode_context или None}, объём контекстов, байт,
+              объём записи, байт)
+    """
+    writes = {}
+    encoded = {}
+    context_bytes = written_bytes = 0
+    for user_id, change in changes.items():
+        if change is None:
+            writes[user_id] = encoded[user_id] = None
+            continue
+        scenario_name, step_name, context = change
+        current = encoded[user_id] = encode_context(context=context)
+        size = encoded_size(encoded=current)
+        context_bytes += size
+        base = persisted.get(user_id)
+        if base is None:
+            writes[user_id] = ('full', scenario_name, step_name, context)
+            written_bytes += size
+            continue
+        changed = {key: value for key, value in current.items() if base.get(key) != value}
+        removed = [key for key in base if key not in current]
+        writes[user_id] = ('delta', scenario_name, step_name, {key: context[key] for key in changed}, removed,
+                           context)
+        written_bytes += encoded_size(encoded=changed) + sum(len(key.encode()) for key in removed)
+    return writes, encoded, context_bytes, written_bytes
+
+
+class ScenarioState:
+
+    """
+    Состояние пользователя внутри сценария, отвязанное от базы данных
+    Повторяет интерфейс UserState, который используют шаги сценария (step_name, context, delete())
+    """
+
+    __slots__ = ('user_id', 'scenario_name', 'step_name', 'context', 'deleted', 'last_activity')
+
+    def __init__(self, user_id, scenario_name, step_name, context):
+        self.user_id = user_id
+        self.scenario_name = scenario_name
+        self.step_name = step_name
+        self.context = context
+        self.deleted = False
+        self.last_activity = time.time()  # последнее сообщение пользователя, unix timestamp
+
+    def delete(self):
+        """
+        Пользователь выходит из сценария
+        """
+        self.deleted = True
+
+
+class SessionCache:
+
+    """
+    Кэш состояний пользователей с отложенной (write-back) записью в хранилище состояний
+    """
+
+    def __init__(self, mode='batch', flush_interval=1.0, flush_batch=100, max_items=10000, max_negative=100000,
+                 backend=None):
+        """
+        :param mode: режим записи в базу ('write_through', 'batch', 'on_complete')
+        :param flush_interval: период фоновой записи, сек (режим 'batch')
+        :param flush_batch: количество изменённых состояний, при котором запись начинается сразу (режим 'batch')
+        :param max_items: максимальное количество состояний в памяти
+        :param max_negative: максимальное количество запомненных пользователей без состояния
+        :param backend: хранилище состояний (session_backends), по умолчанию - таблица UserState основной базы
+        """
+        if mode not in MODES:
+            raise ValueError(f'Неизвестный режим кэша состояний: {mode}')
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.max_items = max_items
+        self.max_negative = max_negative
+        self.backend = backend if backend is not None else DatabaseBackend()
+
+        self._states = OrderedDict()  # user_id: ScenarioState
+        self._negative = OrderedDict()  # user_id: None, пользователи без состояния
+        self._dirty = {}  # user_id: (scenario_name, step_name, context) или None, если состояние удалено
+        self._persisted = {}  # user_id: {ключ: значение в json} - контекст в том виде, в каком он записан в базу
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'flushes': 0, 'written': 0,
+                       'commits': 0, 'context_bytes': 0, 'written_bytes': 0, 'expired': 0}
+
+    def start(self):
+        """
+        Запуск фоновой записи (для режима 'batch')
+        """
+        if self.mode == 'batch' and self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._flush_loop, name='session-cache-flush', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Остановка фоновой записи, запись всех накопленных изменений и закрытие хранилища
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(everything=True)
+        self.backend.close()
+        log.info('Кэш состояний остановлен: %s', self.stats())
+
+    def peek(self, user_id):
+        """
+        Состояние пользователя, если оно известно без обращения к базе
+        :param user_id: id пользователя
+        :return: (известно ли состояние, ScenarioState object или None)
+        """
+        user_id = str(user_id)
+        with self._condition:
+            state = self._states.get(user_id)
+            if state is not None:
+                self._states.move_to_end(user_id)
+                state.last_activity = time.time()
+                self._stats['hits'] += 1
+                return True, state
+            if user_id in self._negative:
+                self._negative.move_to_end(user_id)
+                self._stats['negative_hits'] += 1
+                return True, None
+        return False, None
+
+    def get(self, user_id):
+        """
+        Состояние пользователя (из памяти, или из хранилища, если в памяти его нет)
+        :param user_id: id пользователя
+        :return: ScenarioState object, или None, если пользователь не в сценарии
+        """
+        found, state = self.peek(user_id=user_id)
+        if found:
+            return state
+
+        user_id = str(user_id)
+        row = self.backend.load(user_id=user_id)
+        if row is not None:
+            scenario_name, step_name, context = row
+            state = ScenarioState(user_id=user_id, scenario_name=scenario_name, step_name=step_name, context=context)
+
+        with self._condition:
+            self._stats['misses'] += 1
+            if state is None:
+                self._remember_negative(user_id=user_id)
+            else:
+                self._states[user_id] = state
+                self._persisted.setdefault(user_id, encode_context(context=state.context))
+                self._evict()
+        return state
+
+    def create(self, user_id, scenario_name, step_name, context):
+        """
+        Создание состояния пользователя, начинающего сценарий
+        :return: ScenarioState object (в базу попадёт при commit)
+        """
+        state = ScenarioState(user_id=str(user_id), scenario_name=scenario_name, step_name=step_name, context=context)
+        with self._condition:
+            self._negative.pop(state.user_id, None)
+            self._states[state.user_id] = state
+            self._evict()
+        return state
+
+    def commit(self, state):
+        """
+        Фиксация изменений состояния после обработки сообщения
+        :param state: ScenarioState object
+        :return: None
+        """
+        with self._condition:
+            if state.deleted:
+                self._states.pop(state.user_id, None)
+                self._remember_negative(user_id=state.user_id)
+                self._dirty[state.user_id] = None
+            else:
+                self._dirty[state.user_id] = (state.scenario_name, state.step_name, deepcopy(state.context))
+            self._stats['commits'] += 1
+            dirty_count = len(self._dirty)
+            overflow = len(self._states) > self.max_items
+            self._condition.notify_all()
+
+        if self.mode == 'write_through' or (self.mode == 'on_complete' and (state.deleted or overflow)):
+            self.flush()
+        elif self.mode == 'batch' and self._thread is None and dirty_count >= self.flush_batch:
+            # фоновая запись не запущена - пачка записывается сразу
+            self.flush()
+
+    def flush(self, everything=False):
+        """
+        Запись накопленных изменений в базу одной транзакцией
+        :param everything: записать и состояния внутри сценария в режиме 'on_complete' (при остановке бота)
+        :return: количество записанных состояний
+        """
+        with self._flush_lock:
+            with self._condition:
+                if self.mode == 'on_complete' and not everything:
+                    # законченные сценарии и самые давние состояния, которые не помещаются в памяти
+                    overflow = self._overflow()
+                    changes = {user_id: change for user_id, change in self._dirty.items()
+                               if change is None or user_id in overflow}
+                    for user_id in changes:
+                        del self._dirty[user_id]
+                else:
+                    changes, self._dirty = self._dirty, {}
+            if not changes:
+                return 0
+
+            with self._condition:
+                persisted = {user_id: self._persisted.get(user_id) for user_id in changes}
+            writes, encoded, context_bytes, written_bytes = prepare_writes(changes=changes, persisted=persisted)
+            try:
+                self.backend.write(writes=writes)
+            except Exception:
+                # изменения возвращаются в очередь, если их не перекрыли более новые
+                with self._condition:
+                    for user_id, change in changes.items():
+                        self._dirty.setdefault(user_id, change)
+                raise
+
+            with self._condition:
+                for user_id, context in encoded.items():
+                    if context is None:
+                        self._persisted.pop(user_id, None)
+                    elif user_id in self._states:
+                        self._persisted[user_id] = context
+                self._stats['flushes'] += 1
+                self._stats['written'] += len(changes)
+                self._stats['context_bytes'] += context_bytes
+                self._stats['written_bytes'] += written_bytes
+                self._evict()
+            return len(changes)
+
+    def expire_idle(self, ttl, batch=100):
+        """
+        Удаление состояний пользователей, которые не писали боту дольше ttl секунд (одна небольшая пачка)
+        Кандидаты берутся из памяти (в порядке обращений, начиная с самых давних) и из хранилища (по индексу
+        last_activity); пользователи, недавно писавшие боту, пропускаются, даже если хранилище ещё не знает об этом.
+        :param ttl: время жизни состояния без сообщений пользователя, сек
+        :param batch: максимальное количество удаляемых состояний
+        :return: list[user_id, ...] - удалённые состояния
+        """
+        before = time.time() - ttl
+        candidates = []
+        with self._condition:
+            for user_id, state in self._states.items():
+                if len(candidates) >= batch or state.last_activity >= before:
+                    break
+                candidates.append(user_id)
+        if len(candidates) < batch:
+            candidates.extend(user_id for user_id in self.backend.idle_users(before=before, limit=batch)
+                              if user_id not in candidates)
+
+        expired = []
+        with self._condition:
+            for user_id in candidates[:batch]:
+                state = self._states.get(user_id)
+                if state is not None and state.last_activity >= before:
+                    continue
+                if state is None and user_id in self._dirty:
+                    # состояние уже удалено, но ещё не записано
+                    continue
+                self._states.pop(user_id, None)
+                self._persisted.pop(user_id, None)
+                self._remember_negative(user_id=user_id)
+                self._dirty[user_id] = None
+                expired.append(user_id)
+            self._stats['expired'] += len(expired)
+        if expired:
+            self.flush()
+        return expired
+
+    def stats(self):
+        """
+        Статистика кэша
+        :return: dict {hits, negative_hits, misses, flushes, written, commits, context_bytes, written_bytes,
+                 expired, items, negative_items, dirty}
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats['items'] = len(self._states)
+            stats['negative_items'] = len(self._negative)
+            stats['dirty'] = len(self._dirty)
+        return stats
+
+    def _remember_negative(self, user_id):
+        """
+        Запоминание пользователя без состояния (вызывается под блокировкой)
+        """
+        self._negative[user_id] = None
+        self._negative.move_to_end(user_id)
+        while len(self._negative) > self.max_negative:
+            self._negative.popitem(last=False)
+
+    def _evict(self):
+        """
+        Вытеснение давно не использованных состояний, уже записанных в базу (вызывается под блокировкой)
+        Последнее использованное состояние (только что созданное или загруженное) не вытесняется.
+        """
+        if len(self._states) <= self.max_items:
+            return
+        for user_id in list(self._states)[:-1]:
+            if len(self._states) <= self.max_items:
+                break
+            if user_id not in self._dirty:
+                del self._states[user_id]
+                self._persisted.pop(user_id, None)
+
+    def _overflow(self):
+        """
+        Самые давние изменённые состояния сверх max_items (вызывается под блокировкой)
+        :return: set {user_id, ...}
+        """
+        extra = len(self._states) - self.max_items
+        if extra <= 0:
+            return set()
+        return set(islice((user_id for user_id in self._states if user_id in self._dirty), extra))
+
+    def _flush_loop(self):
+        """
+        Цикл фоновой записи
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping or len(self._dirty) >= self.flush_batch,
+                                         timeout=self.flush_interval)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                log.exception('ОШИБКА ПРИ ЗАПИСИ СОСТОЯНИЙ ПОЛЬЗОВАТЕЛЕЙ')
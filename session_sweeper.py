@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Удаление брошенных сценариев
+Пользователь, который перестал отвечать посреди сценария, оставляет своё состояние в хранилище навсегда.
+Фоновый поток раз в interval секунд удаляет состояния пользователей, не писавших боту дольше ttl секунд:
+- небольшими пачками (batch состояний - одна короткая транзакция), с паузой pause между пачками,
+  поэтому таблица состояний не блокируется надолго и обработка сообщений не ждёт удаления
+- кандидаты ищутся по индексу last_activity
+- каждому пользователю с удалённым состоянием можно отправить уведомление (notify)
+"""
+
+import logging
+import threading
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+
+class SessionSweeper:
+
+    """
+    Фоновое удаление состояний пользователей, бросивших сценарий
+    """
+
+    def __init__(self, sessions, ttl, batch=100, interval=60.0, pause=0.1, notify=None):
+        """
+        :param sessions: session_cache.SessionCache object
+        :param ttl: время жизни состояния без сообщений пользователя, сек
+        :param batch: количество состояний, удаляемых одной транзакцией
+        :param interval: период проверки, сек
+        :param pause: пауза между пачками, сек
+        :param notify: функция notify(user_id), вызывается для каждого пользователя с удалённым состоянием
+        """
+        self.sessions = sessions
+        self.ttl = ttl
+        self.batch = batch
+        self.interval = interval
+        self.pause = pause
+        self.notify = notify
+
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Запуск фонового удаления
+        """
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._sweep_loop, name='session-sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Остановка фонового удаления (текущая пачка дописывается)
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def sweep(self):
+        """
+        Удаление всех просроченных состояний, пачка за пачкой
+        :return: количество удалённых состояний
+        """
+        total = 0
+        while True:
+            expired = self.sessions.expire_idle(ttl=self.ttl, batch=self.batch)
+            total += len(expired)
+            if self.notify is not None:
+                for user_id in expired:
+                    try:
+                        self.notify(user_id)
+                    except Exception:
+                        log.exception('ОШИБКА ПРИ ОТПРАВКЕ УВЕДОМЛЕНИЯ ОБ ИСТЁКШЕМ ЗАКАЗЕ')
+            if len(expired) < self.batch or self._stopping.wait(self.pause):
+                break
+        if total:
+            log.info('Удалено брошенных сценариев: %d', total)
+        return total
+
+    def _sweep_loop(self):
+        """
+        Цикл фонового удаления
+        """
+        while not self._stopping.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                log.exception('ОШИБКА ПРИ УДАЛЕНИИ БРОШЕННЫХ СЦЕНАРИЕВ')
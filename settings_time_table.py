@@ -3,7 +3,7 @@
 """
 Use python3.8
 
-Таблица маршрутов между городами
+Таблица маршрутов между городами и настройки расписания
 """
 
 
@@ -53,3 +53,15 @@ ROUTE_TABLE = {
     'Токио': ['Амстердам', 'Берлин', 'Буэнос-Айрес', 'Лондон', 'Лос-Анджелес', 'Мадрид', 'Москва',
               'Нью-Йорк', 'Париж', 'Пекин', 'Рим', 'Рио-де-Жанейро', 'Санкт-Петербург', 'Сидней']
 }
+
+ROUTE_MAX_STOPS = 2  # максимальное количество пересадок в предлагаемом маршруте
+
+# регулярные рейсы (добавляются к случайным рейсам маршрута)
+REGULAR_FLIGHTS = {
+    ('Москва', 'Лондон'): {'week_days': (0, 2), 'hour': 10, 'minute': 0},  # понедельник и среда
+    ('Лондон', 'Париж'): {'month_days': (5, 15, 25), 'hour': 15, 'minute': 30}  # 5, 15, 25 числа месяца
+}
+
+RANDOM_FLIGHTS_PER_MONTH = 13  # количество случайных рейсов маршрута в месяц
+TIMETABLE_HORIZON_DAYS = 400  # на сколько дней вперёд строится расписание
+TIMETABLE_SEED = 2020  # расписание одинаково при каждом запуске, пока не изменено это число
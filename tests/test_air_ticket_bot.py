@@ -1,14 +1,47 @@
 # -*- coding: utf-8 -*-
 
 from copy import deepcopy
+from datetime import datetime, timedelta
+from io import BytesIO
+from types import SimpleNamespace
 
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import numpy as np
 from pony.orm import db_session, rollback
 from unittest.mock import Mock, patch
 
+import bot_logging
+import bot_metrics
 import generate_ticket
+import handlers
+import migrate_registration
 from air_ticket_bot import Bot
+from avatar_cache import AvatarCache, placeholder_avatar
+from dispatcher import EventDispatcher
+from intent_matcher import IntentMatcher
+from models import Registration, UserState
+from photo_delivery import MultipartBody, PhotoUploader, image_file_type
+from registration_queries import find_by_email, find_by_phone, find_by_route
+from registration_writer import RegistrationWriter
+from route_graph import RouteGraph
+from scenario_compiler import ScenarioConfigError, compile_scenarios, missing_settings
+from message_ids import ReplyIds, random_id
+from send_queue import RetryPolicy, SendQueue, TokenBucket
+from session_backends import make_backend
+from session_cache import SessionCache
+from session_sweeper import SessionSweeper
+from ticket_attachments import AttachmentCache, image_key
+from timetable import TimetableIndex
 from vk_api.bot_longpoll import VkBotMessageEvent
+from vk_api.exceptions import ApiError
 
 
 try:
@@ -153,5 +186,623 @@ class TestBot(unittest.TestCase):
         assert ticket_file.read() == expected_bytes
 
 
+class TestBotLogging(unittest.TestCase):
+
+    def test_queue_json_and_lazy(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(bot_logging.JsonFormatter().format(record))
+        test_log = logging.getLogger(name='air_ticket_bot.test_logging')
+        test_log.propagate = False
+        test_log.setLevel(logging.INFO)
+        listener = bot_logging.start_logging(logger=test_log, handlers=[handler])
+        self.assertIs(bot_logging.start_logging(logger=test_log, handlers=[]), listener)
+
+        expensive = Mock(return_value='заказ')
+        test_log.debug('%s', bot_logging.LazyMessage(expensive))
+        context = {'name': 'иван'}
+        with bot_logging.log_fields(event_id='e1', peer_id=42):
+            bot_logging.bind_log_fields(step='step2')
+            test_log.info('%s', bot_logging.LazyMessage(lambda: context['name']))
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                test_log.exception('ошибка')
+        context['name'] = 'пётр'
+        test_log.info('после события')
+        listener.stop()
+
+        expensive.assert_not_called()
+        first, second, third = [json.loads(record) for record in records]
+        self.assertEqual((first['message'], first['event_id'], first['peer_id'], first['step']),
+                         ('иван', 'e1', 42, 'step2'))
+        self.assertIn('ValueError: boom', second['exception'])
+        self.assertNotIn('peer_id', third)
+
+
+class TestBotMetrics(unittest.TestCase):
+
+    def test_stages_and_endpoint(self):
+        metrics = bot_metrics.Metrics(buckets=(0.01, 1.0))
+        with metrics.timer('handler'):
+            pass
+        metrics.enable()
+        with bot_logging.log_fields(step='step4'):
+            with metrics.timer('route_formation'):
+                pass
+            with self.assertRaises(ValueError):
+                with metrics.timer('route_formation'):
+                    raise ValueError
+        metrics.observe(stage='messages.send', seconds=0.5, step='step1')
+
+        server = bot_metrics.MetricsServer(metrics=metrics, port=0)
+        server.start()
+        self.assertIsNone(server._server)
+
+        text = metrics.render()
+        self.assertNotIn('stage="handler"', text)
+        self.assertIn('bot_stage_seconds_bucket{stage="route_formation",step="step4",le="0.01"} 2', text)
+        self.assertIn('bot_stage_errors_total{stage="route_formation",step="step4"} 1', text)
+        self.assertIn('bot_stage_seconds_bucket{stage="messages.send",step="step1",le="0.01"} 0', text)
+        self.assertIn('bot_stage_seconds_bucket{stage="messages.send",step="step1",le="+Inf"} 1', text)
+        self.assertIn('bot_stage_seconds_count{stage="messages.send",step="step1"} 1', text)
+
+
+class TestEventDispatcher(unittest.TestCase):
+
+    @staticmethod
+    def make_event(peer_id, number):
+        event = Mock()
+        event.object.message = {'peer_id': peer_id, 'text': str(number)}
+        return event
+
+    def test_peer_order(self):
+        handled = []
+
+        def handler(event):
+            if event.object.message['peer_id'] == 1:
+                time.sleep(0.01)
+            handled.append((event.object.message['peer_id'], event.object.message['text']))
+
+        dispatcher = EventDispatcher(handler=handler, workers=3)
+        dispatcher.start()
+        for number in range(10):
+            for peer_id in (1, 2, 3):
+                dispatcher.submit(event=self.make_event(peer_id=peer_id, number=number))
+        dispatcher.stop()
+
+        for peer_id in (1, 2, 3):
+            peer_texts = [text for handled_peer_id, text in handled if handled_peer_id == peer_id]
+            self.assertEqual(peer_texts, [str(number) for number in range(10)])
+        stats = dispatcher.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(sum(worker['processed'] for worker in stats['workers']), 30)
+
+    def test_peerless_events_in_parallel(self):
+        # события без peer_id не ждут друг друга: оба обработчика должны встретиться у барьера
+        barrier = threading.Barrier(parties=2, timeout=5)
+        passed = []
+
+        def handler(event):
+            barrier.wait()
+            passed.append(event)
+
+        dispatcher = EventDispatcher(handler=handler, workers=2)
+        dispatcher.start()
+        for number in range(2):
+            dispatcher.submit(event=self.make_event(peer_id=None, number=number))
+        dispatcher.stop()
+
+        self.assertEqual(len(passed), 2)
+        self.assertEqual(dispatcher.stats()['peers_pending'], 0)
+
+
+class TestAvatarCache(unittest.TestCase):
+
+    def test_cache_and_placeholder(self):
+        with open(file='../files/ivan@yandex.ru.svg', mode='rb') as avatar_file:
+            avatar_mock = Mock()
+            avatar_mock.content = avatar_file.read()
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = AvatarCache(url=generate_ticket.AVATAR_URL, cache_dir=cache_dir)
+            with patch('requests.get', return_value=avatar_mock) as get_mock:
+                avatar = cache.get(email='ivan@yandex.ru')
+                self.assertEqual(cache.get(email='ivan@yandex.ru'), avatar)
+                self.assertEqual(get_mock.call_count, 1)
+
+            # новый процесс - аватарка берётся с диска
+            cache = AvatarCache(url=generate_ticket.AVATAR_URL, cache_dir=cache_dir)
+            with patch('requests.get', side_effect=ConnectionError) as get_mock:
+                self.assertEqual(cache.get(email='ivan@yandex.ru'), avatar)
+                get_mock.assert_not_called()
+                placeholder = cache.get(email='petr@yandex.ru')
+
+        self.assertEqual(placeholder, placeholder_avatar(email='petr@yandex.ru', size=cache.size))
+        self.assertEqual(cache.stats()['placeholders'], 1)
+
+
+class TestPhotoUploader(unittest.TestCase):
+
+    def test_upload_url_reuse_and_batch(self):
+        api = Mock()
+        api.photos.getMessagesUploadServer = Mock(return_value={'upload_url': 'https://upload.vk.com/'})
+        api.photos.saveMessagesPhoto = Mock(return_value=[{'owner_id': 1, 'id': 10}])
+        api.execute = Mock(return_value=[[{'owner_id': 1, 'id': 11}], [{'owner_id': 1, 'id': 12}]])
+        response_mock = Mock()
+        response_mock.json = Mock(return_value={'server': 1, 'photo': '[{"photo": "x"}]', 'hash': 'h'})
+
+        uploader = PhotoUploader()
+        with patch.object(uploader.session, 'post', return_value=response_mock) as post_mock:
+            self.assertEqual(uploader.upload(api=api, images=[BytesIO(b'1')]), ['photo1_10'])
+            self.assertEqual(uploader.upload(api=api, images=[BytesIO(b'2'), BytesIO(b'3')]),
+                             ['photo1_11', 'photo1_12'])
+
+        self.assertEqual(api.photos.getMessagesUploadServer.call_count, 1)
+        self.assertEqual(api.execute.call_count, 1)
+        self.assertEqual(post_mock.call_count, 3)
+
+    def test_multipart_body(self):
+        image = BytesIO(b'\xff\xd8' + b'x' * 100)
+        body = MultipartBody(field='photo', image=image)
+        data = b''.join(iter(lambda: body.read(7), b''))
+        body.close()
+        self.assertEqual(len(data), len(body))
+        self.assertIn(b'filename="image.jpg"\r\nContent-Type: image/jpeg\r\n\r\n\xff\xd8' + b'x' * 100, data)
+        self.assertTrue(body.content_type.endswith(data[2:34].decode()))
+        self.assertEqual(image_file_type(data=b'\x89PNG\r\n'), ('image.png', 'image/png'))
+
+
+class TestTicketEncoding(unittest.TestCase):
+
+    def test_profiles(self):
+        image = generate_ticket.Image.new('RGBA', (200, 100), (255, 255, 255, 255))
+        png, jpeg = BytesIO(), BytesIO()
+        generate_ticket.encode(image=image, output=png)
+        profile = generate_ticket.encode(image=image, output=jpeg, profile='jpeg-small')
+        self.assertEqual(profile.format, 'jpeg')
+        self.assertEqual(image_file_type(data=png.getbuffer()), ('image.png', 'image/png'))
+        self.assertEqual(image_file_type(data=jpeg.getbuffer()), ('image.jpg', 'image/jpeg'))
+        self.assertEqual(generate_ticket.Image.open(jpeg).size, (150, 75))
+
+    def test_text_layers(self):
+        renderer = generate_ticket.TicketRenderer(avatars=None, max_text_layers=2)
+        font_path = '../files/ofont.ru_Lifehack.ttf'
+        font = renderer.font(path=font_path, size=25)
+        for text in ('Москва', 'jq 05-12-2027', 'Москва', 'Лондон', ''):
+            expected = generate_ticket.Image.new('RGBA', (300, 60), (200, 220, 240, 255))
+            generate_ticket.ImageDraw.Draw(expected).text((15, 10), text, font=font, fill=generate_ticket.BLACK)
+            image = generate_ticket.Image.new('RGBA', (300, 60), (200, 220, 240, 255))
+            renderer.draw_text(base=image, offset=(15, 10), text=text, path=font_path, size=25)
+            self.assertEqual(image.tobytes(), expected.tobytes())
+
+        stats = renderer.cache_stats()
+        self.assertEqual((stats['text_hits'], stats['text_misses'], stats['text_layers']), (1, 4, 2))
+
+
+class TestSessionCache(unittest.TestCase):
+
+    def test_write_back(self):
+        cache = SessionCache(mode='batch', flush_batch=10)
+        self.assertIsNone(cache.get(user_id='test-session'))
+        self.assertEqual(cache.peek(user_id='test-session'), (True, None))
+
+        state = cache.create(user_id='test-session', scenario_name='order_ticket', step_name='step1', context={})
+        cache.commit(state=state)
+        state.step_name = 'step2'
+        state.context['name'] = 'иван'
+        cache.commit(state=state)
+        with db_session:
+            self.assertIsNone(UserState.get(user_id='test-session'))
+
+        self.assertEqual(cache.flush(), 1)
+        with db_session:
+            user_state = UserState.get(user_id='test-session')
+            self.assertEqual((user_state.step_name, user_state.context), ('step2', {'name': 'иван'}))
+
+        # в базу уходят только изменённые ключи
+        state.step_name = 'step3'
+        state.context['departure'] = 'Москва'
+        cache.commit(state=state)
+        stats = cache.stats()
+        self.assertEqual(cache.flush(), 1)
+        self.assertLess(cache.stats()['written_bytes'] - stats['written_bytes'],
+                        cache.stats()['context_bytes'] - stats['context_bytes'])
+        del state.context['name']
+        cache.commit(state=state)
+        cache.flush()
+        with db_session:
+            user_state = UserState.get(user_id='test-session')
+            self.assertEqual((user_state.step_name, user_state.context), ('step3', {'departure': 'Москва'}))
+
+        state.delete()
+        cache.commit(state=state)
+        cache.stop()
+        with db_session:
+            self.assertIsNone(UserState.get(user_id='test-session'))
+        self.assertEqual((cache.stats()['misses'], cache.stats()['commits']), (1, 5))
+
+    def test_on_complete_overflow(self):
+        backend = make_backend(kind='memory')
+        cache = SessionCache(mode='on_complete', max_items=2, backend=backend)
+        for user_id in ('test-1', 'test-2', 'test-3'):
+            cache.commit(state=cache.create(user_id=user_id, scenario_name='order_ticket', step_name='step1',
+                                            context={'name': user_id}))
+        # в памяти не больше max_items состояний, самое давнее записано в хранилище
+        self.assertEqual((cache.stats()['items'], cache.stats()['dirty']), (2, 2))
+        self.assertEqual(backend.load(user_id='test-1'), ('order_ticket', 'step1', {'name': 'test-1'}))
+        self.assertIsNone(backend.load(user_id='test-3'))
+        self.assertEqual(cache.get(user_id='test-1').context, {'name': 'test-1'})
+        cache.stop()
+
+    def test_backends(self):
+        with tempfile.TemporaryDirectory() as sqlite_dir:
+            for backend in (make_backend(kind='memory'),
+                            make_backend(kind='sqlite', sqlite_path=f'{sqlite_dir}/sessions.sqlite'),
+                            make_backend(kind='database')):
+                cache = SessionCache(mode='write_through', backend=backend)
+                state = cache.create(user_id='test-backend', scenario_name='order_ticket', step_name='step1',
+                                     context={'name': 'иван', 'date': '05-12-2027'})
+                cache.commit(state=state)
+                state.step_name = 'step2'
+                state.context['departure'] = 'Москва'
+                del state.context['date']
+                cache.commit(state=state)
+                self.assertEqual(backend.load(user_id='test-backend'),
+                                 ('order_ticket', 'step2', {'name': 'иван', 'departure': 'Москва'}))
+                # запись удалена в обход кэша - изменение ключей не теряет состояние
+                backend.write(writes={'test-backend': None})
+                state.step_name = 'step3'
+                state.context['arrival'] = 'Лондон'
+                cache.commit(state=state)
+                self.assertEqual(backend.load(user_id='test-backend'),
+                                 ('order_ticket', 'step3',
+                                  {'name': 'иван', 'departure': 'Москва', 'arrival': 'Лондон'}))
+                state.delete()
+                cache.commit(state=state)
+                self.assertIsNone(backend.load(user_id='test-backend'))
+                cache.stop()
+
+    def test_expire_idle(self):
+        backend = make_backend(kind='memory')
+        cache = SessionCache(mode='write_through', backend=backend)
+        states = [cache.create(user_id=user_id, scenario_name='order_ticket', step_name='step1', context={})
+                  for user_id in ('test-idle', 'test-active')]
+        for state in states:
+            cache.commit(state=state)
+        states[0].last_activity -= 3600
+        self.assertEqual(cache.expire_idle(ttl=60), ['test-idle'])
+        self.assertIsNone(backend.load(user_id='test-idle'))
+        self.assertIsNone(cache.get(user_id='test-idle'))
+        self.assertIsNotNone(cache.get(user_id='test-active'))
+
+        # состояние, которого нет в памяти, находится по времени активности в хранилище
+        notified = []
+        sweeper = SessionSweeper(sessions=SessionCache(mode='write_through', backend=backend), ttl=0, batch=1,
+                                 pause=0, notify=notified.append)
+        self.assertEqual(sweeper.sweep(), 1)
+        self.assertEqual(notified, ['test-active'])
+        self.assertIsNone(backend.load(user_id='test-active'))
+
+
+class TestSendQueue(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+        self.assertTrue(0 < bucket.take() <= 0.1)
+
+    def test_execute_batches(self):
+        api = Mock()
+        release = threading.Event()
+        api.messages.send.side_effect = lambda **values: release.wait() and 1
+        api.execute.side_effect = lambda code: [1] * code.count('API.')
+        queue = SendQueue(rate=1000, workers=1)
+        queue.start()
+        futures = [queue.submit(api, 'messages.send', peer_id=0, message='0')]
+        while not api.messages.send.called:
+            time.sleep(0.001)
+        futures += [queue.submit(api, 'messages.send', peer_id=number % 3, message=str(number))
+                    for number in range(1, 31)]
+        release.set()
+        self.assertEqual([future.result(timeout=5) for future in futures], [1] * 31)
+        queue.stop()
+
+        # вызовы, накопившиеся за время первого запроса, ушли двумя execute, по порядку
+        codes = [call[1]['code'] for call in api.execute.call_args_list]
+        self.assertEqual([code.count('API.') for code in codes], [25, 5])
+        messages = [int(message) for message in re.findall(r'"message": "(\d+)"', ''.join(codes))]
+        self.assertEqual(messages, list(range(1, 31)))
+        self.assertEqual(queue.stats()['requests'], 3)
+
+    def test_retry(self):
+        api = Mock()
+        flood = ApiError(None, 'messages.send', {}, {}, {'error_code': 6, 'error_msg': 'Too many requests per second'})
+        denied = ApiError(None, 'messages.send', {}, {}, {'error_code': 901, 'error_msg': 'Can\'t send messages'})
+        quota = ApiError(None, 'messages.send', {}, {}, {'error_code': 9, 'error_msg': 'Flood control'})
+        api.messages.send.side_effect = [flood, 1, denied, quota]
+        queue = SendQueue(retry=RetryPolicy(attempts=3, base_delay=0))
+        self.assertEqual(queue.call(api, 'messages.send', peer_id=1, random_id=random_id(1, 68, 0)), 1)
+        with self.assertRaises(ApiError):
+            queue.call(api, 'messages.send', peer_id=1, random_id=random_id(1, 68, 1))
+        # повтор идёт с тем же random_id
+        self.assertEqual(api.messages.send.call_args_list[0], api.messages.send.call_args_list[1])
+        stats = queue.stats()
+        self.assertEqual((stats['retries'], stats['sent'], stats['failed']), (1, 1, 1))
+        self.assertEqual((stats['errors']['flood'], stats['errors']['other']), (1, 1))
+        # flood control одинаковых сообщений не повторяется
+        with self.assertRaises(ApiError):
+            queue.call(api, 'messages.send', peer_id=1, random_id=random_id(1, 68, 2))
+        self.assertEqual((queue.stats()['retries'], queue.stats()['errors']['quota']), (1, 1))
+
+    def test_reply_ids(self):
+        reply_ids = ReplyIds()
+        reply_ids.begin(peer_id=1, message_id=68)
+        first = [reply_ids.next(peer_id=1), reply_ids.next(peer_id=1)]
+        reply_ids.begin(peer_id=1, message_id=68)
+        self.assertEqual([reply_ids.next(peer_id=1), reply_ids.next(peer_id=1)], first)
+        self.assertNotEqual(first[0], first[1])
+        self.assertNotEqual(random_id(peer_id=2, message_id=68, part=0), first[0])
+        self.assertTrue(all(0 < random_id(peer_id=1, message_id=68, part=part) < 2 ** 31 for part in range(1000)))
+        # отложенная картинка не сдвигает номера остальных ответов
+        reply_ids.begin(peer_id=1, message_id=68)
+        image = reply_ids.named(peer_id=1, name='image')
+        self.assertEqual(image, random_id(peer_id=1, message_id=68, part='image'))
+        self.assertEqual(reply_ids.next(peer_id=1), first[0])
+
+
+class TestAttachmentCache(unittest.TestCase):
+
+    CONTEXT = {'phone': '+7-812-124-12-24', 'email': 'ivan@yandex.ru', 'name': 'Иван', 'departure': 'Москва',
+               'arrival': 'Лондон', 'flight': '05-12-2027 10:00', 'spaces': '1', 'comment': 'нет'}
+
+    def test_keys_and_eviction(self):
+        key = image_key(image_handler='handle_generate_ticket', context=self.CONTEXT)
+        self.assertEqual(image_key(image_handler='handle_generate_ticket', context=dict(self.CONTEXT, comment='да')),
+                         key)
+        other_key = image_key(image_handler='handle_generate_ticket', context=dict(self.CONTEXT, spaces='2'))
+        self.assertNotEqual(other_key, key)
+        self.assertIsNone(image_key(image_handler='handle_name', context=self.CONTEXT))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = AttachmentCache(path=f'{cache_dir}/attachments.sqlite', max_items=2)
+            cache.put(key=key, attachment='photo1_1')
+            cache.put(key=other_key, attachment='photo1_2')
+            self.assertEqual(cache.get(key=key), 'photo1_1')
+            cache.put(key='third', attachment='photo1_3')
+            cache.close()
+
+            # кэш переживает перезапуск, вытеснено давно не использованное вложение
+            cache = AttachmentCache(path=f'{cache_dir}/attachments.sqlite', max_items=2)
+            self.assertEqual([cache.get(key=key), cache.get(key=other_key), cache.get(key='third')],
+                             ['photo1_1', None, 'photo1_3'])
+            self.assertEqual(cache.stats()['items'], 2)
+            cache.close()
+
+
+class TestRegistrationMigration(unittest.TestCase):
+
+    OLD_TABLE = ('CREATE TABLE "Registration" ("id" INTEGER PRIMARY KEY AUTOINCREMENT, '
+                 '"user_phone" TEXT UNIQUE NOT NULL, "user_email" TEXT NOT NULL, "user_name" TEXT NOT NULL, '
+                 '"departure" TEXT NOT NULL, '
+                 '"arrival" TEXT NOT NULL, "date" TEXT NOT NULL, "spaces" TEXT NOT NULL, "comment" TEXT NOT NULL)')
+
+    def test_sqlite_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'old.sqlite')
+            connection = sqlite3.connect(filename)
+            connection.execute(self.OLD_TABLE)
+            connection.executemany('INSERT INTO "Registration" VALUES (?, ?, \'e\', \'n\', \'a\', \'b\', ?, ?, \'-\')',
+                                   [(1, '+7-1', '05-12-2027 10:00', '2'), (2, '+7-2', '06-12-2027 11:30', '1')])
+            # прерванный запуск старой версии скрипта: таблица переименована, новая создана pony и уже пополнялась
+            connection.execute('ALTER TABLE "Registration" RENAME TO "Registration_old"')
+            connection.execute(migrate_registration.SQLITE_TABLE)
+            connection.execute('INSERT INTO "Registration" VALUES (1, \'+7-9\', \'e\', \'n\', \'a\', \'b\', '
+                               '\'2027-12-01 00:00:00.000000\', 1, \'-\')')
+            connection.commit()
+            connection.close()
+
+            self.assertTrue(migrate_registration.migrate_sqlite(filename=filename))
+            self.assertFalse(migrate_registration.migrate_sqlite(filename=filename))
+            connection = sqlite3.connect(filename)
+            rows = connection.execute('SELECT "id", "user_phone", "date", "spaces" FROM "Registration" '
+                                      'ORDER BY "id"').fetchall()
+            tables = {name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            connection.close()
+        self.assertEqual(rows, [(1, '+7-9', '2027-12-01 00:00:00.000000', 1),
+                                (2, '+7-2', '2027-12-06 11:30:00.000000', 1),
+                                (3, '+7-1', '2027-12-05 10:00:00.000000', 2)])
+        self.assertNotIn('Registration_old', tables)
+
+
+class TestRegistrationWriter(unittest.TestCase):
+
+    ORDER = {'user_phone': '+70000000001', 'user_email': 'test@test.ru', 'user_name': 'Иван', 'departure': 'Москва',
+             'arrival': 'Лондон', 'date': '05-12-2027 10:00', 'spaces': '1', 'comment': 'нет'}
+
+    def test_spool_and_conflicts(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            spool_path = f'{spool_dir}/registrations.spool'
+            writer = RegistrationWriter(spool_path=spool_path, flush_batch=10)
+            writer.submit(order=self.ORDER)
+            writer.submit(order=self.ORDER)
+            with open(spool_path, encoding='utf-8') as spool:
+                self.assertEqual(len(spool.readlines()), 2)
+
+            # заявки из спула не потеряны, если процесс упал до записи в базу
+            writer = RegistrationWriter(spool_path=spool_path, flush_interval=60)
+            writer.start()
+            writer.stop()
+            with open(spool_path, encoding='utf-8') as spool:
+                self.assertEqual(spool.read(), '')
+            registration = find_by_phone(phone=self.ORDER['user_phone'])
+            self.assertEqual((registration['date'], registration['spaces']), (datetime(2027, 12, 5, 10, 0), 1))
+            with db_session:
+                Registration.get(user_phone=self.ORDER['user_phone']).delete()
+
+            stats = writer.stats()
+            self.assertEqual((stats['recovered'], stats['written'], stats['conflicts']), (2, 1, 1))
+
+    def test_rejected_order(self):
+        bad_order = dict(self.ORDER, user_phone='+70000000002', date='5 декабря')
+        with tempfile.TemporaryDirectory() as spool_dir:
+            spool_path = f'{spool_dir}/registrations.spool'
+            with open(spool_path, 'w', encoding='utf-8') as spool:
+                spool.write(json.dumps(bad_order) + '\n')
+            writer = RegistrationWriter(spool_path=spool_path, flush_interval=60)
+            writer.start()
+            writer.submit(order=dict(bad_order, date='05-12-2027 10:00', spaces='два'))
+            writer.submit(order=self.ORDER)
+            writer.stop()
+            with open(writer.rejected_path, encoding='utf-8') as rejected:
+                self.assertEqual(len(rejected.readlines()), 2)
+            self.assertIsNotNone(find_by_phone(phone=self.ORDER['user_phone']))
+            with db_session:
+                Registration.get(user_phone=self.ORDER['user_phone']).delete()
+            self.assertEqual((writer.stats()['rejected'], writer.stats()['written']), (2, 1))
+
+
+class TestRegistrationQueries(unittest.TestCase):
+
+    @isolate_db
+    def test_keyset_pages(self):
+        for number in range(5):
+            Registration(user_phone=f'+7000000010{number}', user_email='test@test.ru', user_name='Иван',
+                         departure='Рим', arrival='Токио', date=datetime(2027, 12, 5 - number % 2, 10, 0),
+                         spaces=1, comment='нет')
+        page = find_by_email(email='test@test.ru', limit=3)
+        self.assertEqual(len(page.items), 3)
+        next_page = find_by_email(email='test@test.ru', after=page.next_cursor, limit=3)
+        self.assertEqual((len(next_page.items), next_page.next_cursor), (2, None))
+
+        dates, cursor = [], None
+        while True:
+            page = find_by_route(departure='Рим', arrival='Токио', date_from=datetime(2027, 12, 1), after=cursor,
+                                 limit=2)
+            dates.extend(item['date'].day for item in page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(dates, [4, 4, 5, 5, 5])
+
+
+class TestScenarioCompiler(unittest.TestCase):
+
+    def test_compile(self):
+        scenarios = compile_scenarios(scenarios=settings.SCENARIOS, handlers_module=handlers, actions=Bot.STEP_ACTIONS)
+        step = scenarios['order_ticket'].steps['step8']
+        self.assertIs(step.handler, handlers.handle_confirmation)
+        self.assertEqual(step.action, 'confirm_order')
+        self.assertEqual(step.text_fields, {'name', 'departure', 'arrival', 'flight_date_to_output', 'spaces'})
+
+    def test_constants(self):
+        scenarios = compile_scenarios(scenarios=settings.SCENARIOS, handlers_module=handlers, actions=Bot.STEP_ACTIONS,
+                                      constants=handlers.TEMPLATE_CONSTANTS)
+        step = scenarios['order_ticket'].steps['step2']
+        self.assertEqual(step.failure_fields, frozenset())
+        self.assertIn('Санкт-Петербург\n', step.render_failure(context={}))
+        self.assertEqual(handlers.find_city(text='из санкт-петербурга'), 'Санкт-Петербург')
+        self.assertIsNone(handlers.find_city(text='лондонский'))
+
+    def test_broken_config(self):
+        scenarios = deepcopy(settings.SCENARIOS)
+        scenarios['order_ticket']['steps']['step9']['next_step'] = 'step100'
+        with self.assertRaises(ScenarioConfigError):
+            compile_scenarios(scenarios=scenarios, handlers_module=handlers, actions=Bot.STEP_ACTIONS)
+
+        scenarios = deepcopy(settings.SCENARIOS)
+        scenarios['order_ticket']['steps']['step9']['handler'] = 'handle_nothing'
+        with self.assertRaises(ScenarioConfigError):
+            compile_scenarios(scenarios=scenarios, handlers_module=handlers, actions=Bot.STEP_ACTIONS)
+
+        scenarios = deepcopy(settings.SCENARIOS)
+        del scenarios['order_ticket']['steps']['step0']['action']
+        with self.assertRaises(ScenarioConfigError):
+            compile_scenarios(scenarios=scenarios, handlers_module=handlers, actions=Bot.STEP_ACTIONS)
+
+        scenarios = deepcopy(settings.SCENARIOS)
+        del scenarios['order_ticket']['pause_step']
+        with self.assertRaises(ScenarioConfigError):
+            compile_scenarios(scenarios=scenarios, handlers_module=handlers, actions=Bot.STEP_ACTIONS)
+
+    def test_missing_settings(self):
+        self.assertEqual(missing_settings(settings_module=settings), [])
+        old_settings = SimpleNamespace(**{name: getattr(settings, name) for name in dir(settings)
+                                          if name != 'SESSION_TTL'})
+        self.assertEqual(missing_settings(settings_module=old_settings), ['SESSION_TTL'])
+
+
+class TestIntentMatcher(unittest.TestCase):
+
+    def test_priority(self):
+        matcher = IntentMatcher(intents=settings.INTENTS)
+        self.assertIs(matcher.match(text='Спасибо, пока!'), settings.INTENTS[1])
+        self.assertIs(matcher.match(text='пока, привет'), settings.INTENTS[0])
+        self.assertIs(matcher.match(text='/TICKET'), settings.INTENTS[3])
+        self.assertIsNone(matcher.match(text='ПРОВЕРКА'))
+
+        intents = [{'name': 'a', 'tokens': ['bcd']}, {'name': 'b', 'tokens': ['abc', 'c']}]
+        matcher = IntentMatcher(intents=intents)
+        self.assertIs(matcher.match(text='xabcd'), intents[0])
+        self.assertIs(matcher.match(text='xabce'), intents[1])
+
+
+class TestTimetableIndex(unittest.TestCase):
+
+    def test_next_flights(self):
+        regular_flights = {('Москва', 'Лондон'): {'week_days': (0, 2), 'hour': 10, 'minute': 0}}
+        timetable = TimetableIndex(route_table={'Москва': ['Лондон']}, random_per_month=0,
+                                   regular_flights=regular_flights)
+        start = datetime.today()
+        flights = timetable.next_flights(departure='Москва', arrival='Лондон', date=start, count=5)
+        flights = list(flights.astype(datetime))
+        self.assertEqual(len(flights), 5)
+        self.assertEqual(flights, sorted(flights))
+        for flight in flights:
+            self.assertGreaterEqual(flight, start)
+            self.assertIn(flight.weekday(), (0, 2))
+            self.assertEqual((flight.hour, flight.minute), (10, 0))
+
+        first = TimetableIndex(route_table={'Рим': ['Токио']}, regular_flights={}, seed=1)
+        second = TimetableIndex(route_table={'Рим': ['Токио']}, regular_flights={}, seed=1)
+        self.assertEqual(list(first.next_flights(departure='Рим', arrival='Токио', date=start)),
+                         list(second.next_flights(departure='Рим', arrival='Токио', date=start)))
+        self.assertEqual(len(first.next_flights(departure='Рим', arrival='Токио', date=start, count=30)), 30)
+
+    def test_horizon_end_and_route_seeds(self):
+        timetable = TimetableIndex(route_table={'Москва': ['Лондон', 'Рим']}, regular_flights={}, horizon_days=40)
+        schedule, _, end = timetable.schedule()
+        near_end = end - timedelta(days=1)
+        for arrival in ('Лондон', 'Рим'):
+            flights = timetable.next_flights(departure='Москва', arrival=arrival, date=near_end, count=5)
+            self.assertEqual(len(flights), 5)
+            self.assertTrue((flights >= np.datetime64(near_end, 'm')).all())
+            # рейсы за пределами индекса и в индексе строятся одинаково
+            in_index = schedule[('Москва', arrival)]
+            self.assertEqual(list(flights[flights < np.datetime64(end, 'm')]),
+                             list(in_index[in_index >= np.datetime64(near_end, 'm')]))
+
+        later = end + timedelta(days=100)
+        self.assertNotEqual(list(timetable.next_flights(departure='Москва', arrival='Лондон', date=later)),
+                            list(timetable.next_flights(departure='Москва', arrival='Рим', date=later)))
+
+
+class TestRouteGraph(unittest.TestCase):
+
+    def test_itinerary(self):
+        graph = RouteGraph(route_table={'A': ['B'], 'B': ['C', 'A'], 'C': ['D'], 'D': ['E']})
+        self.assertTrue(graph.has_route(departure='A', arrival='B'))
+        self.assertFalse(graph.has_route(departure='A', arrival='C'))
+        self.assertFalse(graph.has_route(departure='X', arrival='A'))
+        self.assertEqual(graph.itinerary(departure='A', arrival='C'), ['A', 'B', 'C'])
+        self.assertEqual(graph.itinerary(departure='A', arrival='D'), ['A', 'B', 'C', 'D'])
+        self.assertIsNone(graph.itinerary(departure='A', arrival='E'))
+        self.assertIsNone(graph.itinerary(departure='E', arrival='A'))
+
+        graph = RouteGraph(route_table={'A': ['B'], 'B': ['C'], 'C': ['D']}, max_stops=1)
+        self.assertEqual(graph.itinerary(departure='A', arrival='C'), ['A', 'B', 'C'])
+        self.assertIsNone(graph.itinerary(departure='A', arrival='D'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Кэш вложений VK для одинаковых картинок шагов сценария (билетов)
+Билет зависит только от полей контекста, которые рисует его handler (handlers.IMAGE_CACHE_FIELDS), поэтому
+однажды загруженная в VK картинка ('photo{owner_id}_{media_id}') отправляется повторно одним messages.send,
+без рисования и загрузки. Ключ - sha256 названия handler'а и этих полей.
+Вложения хранятся во встроенной базе SQLite (переживают перезапуск бота), не больше max_items:
+при переполнении удаляются давно не использованные.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import handlers
+
+
+def image_key(image_handler, context):
+    """
+    Ключ картинки в кэше
+    :param image_handler: название handler'а картинки из модуля handlers
+    :param context: контекст работы с пользователем
+    :return: sha256 в hex, или None, если картинки этого handler'а не кэшируются
+    """
+    fields = handlers.IMAGE_CACHE_FIELDS.get(image_handler)
+    if fields is None:
+        return None
+    values = [image_handler] + [context.get(field) for field in fields]
+    return hashlib.sha256(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class AttachmentCache:
+
+    """
+    Вложения VK по ключу картинки, в SQLite с вытеснением давно не использованных
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS "attachment" ('
+              '"key" TEXT PRIMARY KEY, "attachment" TEXT NOT NULL, "used" REAL NOT NULL)')
+    INDEX = 'CREATE INDEX IF NOT EXISTS "idx_attachment__used" ON "attachment" ("used")'
+
+    def __init__(self, path, max_items=10000):
+        """
+        :param path: файл базы данных
+        :param max_items: максимальное количество вложений
+        """
+        self.path = path
+        self.max_items = max_items
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(self.SCHEMA)
+        self._connection.execute(self.INDEX)
+        self._count = self._connection.execute('SELECT COUNT(*) FROM "attachment"').fetchone()[0]
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+    def get(self, key):
+        """
+        :param key: ключ картинки (image_key)
+        :return: строка вложения, или None, если картинки нет в кэше
+        """
+        if key is None:
+            return None
+        with self._lock:
+            row = self._connection.execute('SELECT "attachment" FROM "attachment" WHERE "key" = ?', (key,)).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            self._connection.execute('UPDATE "attachment" SET "used" = ? WHERE "key" = ?', (time.time(), key))
+            self._stats['hits'] += 1
+        return row[0]
+
+    def put(self, key, attachment):
+        """
+        Запоминание вложения (при переполнении удаляются давно не использованные)
+        :param key: ключ картинки (image_key)
+        :param attachment: строка вложения 'photo{owner_id}_{media_id}'
+        :return: None
+        """
+        if key is None:
+            return
+        with self._lock:
+            connection = self._connection
+            connection.execute('BEGIN')
+            try:
+                known = connection.execute('SELECT 1 FROM "attachment" WHERE "key" = ?', (key,)).fetchone()
+                connection.execute('INSERT OR REPLACE INTO "attachment" VALUES (?, ?, ?)',
+                                   (key, attachment, time.time()))
+                count = self._count + (known is None)
+                if count > self.max_items:
+                    evicted = connection.execute('DELETE FROM "attachment" WHERE "key" IN (SELECT "key" FROM '
+                                                 '"attachment" ORDER BY "used" LIMIT ?)',
+                                                 (count - self.max_items,)).rowcount
+                    count -= evicted
+                    self._stats['evicted'] += evicted
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            self._count = count
+            self._stats['stored'] += 1
+
+    def discard(self, key):
+        """
+        Удаление вложения, которое VK больше не принимает
+        :param key: ключ картинки (image_key)
+        :return: None
+        """
+        if key is None:
+            return
+        with self._lock:
+            self._count -= self._connection.execute('DELETE FROM "attachment" WHERE "key" = ?', (key,)).rowcount
+
+    def stats(self):
+        """
+        Статистика кэша
+        :return: dict {hits, misses, stored, evicted, items}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['items'] = self._count
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Пул процессов для рисования картинок шагов сценария (билетов)
+Рисование билета нагружает процессор (jpeg, шрифты, svg, png), поэтому выполняется в отдельных процессах
+и не останавливает обработку сообщений.
+Картинка, не нарисованная за timeout, отменяется, а если процесс уже рисует её (и, возможно, завис), пул процессов
+пересоздаётся: старый пул перестаёт принимать картинки, а его процессы завершаются ещё через timeout секунд.
+"""
+
+import contextvars
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import weakref
+
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import generate_ticket
+import handlers
+from bot_logging import current_log_fields, log_fields
+from bot_metrics import metrics
+
+
+log = logging.getLogger(name='air_ticket_bot')
+
+
+def preload_renderer(metrics_queue=None, pids=None):
+    """
+    Загрузка шаблона и шрифта билета при старте процесса пула
+    :param metrics_queue: очередь для измерений этого процесса (bot_metrics), None - без метрик
+    :param pids: очередь, в которую процесс сообщает свой pid (чтобы пул мог его остановить)
+    """
+    if pids is not None:
+        pids.put(os.getpid())
+    metrics.forward_to(metrics_queue)
+    try:
+        generate_ticket.renderer.preload()
+    except Exception:
+        log.exception('Шаблон билета не загружен заранее')
+
+
+def render_image(image_handler, text, context, step=None):
+    """
+    Рисование картинки в процессе пула (этап метрик 'generate_ticket')
+    :param image_handler: название handler'а картинки из модуля handlers (например 'handle_generate_ticket')
+    :param text: текст сообщения пользователя
+    :param context: контекст работы с пользователем (dict)
+    :param step: шаг сценария для метрик, по умолчанию - шаг текущего события
+    :return: картинка в байтах
+    """
+    handler = getattr(handlers, image_handler)
+    with log_fields(step=step or current_log_fields().get('step')), metrics.timer('generate_ticket'):
+        image = handler(text=text, context=context)
+    return image.getvalue()
+
+
+class TicketRenderPool:
+
+    """
+    Ограниченный пул процессов для рисования картинок
+    Если workers == 0, картинка рисуется в вызывающем потоке.
+    """
+
+    def __init__(self, workers=2, timeout=30):
+        """
+        :param workers: количество процессов
+        :param timeout: максимальное время рисования одной картинки, сек
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self._processes = None
+        self._waiters = None
+        self._owners = weakref.WeakKeyDictionary()  # future: пул процессов, в котором рисуется картинка
+        self._pids = weakref.WeakKeyDictionary()  # пул процессов: очередь pid его процессов
+        self._lock = threading.Lock()
+
+    def submit(self, image_handler, text, context):
+        """
+        Постановка картинки в очередь на рисование
+        :param image_handler: название handler'а картинки из модуля handlers
+        :param text: текст сообщения пользователя
+        :param context: контекст работы с пользователем
+        :return: concurrent.futures.Future, результат - картинка в байтах
+        """
+        step = current_log_fields().get('step')
+        with self._lock:
+            if self._processes is None:
+                self._processes = self._start_processes()
+            try:
+                future = self._processes.submit(render_image, image_handler, text, dict(context), step)
+            except BrokenProcessPool:
+                # один из процессов упал - пул пересоздаётся
+                log.warning('Пул рисования картинок пересоздан')
+                self._processes = self._start_processes()
+                future = self._processes.submit(render_image, image_handler, text, dict(context), step)
+            self._owners[future] = self._processes
+        return future
+
+    def timed_out(self, future, image_handler):
+        """
+        Картинка не нарисована за timeout
+        Картинка, ожидающая в очереди, отменяется. Процесс, который её рисует, через future не остановить,
+        поэтому пул пересоздаётся, а старые процессы завершаются через timeout секунд (_retire).
+        :param future: concurrent.futures.Future из submit
+        :param image_handler: название handler'а картинки (для лога)
+        :return: None
+        """
+        log.error('Картинка %s не нарисована за %s сек', image_handler, self.timeout)
+        if future.cancel() or future.done():
+            return
+        with self._lock:
+            processes = self._owners.pop(future, None)
+            if processes is None or processes is not self._processes:
+                # пул уже пересоздан
+                return
+            self._processes = self._start_processes()
+        log.warning('Пул рисования картинок пересоздан, процессы старого пула будут остановлены через %s сек',
+                    self.timeout)
+        threading.Thread(target=self._retire, args=(processes,), name='ticket-pool-retire', daemon=True).start()
+
+    def _retire(self, processes):
+        """
+        Остановка старого пула: остальные картинки дорисовываются не дольше timeout, затем процессы завершаются
+        """
+        pids = set()
+        pid_queue = self._pids.pop(processes, None)
+        processes.shutdown(wait=False)
+        time.sleep(self.timeout)
+        # у ProcessPoolExecutor нет открытого способа остановить занятый процесс - процессы находятся по pid,
+        # которые они сообщили при старте, среди ещё работающих дочерних процессов
+        while pid_queue is not None:
+            try:
+                pids.add(pid_queue.get_nowait())
+            except (queue.Empty, OSError, ValueError):
+                break
+        for process in multiprocessing.active_children():
+            if process.pid in pids:
+                process.terminate()
+
+    def _start_processes(self):
+        """
+        Новый пул процессов (вызывается под блокировкой)
+        """
+        pid_queue = multiprocessing.Queue()
+        processes = ProcessPoolExecutor(max_workers=self.workers, initializer=preload_renderer,
+                                        initargs=(metrics.process_queue(), pid_queue))
+        self._pids[processes] = pid_queue
+        return processes
+
+    def render(self, image_handler, text, context):
+        """
+        Рисование картинки с ожиданием результата (не дольше timeout)
+        :param image_handler: название handler'а картинки из модуля handlers
+        :param text: текст сообщения пользователя
+        :param context: контекст работы с пользователем
+        :return: картинка (file-like object)
+        """
+        if not self.workers:
+            return BytesIO(render_image(image_handler=image_handler, text=text, context=dict(context)))
+        future = self.submit(image_handler=image_handler, text=text, context=context)
+        try:
+            return BytesIO(future.result(timeout=self.timeout))
+        except FutureTimeoutError:
+            self.timed_out(future=future, image_handler=image_handler)
+            raise
+
+    def deliver(self, image_handler, text, context, callback):
+        """
+        Рисование картинки и передача её в callback, когда она готова
+        Ошибка рисования или отправки записывается в лог и не прерывает шаг сценария.
+        :param image_handler: название handler'а картинки из модуля handlers
+        :param text: текст сообщения пользователя
+        :param context: контекст работы с пользователем
+        :param callback: функция, получающая готовую картинку (file-like object)
+        :return: None
+        """
+        context = dict(context)
+        if not self.workers:
+            self._deliver(image_handler=image_handler, text=text, context=context, callback=callback, future=None)
+            return
+
+        # время ожидания отсчитывается от постановки картинки, а не от того, когда её начал ждать поток доставки
+        deadline = time.monotonic() + self.timeout
+        future = self.submit(image_handler=image_handler, text=text, context=context)
+        with self._lock:
+            if self._waiters is None:
+                self._waiters = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ticket-delivery')
+            # callback выполняется с полями события (bot_logging) того потока, который поставил картинку
+            self._waiters.submit(contextvars.copy_context().run, self._deliver, image_handler, text, context, callback,
+                                 future, deadline)
+
+    def _deliver(self, image_handler, text, context, callback, future, deadline=None):
+        """
+        Ожидание картинки (до deadline по time.monotonic) и вызов callback
+        """
+        try:
+            if future is None:
+                image = render_image(image_handler=image_handler, text=text, context=context)
+            else:
+                image = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            callback(BytesIO(image))
+        except FutureTimeoutError:
+            self.timed_out(future=future, image_handler=image_handler)
+        except Exception:
+            log.exception('ОШИБКА ПРИ РИСОВАНИИ КАРТИНКИ %s', image_handler)
+
+    def shutdown(self, wait=True):
+        """
+        Остановка пула
+        :param wait: дождаться ли рисования и отправки уже поставленных в очередь картинок
+        """
+        with self._lock:
+            waiters, self._waiters = self._waiters, None
+            processes, self._processes = self._processes, None
+        if waiters is not None:
+            waiters.shutdown(wait=wait)
+        if processes is not None:
+            processes.shutdown(wait=wait)
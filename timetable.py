@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+Use python3.8
+
+Индекс расписания рейсов
+Расписание всех маршрутов строится одним векторным проходом NumPy (массивы datetime64, маски (маршрут, день)
+по дням недели и числам месяца) на horizon_days дней вперёд и хранится отсортированными массивами datetime64[m],
+поиск ближайших рейсов - двоичным поиском (numpy.searchsorted).
+Случайные рейсы получаются из хеша (зерно, маршрут, месяц, номер рейса), поэтому один и тот же запрос
+всегда даёт один и тот же ответ, в том числе после перезапуска бота, перестроения индекса или построения
+рейсов за пределами индекса (пока не изменено зерно).
+Расписание строится при старте бота (build_all), новое расписание месяца строится без блокировки чтения:
+пока оно строится, запросы получают прежнее.
+"""
+
+import threading
+import zlib
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+MINUTES_IN_DAY = 24 * 60
+EXTRA_WINDOW_DAYS = 62  # промежуток, на который расписание достраивается за пределами индекса
+EXTRA_WINDOWS = 6  # сколько промежутков достраивается, пока не наберётся нужное количество рейсов
+
+
+def route_list(route_table):
+    """
+    Все маршруты таблицы в постоянном порядке
+    :param route_table: таблица маршрутов {город отправления: [город назначения, ...]}
+    :return: list[(откуда, куда), ...]
+    """
+    return sorted((departure, arrival) for departure, arrivals in route_table.items() for arrival in arrivals)
+
+
+def route_seed(route):
+    """
+    Постоянная часть зерна случайных рейсов маршрута
+    :param route: (откуда, куда)
+    :return: int
+    """
+    return zlib.crc32('\n'.join(route).encode('utf-8'))
+
+
+def mix64(values):
+    """
+    Перемешивание битов 64-битных чисел (финализатор splitmix64), поэлементно
+    :param values: numpy.ndarray uint64
+    :return: numpy.ndarray uint64
+    """
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def random_values(seed, route_seeds, months, count):
+    """
+    Случайные числа [0, 1) для каждого маршрута, месяца и номера числа - одним векторным проходом
+    Число зависит только от (seed, маршрут, месяц, номер), а не от того, какие ещё маршруты и месяцы строятся.
+    :param seed: зерно генерации
+    :param route_seeds: numpy.ndarray uint64 - route_seed маршрутов
+    :param months: numpy.ndarray datetime64[M]
+    :param count: количество чисел на маршрут и месяц
+    :return: numpy.ndarray float64 формы (маршруты, месяцы, count)
+    """
+    keys = mix64(route_seeds ^ mix64(np.array([seed % 2 ** 64], dtype=np.uint64)))[:, None, None]
+    keys = mix64(keys ^ (months.astype(np.int64).astype(np.uint64) * np.uint64(0xD1B54A32D192ED03))[None, :, None])
+    bits = mix64(keys + np.arange(1, count + 1, dtype=np.uint64)[None, None, :] * np.uint64(0x9E3779B97F4A7C15))
+    return (bits >> np.uint64(11)).astype(np.float64) / 2 ** 53
+
+
+def generate_schedule(routes, regular_flights, start, end, random_per_month=13, seed=0):
+    """
+    Расписание маршрутов за промежуток [start, end)
+    :param routes: list[(откуда, куда), ...]
+    :param regular_flights: регулярные рейсы {(откуда, куда): {'week_days' или 'month_days', 'hour', 'minute'}}
+    :param start: datetime object
+    :param end: datetime object
+    :param random_per_month: количество случайных рейсов маршрута в месяц
+    :param seed: зерно генерации случайных рейсов
+    :return: dict {(откуда, куда): отсортированный numpy.ndarray datetime64[m], ...}
+    """
+    start = np.datetime64(start, 'm')
+    end = np.datetime64(end, 'm')
+
+    # случайные рейсы всех маршрутов и месяцев: день и минута каждого рейса - из чисел (seed, маршрут, месяц, номер),
+    # поэтому рейсы маршрута не зависят от того, какие ещё маршруты и месяцы строятся
+    months = np.arange(start.astype('datetime64[M]'), end.astype('datetime64[M]') + 1)
+    month_days = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    route_seeds = np.array([route_seed(route=route) for route in routes], dtype=np.uint64)
+    values = random_values(seed=seed, route_seeds=route_seeds, months=months, count=2 * random_per_month)
+    days = (values[:, :, :random_per_month] * month_days[None, :, None]).astype(np.int64)
+    minutes = (values[:, :, random_per_month:] * MINUTES_IN_DAY).astype(np.int64)
+    random_flights = months.astype('datetime64[m]')[None, :, None] \
+        + (days * MINUTES_IN_DAY + minutes).astype('timedelta64[m]')
+    flight_routes = [np.repeat(np.arange(len(routes)), len(months) * random_per_month)]
+    flights = [random_flights.reshape(-1)]
+
+    # регулярные рейсы: маски (маршрут, день) по дням недели и числам месяца
+    regular_routes = [number for number, route in enumerate(routes) if route in regular_flights]
+    if regular_routes:
+        days = np.arange(start.astype('datetime64[D]'), end.astype('datetime64[D]') + 1)
+        week_days = (days.astype(np.int64) + 3) % 7  # 01-01-1970 - четверг, понедельник - 0
+        day_numbers = (days - days.astype('datetime64[M]').astype('datetime64[D]')).astype(np.int64)
+        week_table = np.zeros((len(regular_routes), 7), dtype=bool)
+        month_table = np.zeros((len(regular_routes), 31), dtype=bool)
+        offsets = np.empty(len(regular_routes), dtype=np.int64)
+        for row, number in enumerate(regular_routes):
+            regular = regular_flights[routes[number]]
+            week_table[row, list(regular.get('week_days', ()))] = True
+            month_table[row, [day - 1 for day in regular.get('month_days', ())]] = True
+            offsets[row] = regular['hour'] * 60 + regular['minute']
+        rows, day_indexes = np.nonzero(week_table[:, week_days] | month_table[:, day_numbers])
+        flight_routes.append(np.array(regular_routes, dtype=np.int64)[rows])
+        flights.append(days[day_indexes].astype('datetime64[m]') + offsets[rows].astype('timedelta64[m]'))
+
+    flight_routes = np.concatenate(flight_routes)
+    flights = np.concatenate(flights)
+    inside = (flights >= start) & (flights < end)
+    flight_routes, flights = flight_routes[inside], flights[inside]
+    order = np.lexsort((flights, flight_routes))
+    flights = flights[order]
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(flight_routes, minlength=len(routes)))))
+    return {route: flights[bounds[number]:bounds[number + 1]] for number, route in enumerate(routes)}
+
+
+def format_flights(flights, template='%d-%m-%Y %H:%M'):
+    """
+    :param flights: numpy.ndarray datetime64[m]
+    :param template: формат datetime.strftime
+    :return: list[str, ...]
+    """
+    return [flight.strftime(template) for flight in flights.astype(datetime)]
+
+
+class TimetableIndex:
+
+    """
+    Расписание всех маршрутов на horizon_days дней вперёд от начала текущего месяца
+    """
+
+    def __init__(self, route_table, regular_flights, random_per_month=13, horizon_days=400, seed=0):
+        """
+        :param route_table: таблица маршрутов {город отправления: [город назначения, ...]}
+        :param regular_flights: регулярные рейсы {(откуда, куда): {'week_days' или 'month_days', 'hour', 'minute'}}
+        :param random_per_month: количество случайных рейсов маршрута в месяц
+        :param horizon_days: на сколько дней вперёд строится расписание
+        :param seed: зерно генерации случайных рейсов
+        """
+        self.routes = route_list(route_table=route_table)
+        self.regular_flights = regular_flights
+        self.random_per_month = random_per_month
+        self.horizon_days = horizon_days
+        self.seed = seed
+
+        self._build_lock = threading.Lock()
+        self._built = None  # (dict {(откуда, куда): numpy.ndarray datetime64[m]}, начало, конец)
+
+    def next_flights(self, departure, arrival, date, count=5):
+        """
+        Ближайшие рейсы не раньше даты
+        :param departure: город отправления
+        :param arrival: город назначения
+        :param date: datetime object
+        :param count: количество рейсов
+        :return: numpy.ndarray datetime64[m]
+        """
+        route = (departure, arrival)
+        schedule, start, end = self.schedule()
+        flights = schedule.get(route)
+        moment = np.datetime64(date, 'm')
+        if flights is not None and start <= date < end:
+            result = flights[np.searchsorted(flights, moment):][:count]
+            window_start = end
+        else:
+            # маршрут не из таблицы или дата за пределами построенного расписания
+            result = flights[:0] if flights is not None else np.empty(0, dtype='datetime64[m]')
+            window_start = datetime(year=date.year, month=date.month, day=1)
+
+        # рейсов до конца расписания не хватает - следующие промежутки строятся без сохранения
+        for _ in range(EXTRA_WINDOWS):
+            if len(result) >= count:
+                break
+            window_end = window_start + timedelta(days=EXTRA_WINDOW_DAYS)
+            extra = generate_schedule(routes=[route], regular_flights=self.regular_flights,
+                                      start=window_start, end=window_end, random_per_month=self.random_per_month,
+                                      seed=self.seed)[route]
+            extra = extra[extra >= moment]
+            result = np.concatenate((result, extra[:count - len(result)]))
+            window_start = window_end
+        return result
+
+    def schedule(self):
+        """
+        Расписание всех маршрутов (строится при старте и при наступлении нового месяца)
+        Новое расписание строит один поток, остальные до его замены получают прежнее и не ждут.
+        :return: (dict {(откуда, куда): numpy.ndarray datetime64[m]}, начало, конец)
+        """
+        today = datetime.today()
+        start = datetime(year=today.year, month=today.month, day=1)
+        built = self._built
+        if built is not None and built[1] == start:
+            return built
+        # ждать построения нужно, только если прежнего расписания нет
+        if not self._build_lock.acquire(blocking=built is None):
+            return built
+        try:
+            built = self._built
+            if built is None or built[1] != start:
+                end = start + timedelta(days=self.horizon_days)
+                schedule = generate_schedule(routes=self.routes, regular_flights=self.regular_flights,
+                                             start=start, end=end, random_per_month=self.random_per_month,
+                                             seed=self.seed)
+                built = self._built = (schedule, start, end)
+        finally:
+            self._build_lock.release()
+        return built
+
+    def build_all(self):
+        """
+        Построение расписания всех маршрутов заранее (при старте бота)
+        """
+        self.schedule()